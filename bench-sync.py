@@ -0,0 +1,542 @@
+import sys
+import os
+import io
+import json
+import time
+import runpy
+import random
+import shlex
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import contextlib
+import subprocess
+import tracemalloc
+import sync_common
+
+
+class TreeGenerator:
+    """
+    TreeGenerator class:
+    Builds reproducible directory trees for the end to end benchmarks. Every profile is generated from a seeded random
+    number generator, so the same seed and scale always give the same names, sizes and contents. File names are unique
+    across the whole tree as the server keeps every file in one directory.
+    The profiles are:
+    * small_files - thousands of small files spread over a few dozen directories
+    * huge_files - a handful of very large files
+    * deep_nesting - a chain of directories many levels deep with a few files at each level
+    * duplicates - many files sharing a small number of distinct contents
+    """
+
+    PROFILES = ['small_files', 'huge_files', 'deep_nesting', 'duplicates']
+
+    def __init__(self, seed=0, scale=1.0):
+        """
+        Initialise the generator
+        :param seed: The seed for the random number generator
+        :param scale: Multiplier applied to the number (or size for huge_files) of files in each profile
+        """
+        self.SEED = seed
+        self.SCALE = scale
+
+    def count(self, number):
+        """
+        :param number: The number of files at a scale of 1
+        :return: The number of files at the generator's scale, at least one
+        """
+        return max(1, int(number * self.SCALE))
+
+    def write(self, path, data):
+        """
+        Write a file, creating the directories above it
+        :param path: The path of the file
+        :param data: The contents of the file
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def generate(self, profile, folder):
+        """
+        Generate the tree for a profile
+        :param profile: The name of the profile
+        :param folder: The folder to generate the tree in
+        :return: List of the paths of the files generated
+        """
+        rng = random.Random('%s:%s' % (self.SEED, profile))
+        paths = []
+        if profile == 'small_files':
+            for i in range(self.count(5000)):
+                paths.append(os.path.join(folder, 'dir_%02d' % (i % 50), 'small_%06d.dat' % i))
+                self.write(paths[-1], rng.randbytes(rng.randint(1024, 16 * 1024)))
+        elif profile == 'huge_files':
+            for i in range(4):
+                paths.append(os.path.join(folder, 'huge_%d.bin' % i))
+                self.write(paths[-1], rng.randbytes(int(64 * 1024 * 1024 * self.SCALE)))
+        elif profile == 'deep_nesting':
+            directory = folder
+            for level in range(32):
+                directory = os.path.join(directory, 'level_%02d' % level)
+                for i in range(self.count(8)):
+                    paths.append(os.path.join(directory, 'deep_%02d_%03d.dat' % (level, i)))
+                    self.write(paths[-1], rng.randbytes(rng.randint(1024, 8 * 1024)))
+        elif profile == 'duplicates':
+            contents = [rng.randbytes(rng.randint(4 * 1024, 64 * 1024)) for i in range(50)]
+            for i in range(self.count(2000)):
+                paths.append(os.path.join(folder, 'dir_%02d' % (i % 20), 'copy_%06d.dat' % i))
+                self.write(paths[-1], rng.choice(contents))
+        else:
+            raise ValueError('Unknown profile: ' + profile)
+        return paths
+
+    def seed_server(self, profile, paths, folder):
+        """
+        Give the server a starting state that exercises every part of a sync: a tenth of the client's files are present
+        under other names (local copies), a twentieth are present with different contents (deletes and transfers) and
+        there are some files the client does not have (deletes)
+        :param profile: The name of the profile, used to seed the random number generator
+        :param paths: The paths of the client files
+        :param folder: The server folder
+        """
+        rng = random.Random('%s:%s:server' % (self.SEED, profile))
+        for path in rng.sample(paths, len(paths) // 10):
+            shutil.copy(path, os.path.join(folder, 'renamed_' + os.path.basename(path)))
+        for path in rng.sample(paths, len(paths) // 20):
+            self.write(os.path.join(folder, os.path.basename(path)), rng.randbytes(1024))
+        for i in range(max(1, len(paths) // 20)):
+            self.write(os.path.join(folder, 'stale_%06d.dat' % i), rng.randbytes(1024))
+
+
+class PhaseTimer:
+    """
+    PhaseTimer class:
+    Collects the time spent in each phase of a sync. Phases may be recorded from the client and server threads, and
+    a phase recorded more than once has its times added together.
+    """
+
+    def __init__(self):
+        """
+        Initialise the timer with no phases recorded
+        """
+        self.PHASES = {}
+        self.MARKS = {}
+        self.LOCK = threading.Lock()
+
+    def record(self, phase, seconds):
+        """
+        Add time to a phase
+        :param phase: The name of the phase
+        :param seconds: The seconds spent in the phase
+        """
+        with self.LOCK:
+            self.PHASES[phase] = self.PHASES.get(phase, 0) + seconds
+
+    def mark(self, name):
+        """
+        Record the current time under a name, used to time phases that start on one side and end on the other
+        :param name: The name of the mark
+        """
+        self.MARKS[name] = time.perf_counter()
+
+    def since(self, phase, name):
+        """
+        Record the time since a mark against a phase
+        :param phase: The name of the phase
+        :param name: The name of the mark the phase started at
+        """
+        self.record(phase, time.perf_counter() - self.MARKS[name])
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        """
+        Time the body of a with statement against a phase
+        :param phase: The name of the phase
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - start)
+
+
+class SyncBenchmark:
+    """
+    SyncBenchmark class:
+    Runs the benchmarks for the server-sync project and prints the results as JSON so they can be saved and compared
+    between versions.
+    The classes under test are loaded straight from server-sync.py, client-sync.py and sync_common.py so the benchmarks
+    always measure the code in the working tree.
+    The end to end benchmark runs each profile in a fresh process, as the server binds its fixed ports for the life of
+    the process.
+    """
+
+    BENCHMARKS = ['file_table_memory', 'transport_throughput', 'hash_throughput', 'end_to_end']
+
+    SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server-sync.py')
+    CLIENT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'client-sync.py')
+    NETEM_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'netem-sync.py')
+    ENTRIES = 100000
+    TRANSFER_BYTES = 256 * 1024 * 1024
+    HASH_SIZES = [1024 * 1024, 16 * 1024 * 1024, 128 * 1024 * 1024, 1024 * 1024 * 1024]
+
+    def __init__(self, args=None):
+        """
+        Initialise the benchmark, loading the server and client scripts without running them
+        :param args: The command line arguments, sys.argv is used when not given
+        """
+        self.ARGUMENTS = self.parse_arguments(args)
+        self.SERVER = runpy.run_path(self.SERVER_SCRIPT)
+        self.CLIENT = runpy.run_path(self.CLIENT_SCRIPT)
+        self.NETEM = runpy.run_path(self.NETEM_SCRIPT)
+        self.RESULTS = {'python': sys.version.split()[0], 'time': time.time(), 'seed': self.ARGUMENTS.seed,
+                        'scale': self.ARGUMENTS.scale, 'netem': self.ARGUMENTS.netem, 'shards': self.ARGUMENTS.shards,
+                        'benchmarks': {}}
+
+    @staticmethod
+    def parse_arguments(args=None):
+        """
+        Read the benchmarks to run and their settings from the command line
+        :param args: The command line arguments, sys.argv is used when not given
+        :return: The parsed arguments
+        """
+        parser = argparse.ArgumentParser(description='Benchmark the server-sync project')
+        parser.add_argument('--benchmarks', nargs='+', choices=SyncBenchmark.BENCHMARKS,
+                            default=SyncBenchmark.BENCHMARKS, help='The benchmarks to run (default: all)')
+        parser.add_argument('--profiles', nargs='+', choices=TreeGenerator.PROFILES, default=TreeGenerator.PROFILES,
+                            help='The trees to sync in the end to end benchmark (default: all)')
+        parser.add_argument('--seed', type=int, default=0, help='Seed for the generated trees (default: 0)')
+        parser.add_argument('--scale', type=float, default=1.0,
+                            help='Multiplier for the number or size of files in the generated trees (default: 1)')
+        parser.add_argument('--output', default='', metavar='FILE', help='Write the results to FILE as well')
+        parser.add_argument('--compare', default='', metavar='FILE',
+                            help='Compare the timings against the results of an earlier run saved in FILE')
+        parser.add_argument('--netem', default='', metavar='OPTIONS',
+                            help='Run the end to end syncs through netem-sync.py started with OPTIONS, e.g. '
+                                 '--netem="--latency 20 --bandwidth 10M"')
+        parser.add_argument('--shards', type=int, default=1, metavar='N',
+                            help='Run the end to end syncs against a server sharded across N processes (default: 1)')
+        parser.add_argument('--worker', default='', metavar='PROFILE', help=argparse.SUPPRESS)
+        return parser.parse_args(args)
+
+    def sample_files(self, count):
+        """
+        Generate a list of file details shaped like a photography archive, a few hundred directories holding a few
+        hundred files each
+        :param count: The number of files to generate
+        :return: List of [root, name, raw md5] lists
+        """
+        files = []
+        for i in range(count):
+            root = '/srv/photos/2020/shoot_%04d/raw' % (i // 250)
+            name = 'IMG_%06d.CR2' % i
+            files.append([root, name, hashlib.md5(name.encode()).digest()])
+        return files
+
+    def measure(self, build):
+        """
+        Measure the memory held by the object returned from build()
+        :param build: Function building the object to measure
+        :return: Tuple of the bytes held and the seconds taken to build
+        """
+        tracemalloc.start()
+        start = time.perf_counter()
+        held = build()
+        elapsed = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del held
+        return current, elapsed
+
+    def bench_file_table_memory(self):
+        """
+        Compare the memory per entry of the original list of [root, name, md5] lists against the FileTable
+        """
+        file_table = sync_common.FileTable
+        files = self.sample_files(self.ENTRIES)
+
+        def build_lists():
+            # Copy the strings so the list does not share the objects held by the sample data
+            return [[''.join(root), ''.join(name), md5.hex()] for root, name, md5 in files]
+
+        def build_table():
+            table = file_table()
+            for root, name, md5 in files:
+                table.add(root, name, md5)
+            return table
+
+        list_bytes, list_seconds = self.measure(build_lists)
+        table_bytes, table_seconds = self.measure(build_table)
+        table = build_table()
+        packed = table.to_bytes()
+        start = time.perf_counter()
+        file_table.from_bytes(packed)
+        decode_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        table.find_names(table)
+        table.find_digests(table)
+        lookup_seconds = time.perf_counter() - start
+
+        self.RESULTS['benchmarks']['file_table_memory'] = {
+            'entries': self.ENTRIES,
+            'list_bytes_per_entry': list_bytes / self.ENTRIES,
+            'table_bytes_per_entry': table_bytes / self.ENTRIES,
+            'packed_bytes_per_entry': len(packed) / self.ENTRIES,
+            'list_build_seconds': list_seconds,
+            'table_build_seconds': table_seconds,
+            'table_decode_seconds': decode_seconds,
+            'table_lookup_seconds': lookup_seconds,
+        }
+
+    def transfer(self, receive, send):
+        """
+        Time a single file transfer, the receiving side is run on a thread while the sending side retries until the
+        receiver is listening
+        :param receive: Function receiving the file, returns once the file is committed
+        :param send: Function sending the file
+        :return: The seconds taken from the first send attempt to the file being committed
+        """
+        receiver = threading.Thread(target=receive)
+        receiver.start()
+        start = time.perf_counter()
+        while True:
+            try:
+                send()
+                break
+            except (ConnectionRefusedError, FileNotFoundError):
+                time.sleep(0.001)
+        receiver.join()
+        return time.perf_counter() - start
+
+    def bench_transport_throughput(self):
+        """
+        Compare the throughput of sending a file over TCP loopback against the local transport, which passes the file
+        descriptor over a unix domain socket for the server to copy from
+        """
+        file_server = self.SERVER['FileServer']
+        file_client = self.CLIENT['FileClient']
+        writer = self.SERVER['FileWriter'](self.SERVER['FileCommitter']())
+        results = {'bytes': self.TRANSFER_BYTES}
+        with tempfile.TemporaryDirectory() as folder:
+            source = os.path.join(folder, 'source')
+            target = os.path.join(folder, 'target')
+            os.mkdir(source)
+            os.mkdir(target)
+            block = os.urandom(1024 * 1024)
+            with open(os.path.join(source, 'file.bin'), 'wb') as f:
+                for i in range(self.TRANSFER_BYTES // len(block)):
+                    f.write(block)
+            path = os.path.join(folder, 'sync.sock.data')
+
+            def receive_tcp():
+                file_server().receive_file('file.bin', target, writer)
+                writer.flush()
+
+            def receive_unix():
+                file_server().receive_descriptor('file.bin', target, writer, path)
+                writer.flush()
+
+            seconds = self.transfer(receive_tcp, lambda: file_client().send_file(source, 'file.bin'))
+            results['tcp_loopback_seconds'] = seconds
+            results['tcp_loopback_mb_per_second'] = self.TRANSFER_BYTES / seconds / 1e6
+            seconds = self.transfer(receive_unix, lambda: file_client().send_descriptor(source, 'file.bin', path))
+            results['unix_descriptor_seconds'] = seconds
+            results['unix_descriptor_mb_per_second'] = self.TRANSFER_BYTES / seconds / 1e6
+        self.RESULTS['benchmarks']['transport_throughput'] = results
+
+    def bench_hash_throughput(self):
+        """
+        Compare the throughput of hashing files of a range of sizes, scaled by --scale, with the original 4KB read loop,
+        the scanner's reads into a reused buffer and the scanner's memory mapped path. Each file is read once first so
+        the timings are of hashing from the page cache rather than of the disk
+        """
+        file_scanner = sync_common.FileScanner
+        methods = {
+            'read_4k': lambda path, size: self.hash_4k(path),
+            'readinto': file_scanner(mmap_threshold=0).hash_file,
+            'mmap': file_scanner(mmap_threshold=1).hash_file,
+        }
+        results = {}
+        with tempfile.TemporaryDirectory() as folder:
+            block = os.urandom(1024 * 1024)
+            for size in self.HASH_SIZES:
+                size = max(len(block), int(size * self.ARGUMENTS.scale) // len(block) * len(block))
+                path = os.path.join(folder, 'file.bin')
+                with open(path, 'wb') as f:
+                    for i in range(size // len(block)):
+                        f.write(block)
+                self.hash_4k(path)
+                result = {}
+                for method, hash_file in methods.items():
+                    start = time.perf_counter()
+                    hash_file(path, size)
+                    seconds = time.perf_counter() - start
+                    result[method + '_seconds'] = seconds
+                    result[method + '_mb_per_second'] = size / seconds / 1e6
+                results[str(size)] = result
+                os.remove(path)
+        self.RESULTS['benchmarks']['hash_throughput'] = results
+
+    @staticmethod
+    def hash_4k(path):
+        """
+        Hash a file the way the scan originally did, in 4KB reads
+        :param path: The path of the file
+        :return: The raw md5 of the file
+        """
+        file_md5 = hashlib.md5()
+        with open(path, 'rb') as open_file:
+            for data in iter(lambda: open_file.read(4096), b""):
+                file_md5.update(data)
+        return file_md5.digest()
+
+    def tree_contents(self, folder):
+        """
+        :param folder: The folder to list
+        :return: Sorted list of [file name, md5] for every file beneath the folder, used to check a sync converged
+        """
+        contents = []
+        for root, dirs, files in os.walk(folder):
+            for file in files:
+                contents.append([file, self.hash_4k(os.path.join(root, file)).hex()])
+        return sorted(contents)
+
+    def run_sync(self, profile):
+        """
+        Generate the trees for a profile and time a single sync between a client and server over loopback. The server
+        runs on a thread and both sides are subclassed to record the time spent in each phase:
+        * client_scan / server_scan - reading and hashing each side's files
+        * list_exchange - encoding, sending and decoding the client's file list
+        * diff - comparing the file lists
+        * local_ops - the server queuing its local copies and deletes, which then run alongside the transfer
+        * transfer - requesting and receiving the files the server needs, through to sync:done
+        * server_rescan - the server rereading its files after the sync
+        When --netem is given the server listens on ports 7201 and 7200 and the client connects through the network
+        emulator forwarding 7101 and 7100 to them, and when --shards is given the server is sharded
+        :param profile: The name of the profile
+        :return: Dictionary of the results for the profile
+        """
+        timer = PhaseTimer()
+        scanned = threading.Event()
+        rescanned = threading.Event()
+        generator = TreeGenerator(self.ARGUMENTS.seed, self.ARGUMENTS.scale)
+
+        class TimedServer(self.SERVER['SyncServer']):
+            def read_local_storage(self):
+                phase = 'server_rescan' if scanned.is_set() else 'server_scan'
+                with timer.phase(phase):
+                    file_list = super().read_local_storage()
+                (rescanned if scanned.is_set() else scanned).set()
+                return file_list
+
+            def compare_client_files_with_local(self, files):
+                timer.since('list_exchange', 'client_scanned')
+                start = time.perf_counter()
+                super().compare_client_files_with_local(files)
+                timer.record('diff', time.perf_counter() - start - timer.PHASES.get('local_ops', 0))
+
+            def update(self, get_files, delete_files, copy_rename_files):
+                with timer.phase('local_ops'):
+                    super().update(get_files, delete_files, copy_rename_files)
+                timer.mark('transfer_start')
+
+        class TimedClient(self.CLIENT['SyncClient']):
+            def read_local_storage(self):
+                with timer.phase('client_scan'):
+                    file_list = super().read_local_storage()
+                timer.mark('client_scanned')
+                return file_list
+
+            def process_sync(self):
+                super().process_sync()
+                timer.since('transfer', 'transfer_start')
+
+        with tempfile.TemporaryDirectory() as folder:
+            client_folder = os.path.join(folder, 'client')
+            server_folder = os.path.join(folder, 'server')
+            os.mkdir(server_folder)
+            paths = generator.generate(profile, client_folder)
+            generator.seed_server(profile, paths, server_folder)
+            emulator = None
+            server_args = [server_folder, '--shards', str(self.ARGUMENTS.shards)]
+            if self.ARGUMENTS.netem:
+                server_args += ['--port', '7201', '--data-port', '7200']
+            # A sharded server forks its workers, so it is started before the emulator starts its threads
+            server = TimedServer(server_args)
+            if self.ARGUMENTS.netem:
+                emulator = self.NETEM['NetworkEmulator'](shlex.split(self.ARGUMENTS.netem))
+                emulator.start()
+            threading.Thread(target=server.run, daemon=True).start()
+            scanned.wait()
+            start = time.perf_counter()
+            TimedClient([client_folder]).run()
+            total = time.perf_counter() - start
+            rescanned.wait()
+            if emulator is not None:
+                emulator.stop()
+            return {
+                'files': len(paths),
+                'bytes': sum(os.path.getsize(path) for path in paths),
+                'sync_seconds': total,
+                'phases': {phase + '_seconds': seconds for phase, seconds in sorted(timer.PHASES.items())},
+                'converged': self.tree_contents(client_folder) == self.tree_contents(server_folder),
+            }
+
+    def bench_end_to_end(self):
+        """
+        Run a full sync for each profile, each in a fresh process running this script as a worker
+        """
+        results = {}
+        for profile in self.ARGUMENTS.profiles:
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', profile,
+                                     '--seed', str(self.ARGUMENTS.seed), '--scale', str(self.ARGUMENTS.scale),
+                                     '--netem=' + self.ARGUMENTS.netem, '--shards', str(self.ARGUMENTS.shards)],
+                                    check=True, stdout=subprocess.PIPE).stdout
+            results[profile] = json.loads(output)
+        self.RESULTS['benchmarks']['end_to_end'] = results
+
+    def compare(self, previous):
+        """
+        Compare every timing in the results against an earlier run
+        :param previous: The results of the earlier run
+        :return: Dictionary of each timing's path to the ratio of the new time to the old, above 1 is slower
+        """
+        def timings(results, path=''):
+            found = {}
+            for key, value in results.items():
+                if isinstance(value, dict):
+                    found.update(timings(value, path + key + '.'))
+                elif key.endswith('_seconds') and isinstance(value, (int, float)):
+                    found[path + key] = value
+            return found
+
+        old = timings(previous.get('benchmarks', {}))
+        new = timings(self.RESULTS['benchmarks'])
+        return {key: new[key] / old[key] for key in sorted(new) if old.get(key)}
+
+    def run(self):
+        """
+        Run the selected benchmarks and print the results, the output of the classes under test is discarded so only
+        the JSON results are printed
+        """
+        if self.ARGUMENTS.worker:
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = self.run_sync(self.ARGUMENTS.worker)
+            print(json.dumps(result))
+            return
+        with contextlib.redirect_stdout(io.StringIO()):
+            for benchmark in self.ARGUMENTS.benchmarks:
+                getattr(self, 'bench_' + benchmark)()
+        if self.ARGUMENTS.compare:
+            with open(self.ARGUMENTS.compare) as f:
+                self.RESULTS['comparison'] = self.compare(json.load(f))
+        output = json.dumps(self.RESULTS, indent=2)
+        if self.ARGUMENTS.output:
+            with open(self.ARGUMENTS.output, 'w') as f:
+                f.write(output + '\n')
+        print(output)
+
+
+if __name__ == '__main__':
+    SyncBenchmark().run()
@@ -1,48 +1,174 @@
 import time
 import socket
+import select
 import sys
 import os
-import hashlib
-import pickle
 import ast
+import argparse
+import json
+import logging
+import struct
+import base64
+from sync_common import FileEventFilter, FileTable, SyncIgnore, StatCache, FileScanner, LinkTuner, SyncMetrics, \
+    SyncProfiler, SyncConnection, FileExtents, SocketConnector
 
+# Loggers for each part of the client, per-file events go to FILE_LOG and FILE_CLIENT_LOG at DEBUG so they cost next
+# to nothing at the default level
+CLIENT_LOG = logging.getLogger('SC')
+FILE_LOG = logging.getLogger('SC.files')
+FILE_CLIENT_LOG = logging.getLogger('FC')
+PROFILE_LOG = logging.getLogger('SC.profile')
 
-class FileClient:
+
+class FileClient(SocketConnector):
     """
     FileClient class:
     A small self contained class that connects to a socket purely for sending a file to the server.
     Once the file has been sent the socket is closed off.
-    Uses a hardcoded server and port.
+    Connects to localhost, port 7100 unless another server and port are given.
+    A server that asks for extents is sent each run of data as a record holding its offset and length, leaving out the
+    holes of sparse files and any whole ZERO_BLOCK of zeros. The file ends with a record of no data holding its size.
+    A refused connection is retried by the SocketConnector, as an older server only starts listening for a file once it
+    has sent the filerequest.
     """
 
-    def send_file(self, folder, file):
+    DATA_TIMEOUT = 60
+    EXTENT = struct.Struct('!QQ')
+    ZERO_BLOCK = 64 * 1024
+    ZEROS = bytes(ZERO_BLOCK)
+    READ_SIZE = 1024 * 1024
+
+    def send_file(self, folder, file, server='localhost', port=7100, tuner=None, extents=False):
         """
         For a given file and location, a connection is opened, the file is opened and sent to the server and connection
         closed down once completed.
+        With a tuner the socket buffer and chunk size are set for the link, and for a file large enough to measure the
+        client waits for the server to close the connection so the time taken is how long the data took to arrive.
+        A server that stops reading, or does not close the connection, for DATA_TIMEOUT raises socket.timeout
         :param file: The name of the file to be read
         :param folder: The location for the file read
+        :param server: The host of the server
+        :param port: The port the server listens for file data on
+        :param tuner: The LinkTuner sizing the transfer and measuring the link, if any
+        :param extents: Whether to send the file as extent records, leaving out its holes and blocks of zeros
+        :return: The number of bytes of file data sent
         """
-        while True:
-            print('FC: Connecting to host: localhost port: 7100' + file)
-            # Configure the socket
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect(('localhost', 7100))
-            print('FC: Connected')
-            print('FC: Reading:', file)
-            # Open the file
-            f = open(os.path.join(folder, file), 'rb')
-            # Send the data in chunks
-            data = f.read(1024)
-            while (data):
-                s.sendall(data)
-                data = f.read(1024)
-            # Close the file
-            f.close()
-            print('FC: File sent')
-            # Close the socket
+        FILE_CLIENT_LOG.debug('Connecting to host: %s port: %d %s', server, port, file)
+        # Configure the socket
+        s = self.connect(socket.AF_INET, (server, port), tuner.buffer_size('tcp_wmem') if tuner else 0)
+        FILE_CLIENT_LOG.debug('Connected')
+        # A server that stalls without closing the connection would otherwise hold up the sync for good
+        s.settimeout(self.DATA_TIMEOUT)
+        try:
+            FILE_CLIENT_LOG.debug('Reading: %s', file)
+            send_start = time.perf_counter()
+            chunk_size = tuner.chunk_size() if tuner else LinkTuner.MIN_CHUNK
+            with open(os.path.join(folder, file), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if extents:
+                    # Records are written as they are found, so small ones are not held back waiting for the next
+                    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    sent = self.send_extents(s, f.fileno(), size, chunk_size)
+                elif hasattr(os, 'sendfile'):
+                    # Send the data in chunks by sendfile, so it goes straight from the page cache to the socket, the
+                    # socket's sendfile waits for the socket within its timeout
+                    sent = 0
+                    while sent < size:
+                        length = s.sendfile(f, sent, min(chunk_size, size - sent))
+                        if length == 0:
+                            break
+                        sent += length
+                else:
+                    sent = 0
+                    data = f.read(chunk_size)
+                    while data:
+                        s.sendall(data)
+                        sent += len(data)
+                        data = f.read(chunk_size)
+            if tuner is not None and size >= tuner.MIN_SAMPLE:
+                # The server closes the connection once it has read everything
+                s.shutdown(socket.SHUT_WR)
+                s.recv(1)
+                tuner.add_transfer(sent, time.perf_counter() - send_start)
+        finally:
+            # Close the socket, also when the transfer failed
             s.close()
-            # Exit out now file send is complete
-            break
+        FILE_CLIENT_LOG.debug('File sent, %d of %d bytes', sent, size)
+        return sent
+
+    def send_extents(self, s, fd, size, chunk_size):
+        """
+        Send a file as extent records. Each run of data is read a chunk at a time and every whole ZERO_BLOCK of zeros,
+        aligned to the file, is left out, so the server can leave it as a hole
+        :param s: The connected socket
+        :param fd: The file descriptor of the file
+        :param size: The size of the file
+        :param chunk_size: The most to read at a time, a multiple of ZERO_BLOCK
+        :return: The number of bytes of file data sent
+        """
+        sent = 0
+        for start, length in FileExtents.find(fd, size):
+            position, end = start, start + length
+            while position < end:
+                data = os.pread(fd, min(max(chunk_size, self.READ_SIZE), end - position), position)
+                if not data:
+                    break
+                # Walk the chunk a block at a time, sending the data before each block of zeros
+                run = block = 0
+                while block < len(data):
+                    block_end = min(len(data), (position + block) // self.ZERO_BLOCK * self.ZERO_BLOCK +
+                                    self.ZERO_BLOCK - position)
+                    if block_end - block == self.ZERO_BLOCK and data[block:block_end] == self.ZEROS:
+                        sent += self.send_record(s, position + run, data, run, block)
+                        run = block_end
+                    block = block_end
+                sent += self.send_record(s, position + run, data, run, len(data))
+                position += len(data)
+        s.sendall(self.EXTENT.pack(size, 0))
+        return sent
+
+    def send_record(self, s, offset, data, start, end):
+        """
+        Send one extent record, the header and data together in as few system calls as possible
+        :param s: The connected socket
+        :param offset: The offset of the data in the file
+        :param data: The chunk holding the data
+        :param start: The start of the data in the chunk
+        :param end: The end of the data in the chunk
+        :return: The number of bytes of file data sent
+        """
+        if end <= start:
+            return 0
+        buffers = [self.EXTENT.pack(offset, end - start), memoryview(data)[start:end]]
+        while buffers:
+            length = s.sendmsg(buffers)
+            # Drop whatever has been sent from the front of the buffers
+            while buffers and length >= len(buffers[0]):
+                length -= len(buffers[0])
+                buffers.pop(0)
+            if buffers:
+                buffers[0] = buffers[0][length:]
+        return end - start
+
+    def send_descriptor(self, folder, file, path):
+        """
+        The local transport version of send_file(). For a given file and location, a connection is opened to the
+        server's unix domain socket and rather than sending the data the open file descriptor is passed to the server
+        (SCM_RIGHTS) so it can copy the file directly.
+        :param folder: The location for the file read
+        :param file: The name of the file to be read
+        :param path: The path of the server's unix domain socket for file data
+        """
+        FILE_CLIENT_LOG.debug('Connecting to host: %s %s', path, file)
+        # Configure the socket
+        s = self.connect(socket.AF_UNIX, path)
+        FILE_CLIENT_LOG.debug('Connected')
+        # Open the file and pass its descriptor over the socket
+        with open(os.path.join(folder, file), 'rb') as f:
+            socket.send_fds(s, [b'file'], [f.fileno()])
+        FILE_CLIENT_LOG.debug('File sent')
+        # Close the socket
+        s.close()
 
 
 class SyncClient:
@@ -55,32 +181,147 @@ class SyncClient:
     LOCAL_FOLDER = ''
     CURRENT_FILE_LIST = ''
     SOCKET = []
-    HEADER = 10
+    CONNECTION = None
     SERVER = 'localhost'
     PORT = 7101
+    DATA_PORT = 7100
+    UNIX_SOCKET = ''
+    SESSION = False
+    READY = False
+    HEARTBEAT = 30
+    LAST_HEARTBEAT = 0
+    CYCLE = 60
+    METRICS = None
+    METRIC_DESCRIPTIONS = {
+        'chunk_bytes': ['gauge', 'Size of the chunks file data is sent in'],
+        'sparse_bytes_total': ['counter', 'Number of bytes of holes and zeros left out of the files transferred'],
+    }
+    SUMMARY = {}
+    SUMMARY_FILE = ''
+    METRICS_FILE = ''
+    PROFILER = None
+    IGNORE = None
+    IGNORE_RULES = []
+    FADVISE = False
+    CACHE = None
+    TUNER = None
+    NODELAY = False
+    PROBE_TIMEOUT = 10
 
-    def __init__(self):
+    def __init__(self, args=None):
         """
         Initialise the main SyncClient class
         Checks arguments for 1 argument which should be the directory to monitor.
-        Socket connection to the hardcoded values stored in the variables SERVER and PORT
+        Socket connection to the values stored in the variables SERVER and PORT, or to a unix domain socket when the
+        local transport is selected with --unix
+        :param args: The command line arguments, sys.argv is used when not given
         """
-        # Find the first argument and assign to variable LOCAL_FOLDER
-        for i, arg in enumerate(sys.argv):
-            if i == 1:
-                self.LOCAL_FOLDER = str(arg)
-                print('SC: Local directory:', self.LOCAL_FOLDER)
+        # Find the first argument and assign to variable LOCAL_FOLDER along with any options
+        arguments = self.parse_arguments(args)
+        FileEventFilter.configure_logging(arguments, [FILE_LOG, FILE_CLIENT_LOG])
+        if arguments.folder:
+            self.LOCAL_FOLDER = str(arguments.folder)
+            CLIENT_LOG.info('Local directory: %s', self.LOCAL_FOLDER)
+        self.UNIX_SOCKET = arguments.unix
+        self.SERVER = arguments.server
+        self.PORT = arguments.port
+        self.DATA_PORT = arguments.data_port
+        self.SESSION = arguments.session
+        self.HEARTBEAT = arguments.heartbeat
+        self.CYCLE = arguments.cycle
+        self.METRICS = SyncMetrics('client_sync', self.METRIC_DESCRIPTIONS)
+        self.SUMMARY = {}
+        self.SUMMARY_FILE = arguments.summary
+        self.METRICS_FILE = arguments.metrics
+        self.IGNORE_RULES = arguments.ignore
+        self.FADVISE = arguments.fadvise
+        if arguments.state:
+            os.makedirs(arguments.state, exist_ok=True)
+        self.CACHE = StatCache(os.path.join(arguments.state, 'client-cache') if arguments.state else '')
+        # The tuner's measurements are kept from one sync to the next, the local transport has no link to tune
+        if not arguments.no_tune and not self.UNIX_SOCKET:
+            self.TUNER = LinkTuner()
+        self.NODELAY = arguments.nodelay
+        self.PROFILER = SyncProfiler('client', PROFILE_LOG, arguments.profile, arguments.trace_alloc,
+                                     arguments.profile_rate, arguments.profile_keep)
         # If no directory specified exit out
         if self.LOCAL_FOLDER == '':
-            print('SC: No local directory specified')
+            CLIENT_LOG.error('No local directory specified')
             sys.exit(1)
 
+    @staticmethod
+    def parse_arguments(args=None):
+        """
+        Read the directory to monitor and any options from the command line
+        :param args: The command line arguments, sys.argv is used when not given
+        :return: The parsed arguments
+        """
+        parser = argparse.ArgumentParser(description='Relay changes in a local directory to the server')
+        parser.add_argument('folder', nargs='?', default='', help='The directory to monitor')
+        parser.add_argument('--unix', default='', metavar='PATH',
+                            help='Use the local transport for a server on the same host: control messages over a '
+                                 'unix domain socket at PATH and file data passed as file descriptors over PATH.data')
+        parser.add_argument('--server', default='localhost', metavar='HOST',
+                            help='The host the server is running on (default: localhost)')
+        parser.add_argument('--port', type=int, default=7101,
+                            help='The port the server listens for control messages on (default: 7101)')
+        parser.add_argument('--data-port', type=int, default=7100,
+                            help='The port the server listens for file data on (default: 7100)')
+        parser.add_argument('--session', action='store_true',
+                            help='Hold the connection to the server open between syncs rather than reconnecting every '
+                                 'cycle')
+        parser.add_argument('--heartbeat', type=float, default=30, metavar='SECONDS',
+                            help='The interval between heartbeats while a session is idle (default: 30)')
+        parser.add_argument('--cycle', type=float, default=60, metavar='SECONDS',
+                            help='The wait between syncs, and before trying again after a failed one (default: 60)')
+        parser.add_argument('--ignore', action='append', default=[], metavar='PATTERN',
+                            help='Leave files and directories matching the gitignore style PATTERN out of the sync, in '
+                                 'addition to the rules in .syncignore at the top of the directory, can be given more '
+                                 'than once')
+        parser.add_argument('--fadvise', action='store_true',
+                            help='Advise the kernel to read ahead when hashing large files and drop each file from the '
+                                 'page cache once hashed, so a full scan does not push everything else out of the '
+                                 'cache')
+        parser.add_argument('--state', default='', metavar='DIR',
+                            help='Save the md5 of every file scanned to DIR so a restarted client only hashes the '
+                                 'files that have changed, DIR should be outside the directory or ignored')
+        parser.add_argument('--no-tune', action='store_true',
+                            help='Leave the socket buffers to the kernel and send file data in fixed chunks rather '
+                                 'than sizing them from the measured round trip time and throughput of the link')
+        parser.add_argument('--nodelay', action='store_true',
+                            help='Send control messages straight away (TCP_NODELAY) rather than letting TCP hold small '
+                                 'messages back to combine them')
+        parser.add_argument('--summary', default='', metavar='FILE',
+                            help='Append a JSON summary record of every sync to FILE')
+        parser.add_argument('--metrics', default='', metavar='FILE',
+                            help='Write the metrics in the Prometheus text format to FILE after every sync, e.g. for '
+                                 'the node exporter\'s textfile collector')
+        FileEventFilter.add_arguments(parser)
+        SyncProfiler.add_arguments(parser)
+        return parser.parse_args(args)
+
+    def write_summary(self):
+        """
+        Print the summary record of the sync just completed and append it to the summary file if one was given, then
+        write out the metrics if a metrics file was given
+        """
+        CLIENT_LOG.info('Summary: %s', self.SUMMARY)
+        if self.SUMMARY_FILE:
+            with open(self.SUMMARY_FILE, 'a') as f:
+                f.write(json.dumps(self.SUMMARY) + '\n')
+        if self.METRICS_FILE:
+            # Replace the file whole so a scrape never reads it half written
+            temp_path = self.METRICS_FILE + '.tmp'
+            with open(temp_path, 'w') as f:
+                f.write(self.METRICS.render())
+            os.replace(temp_path, self.METRICS_FILE)
+
     def read_local_storage(self):
         """
         For the LOCAL_FOLDER variable set from argument passed in, traverse the directory structure beneath it and build
         a file list of every file contained beneath.
 
-        For every file discovered a new list object is created for that file and the following data is stored.
+        For every file discovered an entry is added to a FileTable holding the following data.
 
         [<root directory of the file>, <file name including extension>, <md5 of the file>]
 
@@ -92,83 +333,212 @@ class SyncClient:
         In addition we also use the md5 to check if client files with the same name as a file on the server match in
         orde to indicate whether an update has occurred.
 
-        :return file_list - List object containing a collection of list objects that are used to store file details
-        described above
-        """
-        print('SC: Local file list')
-        file_list = []
-        for root, dirs, files in os.walk(self.LOCAL_FOLDER):
-            for file in files:
-                # Create an md5 object for the file
-                file_md5 = hashlib.md5()
-                # Open the file in binary format to calculate the md5
-                with open(os.path.join(root, file), 'rb') as open_file:
-                    # Add chunks of data to the md5 object
-                    for data in iter(lambda: open_file.read(4096), b""):
-                        file_md5.update(data)
-                file_list.append([root, file, file_md5.hexdigest()])
-                print('SC: File', [root, file, file_md5.hexdigest()])
+        :return file_list - FileTable holding the file details described above
+        """
+        CLIENT_LOG.info('Scanning local directory')
+        log_files = FILE_LOG.isEnabledFor(logging.DEBUG)
+        scan_start = time.perf_counter()
+        file_list = FileTable()
+        self.IGNORE = SyncIgnore.load(self.LOCAL_FOLDER, self.IGNORE_RULES)
+        scanner = FileScanner(self.IGNORE, self.FADVISE, cache=self.CACHE)
+        for root, file, file_md5, file_size in scanner.scan(self.LOCAL_FOLDER):
+            file_list.add(root, file, file_md5, file_size)
+            if log_files:
+                FILE_LOG.debug('File %s', [root, file, file_md5.hex()])
+        # Record how long the scan took and how quickly the files were hashed
+        scan_seconds = time.perf_counter() - scan_start
+        hashed_bytes = scanner.HASHED_BYTES
+        self.METRICS.observe('scan_seconds', scan_seconds)
+        self.METRICS.inc('scanned_files_total', len(file_list))
+        self.METRICS.inc('cached_files_total', scanner.CACHED_FILES)
+        self.METRICS.inc('hashed_bytes_total', hashed_bytes)
+        if scan_seconds > 0:
+            self.METRICS.set('hash_bytes_per_second', hashed_bytes / scan_seconds)
+        self.SUMMARY['scan_seconds'] = scan_seconds
+        self.SUMMARY['files'] = len(file_list)
+        self.SUMMARY['cached_files'] = scanner.CACHED_FILES
         return file_list
 
+    def connect(self):
+        """
+        Setup the socket and connect to the server, over the unix domain socket when using the local transport
+        """
+        # A ready message from a lost session does not carry over to the new connection
+        self.READY = False
+        if self.UNIX_SOCKET:
+            self.SOCKET = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.SOCKET.connect(self.UNIX_SOCKET)
+        else:
+            self.SOCKET = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.SOCKET.connect((self.SERVER, self.PORT))
+            if self.SESSION:
+                # Have TCP keep the connection alive while the session sits idle between syncs
+                self.SOCKET.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if self.NODELAY:
+                self.SOCKET.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.CONNECTION = SyncConnection(self.SOCKET, self.SERVER)
+
     def run(self):
         """
         The main run loop of the ClientSync class that is used to monitor the socket for connections and receiving the
         data from said connection and processing the messages received and acting upon them
         """
-        # Setup the socket and connect to the server
-        self.SOCKET = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.SOCKET.connect((self.SERVER, self.PORT))
-        # Find the local files and send message with list to the server
-        self.send_initial_file_list_to_server()
-        while True:
-            # Initialise variables to indicate whether we are at the start of the message <message_start> and
-            # therefore need to process the header value to find the total length of the message and <message_total>
-            # is initialised in readiness for holding the full message
-            message_start = True
-            message_total = b''
+        self.connect()
+        try:
+            self.sync()
+        finally:
+            # All the work is done so close down the connection and break out to the timer
+            self.SOCKET.close()
 
+    def run_session(self):
+        """
+        The session version of run(). The connection to the server is held open between syncs rather than reconnecting
+        every cycle. The server pushes a ready message once it can take a sync, the client syncs over the existing
+        connection and then waits out the cycle sending heartbeats before syncing again. Returns once the session is
+        lost so the caller can reconnect
+        """
+        self.connect()
+        try:
+            self.CONNECTION.send('session:start')
             while True:
-                # Receive the data
-                data = self.SOCKET.recv(1024)
-                if message_start:
-                    message_length = int(data[:self.HEADER])
-                    print("SC: New message received - Length:", message_length)
-                    # Received the start of a message and have it's length so no longer need to set the message
-                    # length until will start receiving the next message
-                    message_start = False
-
-                # Add additional data received to the existing message we are processing
-                message_total += data
-
-                # if the length of all the data recieved matches that which was specified in the header then we have
-                # a complete message
-                if len(message_total) - self.HEADER == message_length:
-                    # The full message has now been received
-                    # Load the data in using pickle
-                    message_to_process = pickle.loads(message_total[self.HEADER:])
-                    print('SC: RCVD:', message_to_process)
-
-                    # Reset the flag for a new message and clear the full message as not needed from now
-                    message_start = True
-                    message_total = b""
-
-                    # Load in the message type which is the first string in the message and defines what the
-                    # purpose of the message is, essentially a command
-                    message_type = str(message_to_process).split(':')[0]
-                    # Load in the message data which is to be used by the command
-                    message_data = str(message_to_process).split(':')[1]
-
-                    if message_type == 'filerequest':
-                        # A file request message has been received so process it
-                        self.process_file_request_message(message_data)
-                    elif message_type == 'sync':
-                        # Sync done message received so break out of the loop
-                        break
-
-            # All the work is done so close down the connection and break out to the timer
+                # Wait for the server to be ready, it may already have said so while we were waiting out the cycle
+                if not self.READY:
+                    self.wait_for_message(['ready'])
+                self.READY = False
+                self.sync()
+                # Wait out the cycle before syncing again
+                self.wait_for_message([], self.CYCLE)
+        except (OSError, ConnectionError) as error:
+            CLIENT_LOG.warning('Session lost: %s', error)
+        finally:
             self.SOCKET.close()
-            break
 
+    def sync(self):
+        """
+        Run a single sync over the connection and record its summary
+        """
+        sync_start = time.perf_counter()
+        self.SUMMARY = {'time': time.time(), 'server': str(self.CONNECTION.ADDRESS), 'files_sent': 0, 'bytes_sent': 0,
+                        'sparse_bytes': 0, 'files_failed': 0}
+        with self.PROFILER.cycle():
+            if self.TUNER is not None:
+                # Measure the link and let the server know, so it can size its receive buffers to match. Sent ahead of
+                # the scan so the message is not held back by TCP behind the ignore message
+                self.measure_rtt()
+                data = 'tune:' + self.TUNER.encode()
+                CLIENT_LOG.debug('SEND: %s', data)
+                self.CONNECTION.send(data)
+            if not self.UNIX_SOCKET:
+                # Let the server know files can be sent as extents, it asks for them in its file requests
+                self.CONNECTION.send('sparse:extents')
+            # Find the local files and send message with list to the server
+            self.send_initial_file_list_to_server()
+            transfer_start = time.perf_counter()
+            self.process_sync()
+        self.SUMMARY['transfer_seconds'] = time.perf_counter() - transfer_start
+        self.SUMMARY['sync_seconds'] = time.perf_counter() - sync_start
+        self.METRICS.inc('syncs_total')
+        self.METRICS.observe('sync_seconds', self.SUMMARY['sync_seconds'])
+        if self.TUNER is not None:
+            self.record_tuning()
+        self.write_summary()
+
+    def measure_rtt(self):
+        """
+        Time a heartbeat to the server and back to measure the round trip time of the link. The heartbeat carries a
+        probe of its own so the echo of an earlier heartbeat is not mistaken for it
+        """
+        probe = 'probe-%d' % time.monotonic_ns()
+        probe_start = time.perf_counter()
+        self.CONNECTION.send('heartbeat:' + probe)
+        while True:
+            remaining = probe_start + self.PROBE_TIMEOUT - time.perf_counter()
+            message = self.wait_for_message(['heartbeat'], max(remaining, 0), heartbeat=False)
+            if message is None:
+                CLIENT_LOG.warning('No reply to the round trip probe')
+                return
+            if str(message).split(':')[1] == probe:
+                self.TUNER.add_rtt(time.perf_counter() - probe_start)
+                return
+
+    def record_tuning(self):
+        """
+        Add the link measurements and the sizes chosen from them to the summary and metrics
+        """
+        self.SUMMARY['rtt_seconds'] = self.TUNER.RTT
+        self.SUMMARY['link_bytes_per_second'] = self.TUNER.RATE
+        self.SUMMARY['socket_buffer'] = self.TUNER.buffer_size('tcp_wmem')
+        self.SUMMARY['chunk_size'] = self.TUNER.chunk_size()
+        self.METRICS.set('link_rtt_seconds', self.SUMMARY['rtt_seconds'])
+        self.METRICS.set('link_bytes_per_second', self.SUMMARY['link_bytes_per_second'])
+        self.METRICS.set('socket_buffer_bytes', self.SUMMARY['socket_buffer'])
+        self.METRICS.set('chunk_bytes', self.SUMMARY['chunk_size'])
+
+    def process_sync(self):
+        """
+        Process the messages from the server for a sync, sending each file requested until the server reports the
+        sync is done
+        """
+        while True:
+            # Heartbeats are not sent during a sync as the server is busy with this client
+            message_to_process = self.wait_for_message(['filerequest', 'sync'], heartbeat=False)
+            # Load in the message type which is the first string in the message and defines what the
+            # purpose of the message is, essentially a command
+            message_type = str(message_to_process).split(':')[0]
+            # Load in the message data which is to be used by the command
+            message_data = str(message_to_process).split(':')[1]
+
+            if message_type == 'filerequest':
+                # A file request message has been received so process it
+                self.process_file_request_message(message_data)
+            elif message_type == 'sync':
+                # Sync done message received so break out of the loop
+                break
+
+    def wait_for_message(self, message_types, timeout=None, heartbeat=True):
+        """
+        Wait for a message of one of the given types from the server. While a session is waiting a heartbeat is sent
+        every HEARTBEAT seconds and the session is treated as lost if nothing is heard from the server for three
+        intervals. Ready messages are noted whenever they arrive
+        :param message_types: List of the message types to wait for
+        :param timeout: The number of seconds to wait, waits until a message arrives when not given
+        :param heartbeat: Whether to send heartbeats while waiting
+        :return: The message received or None if the timeout passed first
+        """
+        heartbeat = heartbeat and self.SESSION
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # Work through any messages already received
+            while self.CONNECTION.PENDING != []:
+                message_to_process = self.CONNECTION.PENDING.pop(0)
+                CLIENT_LOG.debug('RCVD: %.200s', message_to_process)
+                message_type = str(message_to_process).split(':')[0]
+                if message_type == 'ready':
+                    self.READY = True
+                if message_type in message_types:
+                    return message_to_process
+
+            # Work out how long to wait for more data, sending a heartbeat if one is due
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                return None
+            wait = None if deadline is None else deadline - now
+            if heartbeat:
+                if now - self.CONNECTION.LAST_SEEN > self.HEARTBEAT * 3:
+                    raise ConnectionError('No heartbeat from server')
+                if now - self.LAST_HEARTBEAT >= self.HEARTBEAT:
+                    self.CONNECTION.send('heartbeat:' + str(now))
+                    self.LAST_HEARTBEAT = now
+                next_heartbeat = self.LAST_HEARTBEAT + self.HEARTBEAT - now
+                wait = next_heartbeat if wait is None else min(wait, next_heartbeat)
+
+            # Receive the data
+            readable, writable, errors = select.select([self.SOCKET], [], [], wait)
+            if readable:
+                messages = self.CONNECTION.receive()
+                if messages is None:
+                    raise ConnectionError('Connection closed by server')
+                self.CONNECTION.PENDING.extend(messages)
 
     def send_initial_file_list_to_server(self):
         """
@@ -176,16 +546,17 @@ class SyncClient:
         """
         # Get the file list
         self.CURRENT_FILE_LIST = self.read_local_storage()
-        print('SC: Local file list:')
-        for local_file in self.CURRENT_FILE_LIST:
-            print('SC: File ', local_file)
-        # Generate the message to send to the server
-        data = 'filelist:' + str(self.CURRENT_FILE_LIST)
-        message = pickle.dumps(data)
-        message = bytes(f"{len(message):<{self.HEADER}}", 'utf-8') + message
-        print('SC: SEND:', data)
+        # Send the top of the folder so the server can match its rules against each file's path within it, then the
+        # ignore rules so the server leaves the same files alone, both sent encoded as they may hold a :
+        self.CONNECTION.send('root:' + base64.b64encode(self.LOCAL_FOLDER.encode()).decode())
+        data = 'ignore:' + base64.b64encode('\n'.join(self.IGNORE.RULES).encode()).decode()
+        CLIENT_LOG.debug('SEND: ignore: %d rules', len(self.IGNORE.RULES))
+        self.CONNECTION.send(data)
+        # Generate the message to send to the server, the table is sent packed rather than as a printed list
+        data = 'filelist:' + self.CURRENT_FILE_LIST.encode()
+        CLIENT_LOG.info('SEND: filelist: %d files', len(self.CURRENT_FILE_LIST))
         # Send the message
-        self.SOCKET.send(message)
+        self.CONNECTION.send(data)
 
     def process_file_request_message(self, data):
         """
@@ -196,17 +567,47 @@ class SyncClient:
         file_data = ast.literal_eval(data)
         # Extract the file name from the file list object
         file_name = file_data[0][1]
-        print('SC: Sending file', file_name)
-        # Wait for a bit giving the server time to open the port
-        time.sleep(3)
-        # Send the file data to the server
-        FileClient().send_file(file_data[0][0], file_data[0][1])
+        FILE_LOG.debug('Sending file %s', file_name)
+        file_start = time.perf_counter()
+        # Send the file data to the server, or pass the file itself when using the local transport
+        try:
+            file_size = os.path.getsize(os.path.join(file_data[0][0], file_data[0][1]))
+            if self.UNIX_SOCKET:
+                FileClient().send_descriptor(file_data[0][0], file_data[0][1], self.UNIX_SOCKET + '.data')
+                sent = file_size
+            else:
+                # A server that knows about extents asks for them after the file
+                sent = FileClient().send_file(file_data[0][0], file_data[0][1], self.SERVER, self.DATA_PORT,
+                                              self.TUNER, 'extents' in file_data[1:])
+        except OSError as error:
+            # The server leaves the file out and asks for it again next sync, carry on with the rest of this one
+            CLIENT_LOG.warning('File not sent: %s: %s', file_name, error)
+            self.SUMMARY['files_failed'] += 1
+            return
+        self.METRICS.observe('file_transfer_seconds', time.perf_counter() - file_start)
+        self.METRICS.inc('files_transferred_total')
+        self.METRICS.inc('bytes_transferred_total', file_size)
+        self.METRICS.inc('sparse_bytes_total', max(0, file_size - sent))
+        self.SUMMARY['files_sent'] += 1
+        self.SUMMARY['bytes_sent'] += file_size
+        self.SUMMARY['sparse_bytes'] += max(0, file_size - sent)
 
 
 if __name__ == '__main__':
     """
     In a loop run the SyncClient class run(), upon completion do it again in 60s
+    With --session the connection is held open and run_session() only returns if the session is lost, in which case
+    the client reconnects after the same wait
+    A sync that fails as the server cannot be reached or the connection is lost is tried again after the same wait
+    The same SyncClient is used for every cycle so the md5s it has cached are kept between scans
     """
+    sync_client = SyncClient()
     while True:
-        SyncClient().run()
-        time.sleep(60)
+        try:
+            if sync_client.SESSION:
+                sync_client.run_session()
+            else:
+                sync_client.run()
+        except OSError as error:
+            CLIENT_LOG.warning('Sync failed: %s, retrying in %ds', error, sync_client.CYCLE)
+        time.sleep(sync_client.CYCLE)
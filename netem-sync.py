@@ -0,0 +1,329 @@
+import sys
+import time
+import queue
+import random
+import socket
+import struct
+import logging
+import argparse
+import threading
+from sync_common import LinkTuner, SocketConnector
+
+# Logger for the emulator, each connection is logged at DEBUG as a sync opens one for every file
+EMULATOR_LOG = logging.getLogger('NE')
+
+
+class EmulatedLink:
+    """
+    EmulatedLink class:
+    One direction of the emulated network, shared by every connection going that way so connections compete for the
+    bandwidth as they would on a real link. Each chunk of data is given the time it arrives at the far end: it waits
+    for the link to be free, takes size / bandwidth to send and then the one way latency plus a random jitter to
+    arrive. Chunks on a connection never arrive before the chunk ahead of them, so jitter does not reorder the stream.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, bandwidth=0.0, rng=None):
+        """
+        Initialise the link
+        :param latency: The one way latency in seconds
+        :param jitter: The most extra latency added at random to each chunk in seconds
+        :param bandwidth: The bandwidth in bytes per second, 0 for unlimited
+        :param rng: The random number generator used for the jitter
+        """
+        self.LATENCY = latency
+        self.JITTER = jitter
+        self.BANDWIDTH = bandwidth
+        self.RANDOM = rng or random.Random()
+        self.FREE_AT = 0.0
+        self.LOCK = threading.Lock()
+
+    def arrival(self, size, previous=0.0):
+        """
+        Schedule a chunk on the link
+        :param size: The size of the chunk in bytes
+        :param previous: The arrival time of the previous chunk on the same connection
+        :return: The time.monotonic() time the chunk arrives at the far end
+        """
+        with self.LOCK:
+            now = time.monotonic()
+            sent = max(now, self.FREE_AT) + (size / self.BANDWIDTH if self.BANDWIDTH else 0)
+            self.FREE_AT = sent
+            jitter = self.RANDOM.uniform(0, self.JITTER) if self.JITTER else 0
+        return max(sent + self.LATENCY + jitter, previous)
+
+
+class EmulatedConnection:
+    """
+    EmulatedConnection class:
+    A single connection through the emulator. Each direction has a thread reading from one side and queueing the data
+    with its arrival time, and a thread delivering the data to the other side once it arrives. The queue is bounded,
+    like the buffers along a real path, so a slow link pushes back on the sender through TCP. A connection chosen to be
+    dropped is reset once the chosen number of bytes have been forwarded.
+    """
+
+    CHUNK = 16384
+
+    def __init__(self, emulator, client, target, drop_at=None):
+        """
+        Initialise the connection
+        :param emulator: The NetworkEmulator the connection belongs to
+        :param client: The socket accepted from the client
+        :param target: The socket connected to the target
+        :param drop_at: The number of bytes forwarded after which the connection is reset, None to never drop it
+        """
+        self.EMULATOR = emulator
+        self.CLIENT = client
+        self.TARGET = target
+        self.DROP_AT = drop_at
+        self.FORWARDED = 0
+        self.CLOSED = threading.Event()
+        self.LOCK = threading.Lock()
+        self.FINISHED = 0
+
+    def start(self):
+        """
+        Start forwarding in both directions
+        """
+        for source, destination, link in [(self.CLIENT, self.TARGET, self.EMULATOR.UPSTREAM),
+                                          (self.TARGET, self.CLIENT, self.EMULATOR.DOWNSTREAM)]:
+            chunks = queue.Queue(max(1, self.EMULATOR.BUFFER // self.CHUNK))
+            threading.Thread(target=self.read, args=(source, link, chunks), daemon=True).start()
+            threading.Thread(target=self.deliver, args=(destination, chunks), daemon=True).start()
+
+    def read(self, source, link, chunks):
+        """
+        Read data from one side and queue it with the time it arrives at the other, an empty chunk marks the end of
+        the data
+        :param source: The socket to read from
+        :param link: The EmulatedLink the data travels over
+        :param chunks: The queue of (arrival, data) tuples
+        """
+        arrival = 0.0
+        while not self.CLOSED.is_set():
+            try:
+                data = source.recv(self.CHUNK)
+            except OSError:
+                data = b''
+            arrival = link.arrival(len(data), arrival)
+            while not self.CLOSED.is_set():
+                try:
+                    chunks.put((arrival, data), timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if not data:
+                break
+
+    def deliver(self, destination, chunks):
+        """
+        Send each chunk on to the other side once it has arrived, passing on the end of the data as a half close
+        :param destination: The socket to send to
+        :param chunks: The queue of (arrival, data) tuples
+        """
+        while not self.CLOSED.is_set():
+            try:
+                arrival, data = chunks.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            delay = arrival - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                if not data:
+                    destination.shutdown(socket.SHUT_WR)
+                    break
+                destination.sendall(data)
+            except OSError:
+                self.close()
+                return
+            if self.count(len(data)):
+                EMULATOR_LOG.info('Dropped connection after %d bytes', self.FORWARDED)
+                self.EMULATOR.DROPPED += 1
+                self.close(reset=True)
+                return
+        with self.LOCK:
+            self.FINISHED += 1
+            finished = self.FINISHED == 2
+        if finished:
+            self.close()
+
+    def count(self, length):
+        """
+        Count bytes forwarded in either direction
+        :param length: The number of bytes just forwarded
+        :return: Whether the connection should now be dropped
+        """
+        with self.LOCK:
+            self.FORWARDED += length
+            return self.DROP_AT is not None and self.FORWARDED >= self.DROP_AT
+
+    def close(self, reset=False):
+        """
+        Close both sides of the connection
+        :param reset: Reset the connections rather than closing them cleanly, as a dropped link would appear
+        """
+        if self.CLOSED.is_set():
+            return
+        self.CLOSED.set()
+        for s in (self.CLIENT, self.TARGET):
+            try:
+                if reset:
+                    s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                # Wake any thread blocked reading the socket before closing it
+                s.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+            s.close()
+        EMULATOR_LOG.debug('Connection closed: %d bytes forwarded', self.FORWARDED)
+
+
+class NetworkEmulator(SocketConnector):
+    """
+    NetworkEmulator class:
+    A proxy run between the client and server on one host, making loopback behave like a slower, less reliable network
+    so the cost of each round trip and the handling of lost connections can be measured without a real WAN link.
+    Each forwarded port listens where the client expects the server and forwards to the port the server is really
+    listening on, by default the client's 7101 and 7100 to a server started with --port 7201 --data-port 7200.
+    Connections see the configured latency, jitter and bandwidth, with each new connection also paying the round trip
+    of the TCP handshake, and can be dropped at random.
+    """
+
+    FORWARDS = ['7101:7201', '7100:7200']
+
+    def __init__(self, args=None):
+        """
+        Initialise the emulator from the command line
+        :param args: The command line arguments, sys.argv is used when not given
+        """
+        arguments = self.parse_arguments(args)
+        self.ARGUMENTS = arguments
+        self.RANDOM = random.Random(arguments.seed)
+        self.FORWARDS = [tuple(int(port) for port in forward.split(':', 1))
+                         for forward in arguments.forward or NetworkEmulator.FORWARDS]
+        self.TARGET_HOST = arguments.target_host
+        self.LATENCY = arguments.latency / 1000
+        self.DROP = arguments.drop
+        self.DROP_AFTER = arguments.drop_after
+        self.BUFFER = arguments.buffer
+        bandwidth = LinkTuner.parse_rate(arguments.bandwidth)
+        self.UPSTREAM = EmulatedLink(self.LATENCY, arguments.jitter / 1000, bandwidth, self.RANDOM)
+        self.DOWNSTREAM = EmulatedLink(self.LATENCY, arguments.jitter / 1000, bandwidth, self.RANDOM)
+        self.LISTENERS = []
+        self.CONNECTIONS = 0
+        self.DROPPED = 0
+
+    @staticmethod
+    def parse_arguments(args=None):
+        """
+        Read the ports to forward and the network to emulate from the command line
+        :param args: The command line arguments, sys.argv is used when not given
+        :return: The parsed arguments
+        """
+        parser = argparse.ArgumentParser(description='Emulate a slow or unreliable network between the client and '
+                                                     'server on one host')
+        parser.add_argument('--forward', action='append', default=[], metavar='LISTEN:TARGET',
+                            help='Listen on port LISTEN and forward connections to port TARGET, can be given more than '
+                                 'once (default: 7101:7201 and 7100:7200)')
+        parser.add_argument('--target-host', default='localhost', metavar='HOST',
+                            help='The host to forward connections to (default: localhost)')
+        parser.add_argument('--latency', type=float, default=0, metavar='MS',
+                            help='One way latency added in each direction in milliseconds (default: 0)')
+        parser.add_argument('--jitter', type=float, default=0, metavar='MS',
+                            help='Most extra latency added at random to each chunk of data in milliseconds, data is '
+                                 'never reordered (default: 0)')
+        parser.add_argument('--bandwidth', default='0', metavar='RATE',
+                            help='Bandwidth of each direction in bytes per second, shared by all connections, with an '
+                                 'optional K, M or G suffix (default: unlimited)')
+        parser.add_argument('--drop', type=float, default=0, metavar='FRACTION',
+                            help='The fraction of connections to drop (default: 0)')
+        parser.add_argument('--drop-after', type=int, default=65536, metavar='BYTES',
+                            help='Dropped connections are reset at a random point within their first BYTES bytes '
+                                 '(default: 65536)')
+        parser.add_argument('--buffer', type=int, default=4 * 1024 * 1024, metavar='BYTES',
+                            help='Bytes held in flight in each direction of a connection before the sender is pushed '
+                                 'back on (default: 4194304)')
+        parser.add_argument('--seed', type=int, default=None, help='Seed for the jitter and drops')
+        parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO',
+                            help='The level to log at (default: INFO)')
+        return parser.parse_args(args)
+
+    def start(self):
+        """
+        Listen on each forwarded port, connections are accepted on background threads so the emulator can be started
+        from tests and benchmarks as well as run on its own
+        """
+        for listen_port, target_port in self.FORWARDS:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(('localhost', listen_port))
+            listener.listen(10)
+            self.LISTENERS.append(listener)
+            EMULATOR_LOG.info('Forwarding: %d to %s:%d', listen_port, self.TARGET_HOST, target_port)
+            threading.Thread(target=self.accept, args=(listener, target_port), daemon=True).start()
+
+    def stop(self):
+        """
+        Stop listening, connections already open are left to finish
+        """
+        for listener in self.LISTENERS:
+            try:
+                listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            listener.close()
+        self.LISTENERS = []
+
+    def accept(self, listener, target_port):
+        """
+        Accept connections on a forwarded port until the emulator is stopped
+        :param listener: The listening socket
+        :param target_port: The port to forward connections to
+        """
+        while True:
+            try:
+                client, address = listener.accept()
+            except OSError:
+                return
+            self.CONNECTIONS += 1
+            threading.Thread(target=self.forward, args=(client, target_port), daemon=True).start()
+
+    def forward(self, client, target_port):
+        """
+        Connect a new connection through to the target and start forwarding its data. The connection to the target is
+        made after the round trip a real TCP handshake would take, and retried for a while in case the target has not
+        started listening yet
+        :param client: The socket accepted from the client
+        :param target_port: The port to connect to
+        """
+        time.sleep(2 * self.LATENCY)
+        try:
+            target = self.connect(socket.AF_INET, (self.TARGET_HOST, target_port))
+        except ConnectionRefusedError:
+            EMULATOR_LOG.warning('Nothing listening on port %d', target_port)
+            client.close()
+            return
+        drop_at = None
+        if self.DROP and self.RANDOM.random() < self.DROP:
+            drop_at = self.RANDOM.randint(1, max(1, self.DROP_AFTER))
+        EMULATOR_LOG.debug('Connection forwarded to port %d', target_port)
+        EmulatedConnection(self, client, target, drop_at).start()
+
+    def run(self):
+        """
+        Run the emulator until interrupted
+        """
+        logging.basicConfig(stream=sys.stdout, level=getattr(logging, self.ARGUMENTS.log_level),
+                            format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+        self.start()
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            EMULATOR_LOG.info('Stopped: %d connections %d dropped', self.CONNECTIONS, self.DROPPED)
+
+
+if __name__ == '__main__':
+    NetworkEmulator().run()
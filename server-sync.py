@@ -1,10 +1,659 @@
 import socket
 import sys
+import ast
 import os
 import hashlib
 import pickle
 import shutil
-import ast
+import fnmatch
+import argparse
+import json
+import logging
+import struct
+import errno
+import base64
+import http.server
+import time
+import queue
+import selectors
+import threading
+import ctypes
+import ctypes.util
+import multiprocessing
+import zlib
+from sync_common import FileEventFilter, FileTable, SyncIgnore, StatCache, FileScanner, LinkTuner, SyncMetrics, \
+    SyncProfiler, SyncConnection, FileExtents, SocketConnector
+
+# Loggers for each part of the server, per-file events go to FILE_LOG, FILE_SERVER_LOG and WRITER_LOG at DEBUG so they
+# cost next to nothing at the default level
+SERVER_LOG = logging.getLogger('SS')
+FILE_LOG = logging.getLogger('SS.files')
+FILE_SERVER_LOG = logging.getLogger('FS')
+WRITER_LOG = logging.getLogger('FW')
+PROFILE_LOG = logging.getLogger('SS.profile')
+
+
+class FileCommitter:
+    """
+    FileCommitter class:
+    Files are received into temporary names alongside their final location and handed to the committer once fully
+    written. The committer holds them until a batch builds up, then makes the whole batch durable with a single flush
+    of the file system and renames each file into place. A crash therefore leaves either the old file or the complete
+    new one, never a partly written file under the real name. A batch is also committed once its first file has waited
+    COMMIT_SECONDS, checked by the writer after everything it does and whenever it has been idle that long, so a slow
+    transfer does not leave received files uncommitted for long.
+    The md5 of each file verified as it was received is put into the StatCache once the file is in place, so the rescan
+    that follows the sync does not read it back.
+    """
+
+    TEMP_SUFFIX = '.syncpart'
+    COMMIT_FILES = 64
+    COMMIT_BYTES = 64 * 1024 * 1024
+    COMMIT_SECONDS = 5
+
+    def __init__(self, journal=None, cache=None):
+        """
+        Initialise the committer with an empty batch
+        :param journal: The SyncJournal told of each batch once committed, if any
+        :param cache: The StatCache given the md5 of each file committed, if any
+        """
+        self.JOURNAL = journal
+        self.CACHE = cache
+        self.PENDING = []
+        self.PENDING_BYTES = 0
+        self.PENDING_SINCE = 0
+        self.SYNCFS = self.load_syncfs()
+
+    @staticmethod
+    def load_syncfs():
+        """
+        Find syncfs() in the C library, it flushes a whole file system in one call so a batch costs one sync rather
+        than one per file
+        :return: The syncfs function or None where it is not available
+        """
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            return libc.syncfs
+        except (OSError, AttributeError, TypeError):
+            return None
+
+    @classmethod
+    def temp_path(cls, folder, file):
+        """
+        :param folder: The location for the file being written
+        :param file: The name of the file being written
+        :return: The temporary path the file is written to before being committed
+        """
+        return os.path.join(folder, '.' + file + cls.TEMP_SUFFIX)
+
+    @classmethod
+    def remove_stale(cls, folder):
+        """
+        Remove any temporary files left behind by a sync that was interrupted before it could commit them
+        :param folder: The folder to clean up
+        """
+        for root, dirs, files in os.walk(folder):
+            for file in files:
+                if file.endswith(cls.TEMP_SUFFIX):
+                    WRITER_LOG.info('Removing stale file: %s', os.path.join(root, file))
+                    os.remove(os.path.join(root, file))
+
+    def add(self, temp_path, final_path, size, digest=None):
+        """
+        Add a fully written file to the batch, committing the batch once it is large enough
+        :param temp_path: The temporary path the file was written to
+        :param final_path: The path the file should be renamed to
+        :param size: The number of bytes written
+        :param digest: The raw md5 of the data written, None if it is not known
+        """
+        if self.PENDING == []:
+            self.PENDING_SINCE = time.monotonic()
+        self.PENDING.append([temp_path, final_path, digest])
+        self.PENDING_BYTES += size
+        if len(self.PENDING) >= self.COMMIT_FILES or self.PENDING_BYTES >= self.COMMIT_BYTES:
+            self.commit()
+
+    def expire(self):
+        """
+        Commit the batch if its first file has waited COMMIT_SECONDS
+        :return: The seconds until the batch waiting is due to be committed, None if there is no batch waiting
+        """
+        if self.PENDING == []:
+            return None
+        waited = time.monotonic() - self.PENDING_SINCE
+        if waited >= self.COMMIT_SECONDS:
+            self.commit()
+            return None
+        return self.COMMIT_SECONDS - waited
+
+    def commit(self):
+        """
+        Make every file in the batch durable, rename them into place and then sync the directories holding them so
+        the renames are durable as well
+        """
+        if self.PENDING == []:
+            return
+        self.sync_files([file[0] for file in self.PENDING])
+        directories = set()
+        for temp_path, final_path, digest in self.PENDING:
+            os.replace(temp_path, final_path)
+            directories.add(os.path.dirname(final_path))
+            if self.CACHE is not None and digest is not None:
+                self.CACHE.remember(final_path, os.stat(final_path), digest)
+        self.sync_files(directories)
+        if self.JOURNAL is not None:
+            self.JOURNAL.committed([file[1] for file in self.PENDING])
+        WRITER_LOG.debug('Committed %d files', len(self.PENDING))
+        self.PENDING = []
+        self.PENDING_BYTES = 0
+
+    def sync_files(self, paths):
+        """
+        Flush the given files or directories to disk. Where syncfs() is available one call covers every path on the
+        same file system, otherwise each path is fsynced in turn
+        :param paths: The paths to flush
+        """
+        synced_devices = set()
+        for path in paths:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                if self.SYNCFS is not None and len(paths) > 1:
+                    device = os.fstat(fd).st_dev
+                    if device not in synced_devices and self.SYNCFS(fd) == 0:
+                        synced_devices.add(device)
+                    if device in synced_devices:
+                        continue
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+
+class SyncJournal:
+    """
+    SyncJournal class:
+    Records the plan of the sync in progress, the files to be received and their md5s, followed by each file once it
+    has been committed along with its stat. A server restarted partway through a sync reads the journal back and puts
+    every committed file whose stat is unchanged into its StatCache, so the rescan trusts the md5 the file was
+    requested with rather than reading the file back and the sync carries on with only the files not yet received.
+    Each line of the journal is a JSON record, a partly written last line is ignored.
+    """
+
+    def __init__(self, path):
+        """
+        Initialise the journal
+        :param path: The journal file
+        """
+        self.PATH = path
+        self.PLAN = {}
+        self.FILE = None
+
+    def recover(self, cache):
+        """
+        Read back the journal of a sync that was interrupted, caching the md5 of every file it committed
+        :param cache: The StatCache to add the committed files to
+        :return: The number of files planned and the number committed, or None if no sync was interrupted
+        """
+        if not os.path.exists(self.PATH):
+            return None
+        planned = committed = 0
+        with open(self.PATH) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if 'plan' in record:
+                    planned = record['plan']
+                    continue
+                try:
+                    stat = os.stat(record['file'])
+                except OSError:
+                    continue
+                if StatCache.key(stat) == (record['size'], record['mtime_ns'], record['ino']):
+                    cache.remember(record['file'], stat, bytes.fromhex(record['md5']))
+                    committed += 1
+        return planned, committed
+
+    def start(self, folder, requests):
+        """
+        Begin the journal of a sync with its plan
+        :param folder: The local folder the files are received into
+        :param requests: The entries of the files to be requested, [root, name, md5, size]
+        """
+        self.PLAN = {os.path.join(folder, request[1]): request[2] for request in requests}
+        self.FILE = open(self.PATH, 'w')
+        self.FILE.write(json.dumps({'plan': len(requests), 'bytes': sum(request[3] for request in requests),
+                                    'time': time.time()}) + '\n')
+        self.FILE.flush()
+
+    def committed(self, paths):
+        """
+        Record the files of a batch just committed, called by the FileCommitter once the batch is durable
+        :param paths: The final paths of the files committed
+        """
+        if self.FILE is None:
+            return
+        for path in paths:
+            digest = self.PLAN.get(path)
+            if digest is None:
+                continue
+            stat = os.stat(path)
+            self.FILE.write(json.dumps({'file': path, 'md5': digest, 'size': stat.st_size,
+                                        'mtime_ns': stat.st_mtime_ns, 'ino': stat.st_ino}) + '\n')
+        self.FILE.flush()
+
+    def close(self):
+        """
+        End the journal of a sync that did not complete, keeping it so a restart picks up from the files committed
+        """
+        if self.FILE is not None:
+            self.FILE.close()
+            self.FILE = None
+        self.PLAN = {}
+
+    def finish(self):
+        """
+        End the journal of a sync that completed, removing it
+        """
+        self.close()
+        if os.path.exists(self.PATH):
+            os.remove(self.PATH)
+
+
+class FileWriter:
+    """
+    FileWriter class:
+    The disk side of the receive pipeline. The network side fills buffers taken from the writer's pool and queues them,
+    a writer thread drains the queue to disk and returns the buffers to the pool. The queue is bounded so a slow disk
+    holds back the network rather than buffering a whole file in memory, while a slow network never waits on a write.
+    Each file is hashed as it is written and one that does not match the md5 it was requested with is removed rather
+    than committed.
+    """
+
+    QUEUE_SIZE = 64
+    BUFFER_SIZE = 256 * 1024
+    ZEROS = bytes(BUFFER_SIZE)
+
+    def __init__(self, committer, listener=None):
+        """
+        Initialise the writer and start the writer thread
+        :param committer: The FileCommitter that finished files are handed to
+        :param listener: RelayFiles told as each file is opened, written to and closed, if any
+        """
+        self.COMMITTER = committer
+        self.LISTENER = listener
+        self.QUEUE = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self.BUFFERS = queue.Queue()
+        self.ERROR = None
+        self.REJECTED = []
+        self.THREAD = threading.Thread(target=self.run, daemon=True)
+        self.THREAD.start()
+
+    def get_buffer(self):
+        """
+        :return: A buffer from the pool for the network side to fill, a new one is created if the pool is empty
+        """
+        try:
+            return self.BUFFERS.get_nowait()
+        except queue.Empty:
+            return bytearray(self.BUFFER_SIZE)
+
+    def release_buffer(self, buffer):
+        """
+        Return an unused buffer to the pool
+        :param buffer: The buffer to return
+        """
+        self.BUFFERS.put(buffer)
+
+    def open(self, folder, file, digest=None):
+        """
+        Queue the start of a new file
+        :param folder: The location for the file being written
+        :param file: The name of the file being written
+        :param digest: The raw md5 the file was requested with, the file is only committed if it matches
+        """
+        self.QUEUE.put(['open', folder, file, digest])
+
+    def write(self, buffer, length):
+        """
+        Queue a filled buffer to be written to the current file
+        :param buffer: The buffer holding the data
+        :param length: The number of bytes of the buffer holding data
+        """
+        self.QUEUE.put(['write', buffer, length])
+
+    def seek(self, offset):
+        """
+        Queue a move to where the next data is written in the current file, skipping over a hole
+        :param offset: The offset in the file
+        """
+        self.QUEUE.put(['seek', offset])
+
+    def truncate(self, size):
+        """
+        Queue setting the size of the current file, leaving a hole at its end when it is larger than the data written
+        :param size: The size of the file
+        """
+        self.QUEUE.put(['truncate', size])
+
+    def copy(self, fd):
+        """
+        Queue the whole of an open file to be copied into the current file, used when a client on the same host passes
+        its file descriptor rather than sending the data. The descriptor is closed once copied
+        :param fd: The file descriptor to copy from
+        """
+        self.QUEUE.put(['copy', fd])
+
+    def close(self, complete=True):
+        """
+        Queue the end of the current file
+        :param complete: Whether the whole file was received, a file that was not is removed rather than committed
+        """
+        self.QUEUE.put(['close', complete])
+
+    def flush(self):
+        """
+        Wait for everything queued so far to be written and commit any files still waiting in the committer
+        :return: List of the paths of the files rejected since the last flush as they did not match their md5
+        """
+        done = threading.Event()
+        self.QUEUE.put(['flush', done])
+        done.wait()
+        if self.ERROR is not None:
+            error, self.ERROR = self.ERROR, None
+            raise error
+        rejected, self.REJECTED = self.REJECTED, []
+        return rejected
+
+    def hash_data(self, file_md5, hashed, position, data=b''):
+        """
+        Add data written at a position in the file to its md5, any gap since the data hashed so far being a hole that
+        reads as zeros. The md5 is dropped if data is written out of order, the file is then hashed by the next scan
+        :param file_md5: The md5 of the file so far, None once dropped
+        :param hashed: The number of bytes hashed so far
+        :param position: The position the data is written at
+        :param data: The data written
+        :return: The md5 and the number of bytes hashed
+        """
+        if file_md5 is None or position < hashed:
+            return None, hashed
+        zeros = memoryview(self.ZEROS)
+        while hashed < position:
+            length = min(position - hashed, len(zeros))
+            file_md5.update(zeros[:length])
+            hashed += length
+        file_md5.update(data)
+        return file_md5, hashed + len(data)
+
+    def hash_descriptor(self, file_md5, hashed, fd, size):
+        """
+        Add the contents of a file written other than through the writer to its md5, reading only its runs of data
+        :param file_md5: The md5 of the file so far, None once dropped
+        :param hashed: The number of bytes hashed so far
+        :param fd: The file descriptor of the file
+        :param size: The size of the file
+        :return: The md5 and the number of bytes hashed
+        """
+        buffer = self.get_buffer()
+        try:
+            for start, length in FileExtents.find(fd, size):
+                position, end = start, start + length
+                while position < end and file_md5 is not None:
+                    length = os.preadv(fd, [memoryview(buffer)[:end - position]], position)
+                    if length == 0:
+                        break
+                    file_md5, hashed = self.hash_data(file_md5, hashed, position, memoryview(buffer)[:length])
+                    position += length
+        finally:
+            self.release_buffer(buffer)
+        return self.hash_data(file_md5, hashed, size)
+
+    def copy_descriptor(self, source, destination):
+        """
+        Copy the contents of one file descriptor to another using copy_file_range(), so the data is copied inside the
+        kernel (or shared by the file system) without passing through the process. Falls back to reading and writing
+        through a buffer where copy_file_range() is not available or not supported between the two files
+        Only the runs of data are copied and the file is then extended to its full size, so holes stay holes
+        :param source: The file descriptor to copy from
+        :param destination: The file descriptor to copy to
+        :return: The size of the file copied
+        """
+        size = os.fstat(source).st_size
+        buffer = None
+        for start, length in FileExtents.find(source, size):
+            position, end = start, start + length
+            while position < end:
+                copied = 0
+                if buffer is None:
+                    try:
+                        copied = os.copy_file_range(source, destination, end - position, position, position)
+                    except (AttributeError, OSError):
+                        buffer = self.get_buffer()
+                if buffer is not None:
+                    copied = os.preadv(source, [memoryview(buffer)[:end - position]], position)
+                    os.pwrite(destination, memoryview(buffer)[:copied], position)
+                if copied == 0:
+                    break
+                position += copied
+        if buffer is not None:
+            self.release_buffer(buffer)
+        os.ftruncate(destination, size)
+        return size
+
+    def run(self):
+        """
+        The writer thread, drains the queue writing each file to its temporary name and handing it to the committer
+        once closed. The queue is only waited on until the committer's batch is due, so a batch is committed on time
+        even when no more data arrives
+        """
+        f = None
+        temp_path = final_path = ''
+        size = hashed = 0
+        file_md5 = expected = None
+        timeout = None
+        while True:
+            try:
+                item = self.QUEUE.get(timeout=timeout)
+            except queue.Empty:
+                # Nothing has arrived before the batch was due, so there is only the batch to commit
+                item = ('expire',)
+            try:
+                if item[0] == 'open':
+                    final_path = os.path.join(item[1], item[2])
+                    temp_path = FileCommitter.temp_path(item[1], item[2])
+                    # Opened for reading as well so a copied file can be read back to hash it
+                    f = open(temp_path, 'w+b')
+                    size = hashed = 0
+                    file_md5 = hashlib.md5()
+                    expected = item[3]
+                    if self.LISTENER is not None:
+                        self.LISTENER.opened(final_path, temp_path)
+                elif item[0] == 'write':
+                    if f is not None:
+                        data = memoryview(item[1])[:item[2]]
+                        file_md5, hashed = self.hash_data(file_md5, hashed, f.tell(), data)
+                        f.write(data)
+                        size = max(size, f.tell())
+                        # The data is followed from the file by the relay, so it cannot wait in the file's buffer
+                        if self.LISTENER is not None:
+                            f.flush()
+                            self.LISTENER.wrote(final_path, size)
+                    self.release_buffer(item[1])
+                elif item[0] == 'seek':
+                    if f is not None:
+                        f.seek(item[1])
+                elif item[0] == 'truncate':
+                    if f is not None:
+                        f.truncate(item[1])
+                        file_md5, hashed = self.hash_data(file_md5, hashed, item[1])
+                        size = item[1]
+                        if self.LISTENER is not None:
+                            f.flush()
+                            self.LISTENER.wrote(final_path, size)
+                elif item[0] == 'copy':
+                    try:
+                        if f is not None:
+                            size += self.copy_descriptor(item[1], f.fileno())
+                            # The copy is made inside the kernel, so what was written is read back to hash it
+                            file_md5, hashed = self.hash_descriptor(file_md5, hashed, f.fileno(), size)
+                            if self.LISTENER is not None:
+                                self.LISTENER.wrote(final_path, size)
+                    finally:
+                        os.close(item[1])
+                elif item[0] == 'close':
+                    if f is not None:
+                        digest = file_md5.digest() if file_md5 is not None and hashed == size else None
+                        if item[1] and expected is not None and digest is None:
+                            # Written out of order so the md5 was dropped, the file is read back to check it
+                            f.flush()
+                            file_md5, hashed = self.hash_descriptor(hashlib.md5(), 0, f.fileno(), size)
+                            digest = file_md5.digest()
+                        f.close()
+                        f = None
+                        if self.LISTENER is not None:
+                            self.LISTENER.closed(final_path, size)
+                        if not item[1]:
+                            # Cut off part way, the file is left out and requested by the next sync
+                            WRITER_LOG.warning('Left out %s as it was not received in full', final_path)
+                            os.remove(temp_path)
+                        elif expected is not None and digest is not None and digest != expected:
+                            # Corrupted or changed on the way, the file is left out and requested by the next sync
+                            WRITER_LOG.error('Rejected %s: received md5 %s, requested %s', final_path, digest.hex(),
+                                             expected.hex())
+                            os.remove(temp_path)
+                            self.REJECTED.append(final_path)
+                        else:
+                            self.COMMITTER.add(temp_path, final_path, size, digest)
+                elif item[0] == 'flush':
+                    self.COMMITTER.commit()
+                    item[1].set()
+                timeout = self.COMMITTER.expire()
+            except OSError as error:
+                # Keep draining the queue so the network side is never left blocked, the error is raised on flush
+                WRITER_LOG.error('Write failed: %s', error)
+                self.ERROR = error
+                timeout = None
+                if f is not None:
+                    f.close()
+                    f = None
+                if item[0] == 'flush':
+                    item[1].set()
+                elif self.LISTENER is not None:
+                    self.LISTENER.closed(final_path, size)
+
+
+class LocalOperations:
+    """
+    LocalOperations class:
+    Runs the server's local copies and deletes on a bounded pool of worker threads, so a large reorganisation is done
+    in parallel and the transfers can start while it is still running. Operations on the same file keep the order the
+    sync needs: a delete waits for every copy reading the file it removes, and the transfer of a file waits for the
+    delete of its old copy so the new file is never removed. The queue is bounded so a huge sync does not queue every
+    operation in memory at once.
+    """
+
+    WORKERS = 4
+    QUEUE_SIZE = 256
+
+    def __init__(self, workers=WORKERS):
+        """
+        Initialise the pool and start the worker threads
+        :param workers: The number of worker threads
+        """
+        self.QUEUE = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self.CONDITION = threading.Condition()
+        # The number of copies waiting or running reading and writing each path, and the paths waiting to be deleted
+        self.READING = {}
+        self.WRITING = {}
+        self.DELETING = set()
+        self.OUTSTANDING = 0
+        self.FINISHED = 0
+        self.ERROR = None
+        for i in range(max(1, workers)):
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def copy(self, source, destination):
+        """
+        Queue a copy of a file, copies must be queued before any deletes they need to run ahead of
+        :param source: The path of the file to copy
+        :param destination: The path to copy the file to
+        """
+        source = os.path.normpath(source)
+        destination = os.path.normpath(destination)
+        with self.CONDITION:
+            self.READING[source] = self.READING.get(source, 0) + 1
+            self.WRITING[destination] = self.WRITING.get(destination, 0) + 1
+            self.OUTSTANDING += 1
+        self.QUEUE.put(['copy', source, destination])
+
+    def delete(self, path):
+        """
+        Queue the delete of a file, it runs once every copy queued from the file has finished
+        :param path: The path of the file to delete
+        """
+        path = os.path.normpath(path)
+        with self.CONDITION:
+            self.DELETING.add(path)
+            self.OUTSTANDING += 1
+        self.QUEUE.put(['delete', path])
+
+    def wait_for(self, path):
+        """
+        Wait for any queued copy to or delete of a path, called before a file is requested so the received file is not
+        deleted, and before a relay sends a file downstream so it sends the copied file
+        :param path: The path of the file about to be received or sent
+        """
+        path = os.path.normpath(path)
+        with self.CONDITION:
+            self.CONDITION.wait_for(lambda: path not in self.DELETING and path not in self.WRITING)
+
+    def join(self):
+        """
+        Wait for every queued operation to finish, raising the first error any of them hit. FINISHED then holds the
+        time.perf_counter() time the last operation finished
+        """
+        with self.CONDITION:
+            self.CONDITION.wait_for(lambda: self.OUTSTANDING == 0)
+            error, self.ERROR = self.ERROR, None
+        if error is not None:
+            raise error
+
+    def run(self):
+        """
+        A worker thread, takes operations from the queue and runs them. Copies are queued ahead of deletes, so every
+        copy a delete waits for has already been taken by a worker and the wait always ends
+        """
+        while True:
+            item = self.QUEUE.get()
+            failure = None
+            try:
+                if item[0] == 'copy':
+                    FILE_LOG.debug('Copying file: %s to %s', item[1], item[2])
+                    shutil.copy(item[1], item[2])
+                else:
+                    with self.CONDITION:
+                        self.CONDITION.wait_for(lambda: self.READING.get(item[1], 0) == 0)
+                    FILE_LOG.debug('Deleting file: %s', item[1])
+                    os.remove(item[1])
+            except OSError as error:
+                # The error is raised on join so the sync still waits for the other operations
+                SERVER_LOG.error('Local %s failed: %s', item[0], error)
+                failure = error
+            finally:
+                with self.CONDITION:
+                    self.ERROR = self.ERROR or failure
+                    if item[0] == 'copy':
+                        self.READING[item[1]] -= 1
+                        if self.READING[item[1]] == 0:
+                            del self.READING[item[1]]
+                        self.WRITING[item[2]] -= 1
+                        if self.WRITING[item[2]] == 0:
+                            del self.WRITING[item[2]]
+                    else:
+                        self.DELETING.discard(item[1])
+                    self.OUTSTANDING -= 1
+                    self.FINISHED = time.perf_counter()
+                    self.CONDITION.notify_all()
 
 
 class FileServer:
@@ -13,38 +662,861 @@ class FileServer:
     A small self contained class that creates a independent socket purely for receiving a file sent from a client
     connection.
     Once the file has been received the socket is closed off.
-    Uses a hardcoded server and port.
+    Listens on localhost, port 7100 unless another is given.
+    A file asked for as extents arrives as records holding the offset and length of each run of data followed by the
+    data, and ends with a record of no data holding the size of the file. The gaps between the runs are left as holes.
     """
 
-    def receive_file(self, file, folder):
+    EXTENT = struct.Struct('!QQ')
+    ACCEPT_TIMEOUT = 30
+    DATA_TIMEOUT = 60
+    # Room for a message passed with descriptors holding a path of up to PATH_MAX bytes, pickled, and its md5
+    PATH_MAX = 4096
+    MESSAGE_SIZE = 4 * PATH_MAX + 1024
+
+    def listen(self, port=7100, buffer_size=0):
         """
-        For a given file and location, a connection is opened, the file is opened in readiness for incoming data,
-        upon data received it is written to the file. Once all the data is received the file in closed and connection
-        closed down from the client.
-        :param file: The name of the file to be written to
-        :param folder: The location for the file being written
+        Open a socket listening on the data port. A sync keeps one open for all its files, so a client connecting for
+        a file is queued by the kernel rather than refused while the server is still sending the filerequest
+        :param port: The port to listen for the file data on
+        :param buffer_size: The receive buffer to set, 0 to leave it to the kernel
+        :return: The listening socket
         """
-        print('FS: Opening sever: localhost port: 7100')
+        FILE_SERVER_LOG.debug('Opening sever: localhost port: %d', port)
         # Configure the socket
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.bind(('localhost', 7100))
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if buffer_size:
+            # Set before listening so the connection is accepted with a window scale large enough for the buffer
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+        s.bind(('localhost', port))
         s.listen(5)
-        print('FS: Waiting for connection')
+        # Give up on a file whose client never connects, rather than waiting on a client that has gone away
+        s.settimeout(self.ACCEPT_TIMEOUT)
+        return s
+
+    def accept_file(self, port=7100, buffer_size=0, listener=None):
+        """
+        Listen on the data port until the client connects to send a file
+        :param port: The port to listen for the file data on
+        :param buffer_size: The receive buffer to set, 0 to leave it to the kernel
+        :param listener: A socket already listening on the data port, one is opened for the file when not given
+        :return: The connected client socket
+        """
+        s = listener or self.listen(port, buffer_size)
+        FILE_SERVER_LOG.debug('Waiting for connection')
         client, address = s.accept()
-        # Open the give file in preparation for data
-        print('FS: Connect to: ', address)
-        with open(os.path.join(folder, file), 'wb') as f:
-            while True:
-                data = client.recv(1024)
-                if not data:
-                    break
-                f.write(data)
-        # Close the file once data has been received
-        f.close()
-        print('FS: File saved:', file)
+        if listener is None:
+            s.close()
+        FILE_SERVER_LOG.debug('Connect to: %s', address)
+        return client
+
+    def receive_file(self, file, folder, writer, limiter=None, port=7100, buffer_size=0, extents=False, digest=None,
+                     listener=None):
+        """
+        For a given file and location, a connection is opened and the incoming data is read into buffers which are
+        queued on the writer to be saved. The file is written under a temporary name and committed by the writer, so
+        the network read never waits for the disk. Once all the data is received the connection is closed down from
+        the client.
+        :param file: The name of the file to be written to
+        :param folder: The location for the file being written
+        :param writer: The FileWriter that saves the data
+        :param limiter: RateLimiter holding the transfer to a bandwidth limit, if any
+        :param port: The port to listen for the file data on
+        :param buffer_size: The receive buffer to set, 0 to leave it to the kernel
+        :param extents: Whether the file was asked for as extent records
+        :param digest: The raw md5 the file was requested with, checked as the file is written
+        :param listener: A socket already listening on the data port, one is opened for the file when not given
+        """
+        self.receive_data(self.accept_file(port, buffer_size, listener), file, folder, writer, limiter, extents, digest)
+
+    def receive_data(self, client, file, folder, writer, limiter=None, extents=False, digest=None):
+        """
+        Read a file from a connected client socket into the writer, closing the socket once the client has sent it all.
+        A connection lost part way, or one the client stops sending on for DATA_TIMEOUT, raises OSError once the writer
+        has been told to remove what was received
+        :param client: The connected client socket
+        :param file: The name of the file to be written to
+        :param folder: The location for the file being written
+        :param writer: The FileWriter that saves the data
+        :param limiter: RateLimiter holding the transfer to a bandwidth limit, if any
+        :param extents: Whether the file was asked for as extent records
+        :param digest: The raw md5 the file was requested with, checked as the file is written
+        """
+        # A client that stalls without closing the connection would otherwise hold up the sync for good
+        client.settimeout(self.DATA_TIMEOUT)
+        # Start the file on the writer in preparation for data
+        writer.open(folder, file, digest)
+        try:
+            if extents:
+                self.receive_extents(client, file, writer, limiter)
+            else:
+                while True:
+                    buffer = writer.get_buffer()
+                    length = client.recv_into(buffer)
+                    if not length:
+                        writer.release_buffer(buffer)
+                        break
+                    writer.write(buffer, length)
+                    # Hold back the read while the file's class is over its bandwidth limit, so TCP slows the client
+                    if limiter is not None:
+                        limiter.consume(length)
+        except OSError:
+            # The connection was lost or timed out part way, so the writer removes what was received rather than
+            # committing it
+            writer.close(False)
+            client.close()
+            raise
+        # Close the file once data has been received, the writer commits it
+        writer.close()
+        FILE_SERVER_LOG.debug('File received: %s', file)
         # Close the client connection
         client.close()
-        print('FS: Closed')
+        FILE_SERVER_LOG.debug('Closed')
+
+    def receive_extents(self, client, file, writer, limiter=None):
+        """
+        Read the extent records of a file into the writer, moving the writer past each hole, up to the record ending
+        the file
+        :param client: The connected client socket
+        :param file: The name of the file being written
+        :param writer: The FileWriter that saves the data
+        :param limiter: RateLimiter holding the transfer to a bandwidth limit, if any
+        """
+        header = bytearray(self.EXTENT.size)
+        while True:
+            # Read the whole header of the next record
+            received = 0
+            while received < len(header):
+                length = client.recv_into(memoryview(header)[received:])
+                if not length:
+                    raise ConnectionError('File data ended early: ' + file)
+                received += length
+            offset, remaining = self.EXTENT.unpack(header)
+            if remaining == 0:
+                # The end of the file, which may finish with a hole
+                writer.truncate(offset)
+                return
+            writer.seek(offset)
+            while remaining:
+                buffer = writer.get_buffer()
+                length = client.recv_into(buffer, min(remaining, len(buffer)))
+                if not length:
+                    writer.release_buffer(buffer)
+                    raise ConnectionError('File data ended early: ' + file)
+                writer.write(buffer, length)
+                remaining -= length
+                if limiter is not None:
+                    limiter.consume(length)
+
+    def listen_descriptor(self, path):
+        """
+        The local transport version of listen(), opens a unix domain socket listening at the given path
+        :param path: The path of the unix domain socket to receive descriptors on
+        :return: The listening socket
+        """
+        FILE_SERVER_LOG.debug('Opening sever: %s', path)
+        # Configure the socket, clearing any socket file left from the last file
+        if os.path.exists(path):
+            os.remove(path)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(path)
+        s.listen(5)
+        s.settimeout(self.ACCEPT_TIMEOUT)
+        return s
+
+    def accept_descriptor(self, path, listener=None):
+        """
+        Listen on the unix domain socket at the given path until the client connects and passes its file descriptor
+        :param path: The path of the unix domain socket to receive the descriptor on
+        :param listener: A socket already listening at the path, one is opened for the file when not given
+        :return: List of the file descriptors received
+        """
+        s = listener or self.listen_descriptor(path)
+        FILE_SERVER_LOG.debug('Waiting for connection')
+        client, address = s.accept()
+        if listener is None:
+            s.close()
+        client.settimeout(self.DATA_TIMEOUT)
+        message, fds, flags, address = socket.recv_fds(client, self.MESSAGE_SIZE, 1)
+        # Close the client connection, the descriptor stays open
+        client.close()
+        FILE_SERVER_LOG.debug('Closed')
+        return fds
+
+    def receive_descriptor(self, file, folder, writer, path, digest=None, listener=None):
+        """
+        The local transport version of receive_file(). A unix domain socket is opened at the given path and rather than
+        the file data the client passes the open file descriptor of its file (SCM_RIGHTS), which the writer copies
+        straight from the client's file.
+        :param file: The name of the file to be written to
+        :param folder: The location for the file being written
+        :param writer: The FileWriter that saves the data
+        :param path: The path of the unix domain socket to receive the descriptor on
+        :param digest: The raw md5 the file was requested with, the copy is only committed if it matches
+        :param listener: A socket already listening at the path, one is opened for the file when not given
+        """
+        self.copy_descriptors(self.accept_descriptor(path, listener), file, folder, writer, digest)
+
+    def copy_descriptors(self, fds, file, folder, writer, digest=None):
+        """
+        Have the writer copy a file from the client's file descriptors
+        :param fds: The file descriptors received from the client
+        :param file: The name of the file to be written to
+        :param folder: The location for the file being written
+        :param writer: The FileWriter that saves the data
+        :param digest: The raw md5 the file was requested with, the copy is only committed if it matches
+        """
+        writer.open(folder, file, digest)
+        for fd in fds:
+            writer.copy(fd)
+        writer.close()
+        FILE_SERVER_LOG.debug('File received: %s', file)
+
+
+class ShardWorker:
+    """
+    ShardWorker class:
+    Holds one shard of the local folder in a process of its own: the files whose path hashes to its index. The front
+    process hands it work over a unix socket pair, scanning and hashing its files, receiving the files requested from
+    the client on the data connections (or descriptors) the front accepted and passed on, and flushing its writer.
+    """
+
+    def __init__(self, index, count, mode, folder, ignore_rules=(), fadvise=False, cache_path=''):
+        """
+        Initialise the worker for a shard
+        :param index: The index of the shard
+        :param count: The number of shards the folder is split across
+        :param mode: How files are assigned to shards, one of ShardPool.MODES
+        :param folder: The local folder being kept in sync
+        :param ignore_rules: Rules to ignore in addition to the folder's .syncignore
+        :param fadvise: Whether the scanner gives the kernel readahead and page cache advice
+        :param cache_path: The file the shard's StatCache is saved to, not saved when not given
+        """
+        self.INDEX = index
+        self.COUNT = count
+        self.MODE = mode
+        self.FOLDER = folder
+        self.IGNORE_RULES = ignore_rules
+        self.FADVISE = fadvise
+        self.CACHE_PATH = cache_path
+        self.CACHE = None
+
+    def owns(self, path):
+        """
+        :param path: The path of a file relative to the folder
+        :return: True if the file belongs to this shard
+        """
+        return ShardPool.shard(path, self.COUNT, self.MODE) == self.INDEX
+
+    def run(self, sock, inherited=()):
+        """
+        Serve the front process until it closes its end of the socket pair
+        :param sock: The worker's end of the socket pair
+        :param inherited: The front's ends of the socket pairs of this shard and those started earlier, closed so that
+        only the front holds them and the worker sees the front close
+        """
+        for other in inherited:
+            other.close()
+        self.CACHE = StatCache(self.CACHE_PATH)
+        writer = FileWriter(FileCommitter(cache=self.CACHE))
+        # The time taken to receive each file and the files lost part way since the last flush, reported back to the
+        # front with the flush
+        transfer_seconds = []
+        failed = []
+        while True:
+            message, fds, flags, address = socket.recv_fds(sock, ShardPool.MESSAGE_SIZE, 1)
+            if not message:
+                break
+            command = pickle.loads(message)
+            if command[0] == 'scan':
+                self.scan(sock)
+            elif command[0] == 'socket':
+                file_start = time.perf_counter()
+                try:
+                    FileServer().receive_data(socket.socket(fileno=fds[0]), command[1], self.FOLDER, writer,
+                                              extents=command[2], digest=command[3])
+                    transfer_seconds.append(time.perf_counter() - file_start)
+                except OSError as error:
+                    SERVER_LOG.warning('File not received: %s: %s', command[1], error)
+                    failed.append(command[1])
+            elif command[0] == 'descriptor':
+                file_start = time.perf_counter()
+                FileServer().copy_descriptors(fds, command[1], self.FOLDER, writer, command[3])
+                transfer_seconds.append(time.perf_counter() - file_start)
+            elif command[0] == 'flush':
+                error = None
+                rejected = []
+                try:
+                    rejected = writer.flush()
+                except OSError as e:
+                    error = str(e)
+                sock.send(pickle.dumps(['flushed', error, rejected, transfer_seconds, failed]))
+                transfer_seconds = []
+                failed = []
+
+    def scan(self, sock):
+        """
+        Scan and hash the files of the shard and send the table of them back to the front in chunks
+        :param sock: The worker's end of the socket pair
+        """
+        log_files = FILE_LOG.isEnabledFor(logging.DEBUG)
+        scan_start = time.perf_counter()
+        file_list = FileTable()
+        scanner = FileScanner(SyncIgnore.load(self.FOLDER, self.IGNORE_RULES), self.FADVISE, FileCommitter.TEMP_SUFFIX,
+                              select=self.owns, cache=self.CACHE)
+        for root, file, file_md5, file_size in scanner.scan(self.FOLDER):
+            file_list.add(root, file, file_md5, file_size)
+            if log_files:
+                FILE_LOG.debug('File %s', [root, file, file_md5.hex()])
+        data = file_list.to_bytes()
+        for offset in range(0, len(data), ShardPool.CHUNK_SIZE):
+            sock.send(pickle.dumps(['table', data[offset:offset + ShardPool.CHUNK_SIZE]]))
+        sock.send(pickle.dumps(['scanned', time.perf_counter() - scan_start, scanner.HASHED_BYTES,
+                                scanner.CACHED_FILES]))
+
+
+class ShardPool:
+    """
+    ShardPool class:
+    The front process's side of a sharded server. The local folder is split across a number of worker processes by a
+    hash of each file's path, or of its top level directory so that a directory stays on one shard, and each worker
+    scans, hashes and writes only its own files so the work is spread over as many cores as there are shards. The
+    front keeps the client connections and the comparison of the file lists, merging the tables scanned by the shards
+    and passing each file's data connection on to the shard that owns the file.
+    Received files are written straight into the folder, so a file received is assigned by its name in either mode.
+    The workers are forked, so the pool must be started before the process starts any threads.
+    """
+
+    MODES = ['path', 'directory']
+    MESSAGE_SIZE = FileServer.MESSAGE_SIZE
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, count, mode, folder, ignore_rules=(), fadvise=False, state=''):
+        """
+        Start a worker process for each shard
+        :param count: The number of shards to split the folder across
+        :param mode: How files are assigned to shards, one of MODES
+        :param folder: The local folder being kept in sync
+        :param ignore_rules: Rules to ignore in addition to the folder's .syncignore
+        :param fadvise: Whether the scanners give the kernel readahead and page cache advice
+        :param state: The folder each shard saves its StatCache to, not saved when not given
+        """
+        self.COUNT = count
+        self.MODE = mode
+        self.SOCKETS = []
+        self.PROCESSES = []
+        # The bytes hashed by the last scan and the files taken from the shards' caches instead
+        self.HASHED_BYTES = 0
+        self.CACHED_FILES = 0
+        # The time each shard took to receive each file passed to it since the last flush, and the files they lost
+        self.TRANSFER_SECONDS = []
+        self.FAILED = []
+        context = multiprocessing.get_context('fork')
+        for index in range(count):
+            front, back = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            worker = ShardWorker(index, count, mode, folder, ignore_rules, fadvise,
+                                 os.path.join(state, 'server-cache-%d' % index) if state else '')
+            process = context.Process(target=worker.run, args=(back, self.SOCKETS + [front]), name='shard-%d' % index,
+                                      daemon=True)
+            process.start()
+            back.close()
+            self.SOCKETS.append(front)
+            self.PROCESSES.append(process)
+        SERVER_LOG.info('Shards: %d by %s', count, mode)
+
+    @staticmethod
+    def shard(path, count, mode='path'):
+        """
+        :param path: The path of a file relative to the folder
+        :param count: The number of shards
+        :param mode: How files are assigned to shards, one of MODES
+        :return: The index of the shard the file belongs to
+        """
+        key = path.split('/', 1)[0] if mode == 'directory' else path
+        return zlib.crc32(key.encode(FileTable.ENCODING, FileTable.ERRORS)) % count
+
+    def receive(self, index):
+        """
+        Wait for the next reply from a shard
+        :param index: The index of the shard
+        :return: The reply
+        """
+        message = self.SOCKETS[index].recv(self.CHUNK_SIZE * 2)
+        if not message:
+            raise OSError('Shard %d has stopped' % index)
+        return pickle.loads(message)
+
+    def send(self, file, kind, fds, extents=False, digest=None):
+        """
+        Pass a file's data connection or descriptors to the shard that owns the file, the shard keeps its own copies
+        :param file: The path of the file relative to the folder
+        :param kind: socket for a data connection or descriptor for descriptors from the local transport
+        :param fds: The file descriptors to pass
+        :param extents: Whether the file was asked for as extent records
+        :param digest: The raw md5 the file was requested with
+        """
+        index = self.shard(file, self.COUNT, self.MODE)
+        message = pickle.dumps([kind, file, extents, digest])
+        # The shard reads each message whole into MESSAGE_SIZE, a longer one would arrive cut short
+        if len(message) > self.MESSAGE_SIZE:
+            raise OSError(errno.ENAMETOOLONG, 'Path too long to pass to a shard', file)
+        socket.send_fds(self.SOCKETS[index], [message], fds)
+
+    def scan(self):
+        """
+        Have every shard scan its files at once and merge the tables they send back
+        :return: FileTable of all the files in the folder
+        """
+        for sock in self.SOCKETS:
+            sock.send(pickle.dumps(['scan']))
+        file_list = FileTable()
+        self.HASHED_BYTES = self.CACHED_FILES = 0
+        for index in range(self.COUNT):
+            chunks = []
+            reply = self.receive(index)
+            while reply[0] == 'table':
+                chunks.append(reply[1])
+                reply = self.receive(index)
+            SERVER_LOG.debug('Shard %d scanned in %.3fs', index, reply[1])
+            self.HASHED_BYTES += reply[2]
+            self.CACHED_FILES += reply[3]
+            file_list.extend(FileTable.from_bytes(b''.join(chunks)))
+        return file_list
+
+    def receive_file(self, file, port=7100, buffer_size=0, extents=False, digest=None, listener=None):
+        """
+        Accept the client's data connection for a file and pass it to the shard that owns the file, which receives the
+        data while the front moves on to the next file
+        :param file: The path of the file relative to the folder
+        :param port: The port to listen for the file data on
+        :param buffer_size: The receive buffer to set, 0 to leave it to the kernel
+        :param extents: Whether the file was asked for as extent records
+        :param digest: The raw md5 the file was requested with
+        :param listener: A socket already listening on the data port, one is opened for the file when not given
+        """
+        client = FileServer().accept_file(port, buffer_size, listener)
+        self.send(file, 'socket', [client.fileno()], extents, digest)
+        client.close()
+
+    def receive_descriptor(self, file, path, digest=None, listener=None):
+        """
+        The local transport version of receive_file(), the client's file descriptors are passed on to the shard
+        :param file: The path of the file relative to the folder
+        :param path: The path of the unix domain socket to receive the descriptor on
+        :param digest: The raw md5 the file was requested with
+        :param listener: A socket already listening at the path, one is opened for the file when not given
+        """
+        fds = FileServer().accept_descriptor(path, listener)
+        self.send(file, 'descriptor', fds, digest=digest)
+        for fd in fds:
+            os.close(fd)
+
+    def flush(self):
+        """
+        Wait for every shard to write and commit the files passed to it, and collect the time they took to receive them
+        and the files whose connection was lost part way
+        :return: List of the paths of the files the shards rejected as they did not match their md5
+        """
+        for sock in self.SOCKETS:
+            sock.send(pickle.dumps(['flush']))
+        replies = [self.receive(index) for index in range(self.COUNT)]
+        self.TRANSFER_SECONDS = [seconds for reply in replies for seconds in reply[3]]
+        self.FAILED = [file for reply in replies for file in reply[4]]
+        for reply in replies:
+            if reply[1] is not None:
+                raise OSError(reply[1])
+        return [path for reply in replies for path in reply[2]]
+
+
+class RelayFiles:
+    """
+    RelayFiles class:
+    Tracks the files a relay is receiving so they can be sent on downstream while they are still arriving. The writer
+    reports each file as it is opened, written to and closed. A file is followed from its temporary name as it grows,
+    or from its final name once committed, until the writer has closed it, so each byte is read from the page cache
+    soon after it was written rather than waiting for the whole file.
+    """
+
+    def __init__(self):
+        """
+        Initialise the relay with no files
+        """
+        self.CONDITION = threading.Condition()
+        # Final path of each file expected or received to [temporary path, bytes written, closed]
+        self.FILES = {}
+
+    def expect(self, paths):
+        """
+        Note the files about to be received, so a request for one waits for the new file rather than sending the old
+        :param paths: The final paths of the files to be received
+        """
+        with self.CONDITION:
+            for path in paths:
+                self.FILES[os.path.normpath(path)] = ['', 0, False]
+
+    def opened(self, path, temp_path):
+        """
+        Called by the writer once it has created a file's temporary file
+        :param path: The final path of the file
+        :param temp_path: The temporary path it is being written to
+        """
+        with self.CONDITION:
+            # Updated in place, a sender may already be waiting on the expected entry
+            self.FILES.setdefault(os.path.normpath(path), ['', 0, False])[:] = [temp_path, 0, False]
+            self.CONDITION.notify_all()
+
+    def wrote(self, path, size):
+        """
+        Called by the writer each time more of a file has been written
+        :param path: The final path of the file
+        :param size: The number of bytes written so far
+        """
+        with self.CONDITION:
+            self.FILES.setdefault(os.path.normpath(path), ['', 0, False])[1] = size
+            self.CONDITION.notify_all()
+
+    def closed(self, path, size):
+        """
+        Called by the writer once a file is complete, or has failed
+        :param path: The final path of the file
+        :param size: The number of bytes written
+        """
+        with self.CONDITION:
+            entry = self.FILES.setdefault(os.path.normpath(path), ['', 0, False])
+            entry[1] = size
+            entry[2] = True
+            self.CONDITION.notify_all()
+
+    def abandon(self, paths):
+        """
+        Give up on files that will not be received in this sync, a sender waiting for one to start fails rather than
+        waiting for the end of the sync
+        :param paths: The final paths of the files
+        """
+        with self.CONDITION:
+            for path in paths:
+                entry = self.FILES.get(os.path.normpath(path))
+                if entry is not None:
+                    entry[2] = True
+            self.CONDITION.notify_all()
+
+    def clear(self):
+        """
+        Forget the files of the sync just finished, waking any sender still waiting on one
+        """
+        with self.CONDITION:
+            for entry in self.FILES.values():
+                entry[2] = True
+            self.FILES = {}
+            self.CONDITION.notify_all()
+
+    def send(self, path, sock):
+        """
+        Send a file to a socket, following it as it is written when the relay is still receiving it
+        :param path: The final path of the file
+        :param sock: The connected socket to send the file on
+        :return: The number of bytes sent
+        """
+        with self.CONDITION:
+            entry = self.FILES.get(os.path.normpath(path))
+            if entry is not None:
+                self.CONDITION.wait_for(lambda: entry[0] or entry[2])
+                if not entry[0]:
+                    raise OSError('File was not received: %s' % path)
+        if entry is None:
+            # Not being received in this sync, the file is sent as it is
+            with open(path, 'rb') as f:
+                return sock.sendfile(f)
+        try:
+            fd = os.open(entry[0], os.O_RDONLY)
+        except FileNotFoundError:
+            # Already committed under its final name
+            fd = os.open(path, os.O_RDONLY)
+        try:
+            position = 0
+            while True:
+                with self.CONDITION:
+                    self.CONDITION.wait_for(lambda: entry[1] > position or entry[2])
+                    written, closed = entry[1], entry[2]
+                if written > position:
+                    sent = os.sendfile(sock.fileno(), fd, position, written - position)
+                    if sent == 0:
+                        raise OSError('File is shorter than written: %s' % path)
+                    position += sent
+                elif closed:
+                    return position
+        finally:
+            os.close(fd)
+
+
+class DownstreamServer(SocketConnector):
+    """
+    DownstreamServer class:
+    A relay's connection to a server downstream of it. The relay passes on the client's ignore rules and file list, so
+    the downstream server plans its own sync against the client's tree, and answers each of its file requests from the
+    relay's copy of the file, following files the relay is still receiving. The downstream server can itself relay,
+    so servers can be chained or arranged in a tree while the client uploads each file once.
+    """
+
+    def __init__(self, address, folder, files, local_ops):
+        """
+        Initialise the connection to a downstream server
+        :param address: The server as HOST[:PORT[:DATA_PORT]], the ports defaulting to 7101 and 7100
+        :param folder: The relay's local folder the files are sent from
+        :param files: The relay's RelayFiles
+        :param local_ops: The relay's LocalOperations, waited on for files being copied
+        """
+        host, port, data_port = (address.split(':') + ['', '', ''])[:3]
+        self.HOST = host or 'localhost'
+        self.PORT = int(port or 7101)
+        self.DATA_PORT = int(data_port or 7100)
+        self.FOLDER = folder
+        self.FILES = files
+        self.LOCAL_OPS = local_ops
+        self.THREAD = None
+        self.ERROR = None
+
+    def start(self, root, ignore_rules, file_list):
+        """
+        Start syncing the downstream server on a thread of its own
+        :param root: The top of the client's folder
+        :param ignore_rules: The client's ignore rules
+        :param file_list: The client's file list, as encoded in the filelist message
+        """
+        self.ERROR = None
+        self.THREAD = threading.Thread(target=self.sync, args=(root, ignore_rules, file_list), daemon=True)
+        self.THREAD.start()
+
+    def join(self):
+        """
+        Wait for the downstream sync to finish
+        :return: The error that stopped the sync or None if it completed
+        """
+        self.THREAD.join()
+        return self.ERROR
+
+    def sync(self, root, ignore_rules, file_list):
+        """
+        Run a sync with the downstream server as its client, sending every file it requests until it reports the sync
+        is done
+        :param root: The top of the client's folder
+        :param ignore_rules: The client's ignore rules
+        :param file_list: The client's file list, as encoded in the filelist message
+        """
+        try:
+            address = (self.HOST, self.PORT)
+            connection = SyncConnection(self.connect(socket.AF_INET, address), address)
+            try:
+                if root:
+                    connection.send('root:' + base64.b64encode(root.encode()).decode())
+                connection.send('ignore:' + base64.b64encode('\n'.join(ignore_rules).encode()).decode())
+                connection.send('filelist:' + file_list)
+                while True:
+                    messages = connection.receive()
+                    if messages is None:
+                        raise ConnectionError('Connection closed by the downstream server')
+                    for message in messages:
+                        message_type = str(message).split(':')[0]
+                        if message_type == 'filerequest':
+                            self.send_file(ast.literal_eval(str(message).split(':')[1])[0][1])
+                        elif message_type == 'sync':
+                            return
+            finally:
+                connection.close()
+        except OSError as error:
+            SERVER_LOG.error('Downstream %s:%d failed: %s', self.HOST, self.PORT, error)
+            self.ERROR = error
+
+    def send_file(self, file):
+        """
+        Send a file requested by the downstream server over a data connection of its own
+        :param file: The name of the file
+        """
+        path = os.path.join(self.FOLDER, file)
+        self.LOCAL_OPS.wait_for(path)
+        s = self.connect(socket.AF_INET, (self.HOST, self.DATA_PORT))
+        try:
+            sent = self.FILES.send(path, s)
+            FILE_SERVER_LOG.debug('Relayed %s to %s:%d, %d bytes', file, self.HOST, self.DATA_PORT, sent)
+        finally:
+            s.close()
+
+
+class RateLimiter:
+    """
+    RateLimiter class:
+    A token bucket used to cap the bandwidth used by a class of transfers. Up to a second's worth of bytes may be used
+    in a burst, after that the caller is held back until the average rate is back within the limit.
+    """
+
+    def __init__(self, rate):
+        """
+        Initialise the limiter with a full bucket
+        :param rate: The limit in bytes per second
+        """
+        self.RATE = rate
+        self.ALLOWANCE = rate
+        self.LAST = time.monotonic()
+
+    def consume(self, length):
+        """
+        Take the given number of bytes from the bucket, sleeping if the bucket is empty
+        :param length: The number of bytes transferred
+        """
+        now = time.monotonic()
+        self.ALLOWANCE = min(self.RATE, self.ALLOWANCE + (now - self.LAST) * self.RATE)
+        self.LAST = now
+        self.ALLOWANCE -= length
+        if self.ALLOWANCE < 0:
+            time.sleep(-self.ALLOWANCE / self.RATE)
+
+
+class TransferScheduler:
+    """
+    TransferScheduler class:
+    Decides the order the files needed from the client are requested in and tracks the progress of the transfers.
+    Files are sorted into classes by matching their names (or paths) against globs, each class can be given a
+    bandwidth limit. The policies are:
+    * walk - the order the client found the files in
+    * smallest - smallest files first, so one huge file does not hold up thousands of small ones
+    * locality - grouped by directory and sorted by name, so the client reads each directory sequentially
+    * priority - classes in the order they were given, smallest first within each class
+    """
+
+    POLICIES = ['walk', 'smallest', 'locality', 'priority']
+    DEFAULT_CLASS = 'default'
+
+    def __init__(self, policy='walk', classes=None, limits=None):
+        """
+        Initialise the scheduler
+        :param policy: The name of the ordering policy
+        :param classes: List of [class name, glob] pairs, a file belongs to the first class it matches
+        :param limits: Dictionary of class name to bandwidth limit in bytes per second
+        """
+        self.POLICY = policy
+        self.CLASSES = classes or []
+        self.LIMITERS = {name: RateLimiter(rate) for name, rate in (limits or {}).items()}
+        self.BYTES_TOTAL = 0
+        self.BYTES_DONE = 0
+        self.FILES_TOTAL = 0
+        self.FILES_DONE = 0
+        self.START = time.monotonic()
+
+    def file_class(self, file):
+        """
+        :param file: The file in the [root, name, md5, size] form
+        :return: The name of the class the file belongs to
+        """
+        for name, pattern in self.CLASSES:
+            if fnmatch.fnmatch(file[1], pattern) or fnmatch.fnmatch(os.path.join(file[0], file[1]), pattern):
+                return name
+        return self.DEFAULT_CLASS
+
+    def order(self, files):
+        """
+        Sort the files to request according to the policy
+        :param files: List of files in the [root, name, md5, size] form
+        :return: The files in the order they should be requested
+        """
+        if self.POLICY == 'smallest':
+            return sorted(files, key=lambda file: file[3])
+        if self.POLICY == 'locality':
+            return sorted(files, key=lambda file: (file[0], file[1]))
+        if self.POLICY == 'priority':
+            ranks = {name: rank for rank, (name, pattern) in reversed(list(enumerate(self.CLASSES)))}
+            return sorted(files, key=lambda file: (ranks.get(self.file_class(file), len(ranks)), file[3]))
+        return list(files)
+
+    def start(self, files):
+        """
+        Start tracking the progress of a new set of transfers
+        :param files: List of files in the [root, name, md5, size] form about to be requested
+        """
+        self.BYTES_TOTAL = sum(file[3] for file in files)
+        self.BYTES_DONE = 0
+        self.FILES_TOTAL = len(files)
+        self.FILES_DONE = 0
+        self.START = time.monotonic()
+
+    def limiter(self, file):
+        """
+        :param file: The file in the [root, name, md5, size] form
+        :return: The RateLimiter for the class of the file or None if the class is not limited
+        """
+        return self.LIMITERS.get(self.file_class(file))
+
+    def complete(self, file):
+        """
+        Record a file as transferred
+        :param file: The file in the [root, name, md5, size] form
+        """
+        self.BYTES_DONE += file[3]
+        self.FILES_DONE += 1
+
+    def progress(self):
+        """
+        :return: Dictionary of the files and bytes remaining, the average rate so far and the estimated seconds until
+        the transfers complete (None until the rate is known)
+        """
+        elapsed = time.monotonic() - self.START
+        rate = self.BYTES_DONE / elapsed if elapsed > 0 else 0
+        remaining = self.BYTES_TOTAL - self.BYTES_DONE
+        return {
+            'files_remaining': self.FILES_TOTAL - self.FILES_DONE,
+            'bytes_remaining': remaining,
+            'bytes_per_second': rate,
+            'eta_seconds': remaining / rate if rate > 0 else None,
+        }
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """
+    MetricsHandler class:
+    Serves the server's metrics over HTTP at /metrics for scraping by Prometheus or reading with curl. The SyncMetrics
+    to serve are taken from the METRICS attribute of the HTTP server.
+    """
+
+    def do_GET(self):
+        """
+        Reply to a request with the metrics, or a 404 for any other path
+        """
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """
+        Keep requests out of the server output
+        """
+        pass
+
+
+class ClientConnection(SyncConnection):
+    """
+    ClientConnection class:
+    A SyncConnection accepted from a client, holding what the client has told the server about itself along with the
+    connection: the top of its folder, the rules of the files it leaves out, the link measurements it made and whether
+    it sends sparse files as extents.
+    """
+
+    def __init__(self, sock, address):
+        """
+        Initialise the connection
+        :param sock: The connected socket
+        :param address: The address of the client
+        """
+        super().__init__(sock, address)
+        self.ROOT = ''
+        self.IGNORE = SyncIgnore()
+        self.TUNER = None
+        self.SPARSE = False
 
 
 class SyncServer:
@@ -56,38 +1528,228 @@ class SyncServer:
 
     LOCAL_FOLDER = ''
     CURRENT_FILE_LIST = ''
-    SOCKET = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    SOCKET = None
     REQUEST_FILE_LIST = []
-    HEADER = 10
+    WRITER = None
+    LOCAL_OPS = None
+    LOCAL_OPS_START = 0
+    SHARDS = None
+    RELAY = None
+    DOWNSTREAM = []
+    CACHE = None
+    JOURNAL = None
+    SCHEDULER = None
+    METRICS = None
+    METRIC_DESCRIPTIONS = {
+        'diff_seconds': ['histogram', 'Time taken to compare the client and server file lists'],
+        'local_copies_total': ['counter', 'Number of files copied locally rather than transferred'],
+        'deletes_total': ['counter', 'Number of files deleted'],
+        'local_ops_seconds': ['histogram', 'Time taken by the local copies and deletes of each sync'],
+        'transfer_files_remaining': ['gauge', 'Files still to transfer in the current sync'],
+        'transfer_bytes_remaining': ['gauge', 'Bytes still to transfer in the current sync'],
+        'transfer_eta_seconds': ['gauge', 'Estimated seconds until the transfers of the current sync complete'],
+        'rejected_files_total': ['counter', 'Number of files received that did not match the md5 requested'],
+        'failed_files_total': ['counter', 'Number of files whose connection was lost part way through receiving them'],
+        'relay_wait_seconds': ['histogram', 'Time spent after each sync waiting for the downstream servers to finish'],
+        'relay_failures_total': ['counter', 'Number of relayed syncs to downstream servers that failed'],
+    }
+    SUMMARY = {}
+    SUMMARY_FILE = ''
+    PROFILER = None
+    IGNORE = None
+    IGNORE_RULES = []
+    FADVISE = False
+    CLIENT_IGNORE = None
+    CLIENT_ROOT = ''
+    PROGRESS_INTERVAL = 5
+    LAST_PROGRESS = 0
+    SELECTOR = None
     SERVER = 'localhost'
     PORT = 7101
+    DATA_PORT = 7100
+    UNIX_SOCKET = ''
+    HEARTBEAT = 30
+    NODELAY = False
 
-    def __init__(self):
+    def __init__(self, args=None):
         """
         Initialise the main SyncServer class
         Checks arguments for 1 argument which should be the directory to maintain against data provided by client
-        Binds the socket connection to the hardcoded values stored in the variables SERVER and PORT
+        Binds the socket connection to the values stored in the variables SERVER and PORT, or to a unix domain socket
+        when the local transport is selected with --unix
+        Starts the FileWriter used to save received files, and the shard worker processes when the folder is sharded
+        :param args: The command line arguments, sys.argv is used when not given
         """
-        # Find the first argument and assign to variable LOCAL_FOLDER
-        for i, arg in enumerate(sys.argv):
-            if i == 1:
-                self.LOCAL_FOLDER = str(arg)
-                print('SS: Local directory:', self.LOCAL_FOLDER)
+        # Find the first argument and assign to variable LOCAL_FOLDER along with any options
+        arguments = self.parse_arguments(args)
+        FileEventFilter.configure_logging(arguments, [FILE_LOG, FILE_SERVER_LOG, WRITER_LOG])
+        if arguments.folder:
+            self.LOCAL_FOLDER = str(arguments.folder)
+            SERVER_LOG.info('Local directory: %s', self.LOCAL_FOLDER)
+        self.UNIX_SOCKET = arguments.unix
+        self.PORT = arguments.port
+        self.DATA_PORT = arguments.data_port
+        self.HEARTBEAT = arguments.heartbeat
+        self.NODELAY = arguments.nodelay
+        self.SCHEDULER = TransferScheduler(arguments.schedule,
+                                           [option.split('=', 1) for option in arguments.transfer_class],
+                                           {name: LinkTuner.parse_rate(rate) for name, rate in
+                                            (option.split('=', 1) for option in arguments.class_limit)})
+        self.SELECTOR = selectors.DefaultSelector()
+        self.METRICS = SyncMetrics('server_sync', self.METRIC_DESCRIPTIONS)
+        self.SUMMARY = {}
+        self.SUMMARY_FILE = arguments.summary
+        self.IGNORE_RULES = arguments.ignore
+        self.FADVISE = arguments.fadvise
+        self.PROFILER = SyncProfiler('server', PROFILE_LOG, arguments.profile, arguments.trace_alloc,
+                                     arguments.profile_rate, arguments.profile_keep)
         # If no directory specified exit out
         if self.LOCAL_FOLDER == '':
-            print('SS: No local directory specified')
+            SERVER_LOG.error('No local directory specified')
             sys.exit(1)
-        # Bind the socket to the server and port provided and set listen queue
-        print('SS: Socket bind:', (self.SERVER, self.PORT))
-        self.SOCKET.bind((self.SERVER, self.PORT))
+        # Clear out any partly received files left by an interrupted sync and start the writer for received files
+        FileCommitter.remove_stale(self.LOCAL_FOLDER)
+        if arguments.state:
+            os.makedirs(arguments.state, exist_ok=True)
+        # The shard workers are forked, so they are started before any threads
+        if arguments.shards > 1:
+            self.SHARDS = ShardPool(arguments.shards, arguments.shard_by, self.LOCAL_FOLDER, self.IGNORE_RULES,
+                                    self.FADVISE, arguments.state)
+        else:
+            # Pick up from any sync that was interrupted, the files it committed do not need hashing again
+            self.CACHE = StatCache(os.path.join(arguments.state, 'server-cache') if arguments.state else '')
+            if arguments.state:
+                self.JOURNAL = SyncJournal(os.path.join(arguments.state, 'server-journal'))
+                recovered = self.JOURNAL.recover(self.CACHE)
+                if recovered is not None:
+                    SERVER_LOG.info('Resuming interrupted sync: %d of %d files were received', recovered[1],
+                                    recovered[0])
+        # A relay follows the files it receives so it can send them on while they arrive
+        if arguments.downstream:
+            self.RELAY = RelayFiles()
+        self.WRITER = FileWriter(FileCommitter(self.JOURNAL, self.CACHE), self.RELAY)
+        self.LOCAL_OPS = LocalOperations(arguments.local_workers)
+        self.DOWNSTREAM = [DownstreamServer(address, self.LOCAL_FOLDER, self.RELAY, self.LOCAL_OPS)
+                           for address in arguments.downstream]
+        # Bind the socket to the server and port provided, or the unix domain socket, and set listen queue
+        if self.UNIX_SOCKET:
+            SERVER_LOG.info('Socket bind: %s', self.UNIX_SOCKET)
+            if os.path.exists(self.UNIX_SOCKET):
+                os.remove(self.UNIX_SOCKET)
+            self.SOCKET = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.SOCKET.bind(self.UNIX_SOCKET)
+        else:
+            SERVER_LOG.info('Socket bind: %s', (self.SERVER, self.PORT))
+            self.SOCKET = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Allow the port to be bound again straight away on restart rather than waiting for TIME_WAIT to clear
+            self.SOCKET.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.SOCKET.bind((self.SERVER, self.PORT))
         self.SOCKET.listen(10)
+        # Serve the metrics over HTTP if a port has been given
+        if arguments.stats_port:
+            self.serve_metrics(arguments.stats_port)
+
+    @staticmethod
+    def parse_arguments(args=None):
+        """
+        Read the directory to keep in sync and any options from the command line
+        :param args: The command line arguments, sys.argv is used when not given
+        :return: The parsed arguments
+        """
+        parser = argparse.ArgumentParser(description='Keep a local directory in sync with the directory of a client')
+        parser.add_argument('folder', nargs='?', default='', help='The directory to keep in sync')
+        parser.add_argument('--unix', default='', metavar='PATH',
+                            help='Use the local transport for a client on the same host: control messages over a '
+                                 'unix domain socket at PATH and file data passed as file descriptors over PATH.data')
+        parser.add_argument('--port', type=int, default=7101,
+                            help='The port to listen for control messages from clients on (default: 7101)')
+        parser.add_argument('--data-port', type=int, default=7100,
+                            help='The port to listen for file data from clients on (default: 7100)')
+        parser.add_argument('--heartbeat', type=float, default=30, metavar='SECONDS',
+                            help='The heartbeat interval expected from clients holding a session open, sessions not '
+                                 'heard from for three intervals are closed (default: 30)')
+        parser.add_argument('--nodelay', action='store_true',
+                            help='Send control messages straight away (TCP_NODELAY) rather than letting TCP hold small '
+                                 'messages back to combine them')
+        parser.add_argument('--schedule', choices=TransferScheduler.POLICIES, default='walk',
+                            help='The order files are requested from the client in: walk (the order the client found '
+                                 'them), smallest first, locality (by directory) or priority (by class) '
+                                 '(default: walk)')
+        parser.add_argument('--class', dest='transfer_class', action='append', default=[], metavar='NAME=GLOB',
+                            help='Put files whose name or path matches GLOB into the class NAME, can be given more '
+                                 'than once and a file belongs to the first class it matches. The priority schedule '
+                                 'requests classes in the order given')
+        parser.add_argument('--class-limit', action='append', default=[], metavar='NAME=RATE',
+                            help='Cap the bandwidth of transfers in the class NAME to RATE bytes per second, with an '
+                                 'optional K, M or G suffix')
+        parser.add_argument('--shards', type=int, default=1, metavar='N',
+                            help='Split the directory across N worker processes that scan, hash and write their own '
+                                 'files, so a large tree uses N cores (default: 1, not sharded)')
+        parser.add_argument('--shard-by', choices=ShardPool.MODES, default='path',
+                            help='Assign files to shards by a hash of their path, or of their top level directory so '
+                                 'that each directory stays on one shard. Received files are written straight into '
+                                 'the directory, so they are assigned by name either way (default: path)')
+        parser.add_argument('--downstream', action='append', default=[], metavar='HOST[:PORT[:DATA_PORT]]',
+                            help='Relay every sync on to the server at HOST (ports default to 7101 and 7100), sending '
+                                 'each file on while it is still being received, can be given more than once')
+        parser.add_argument('--local-workers', type=int, default=LocalOperations.WORKERS, metavar='N',
+                            help='The number of threads running the local copies and deletes of a sync (default: 4)')
+        parser.add_argument('--stats-port', type=int, default=0, metavar='PORT',
+                            help='Serve the sync metrics in the Prometheus text format at '
+                                 'http://localhost:PORT/metrics')
+        parser.add_argument('--ignore', action='append', default=[], metavar='PATTERN',
+                            help='Leave files and directories matching the gitignore style PATTERN out of the sync, in '
+                                 'addition to the rules in .syncignore at the top of the directory, can be given more '
+                                 'than once')
+        parser.add_argument('--fadvise', action='store_true',
+                            help='Advise the kernel to read ahead when hashing large files and drop each file from the '
+                                 'page cache once hashed, so a full scan does not push everything else out of the '
+                                 'cache')
+        parser.add_argument('--state', default='', metavar='DIR',
+                            help='Save the md5 of every file scanned and a journal of the sync in progress to DIR, so '
+                                 'a restarted server only hashes the files that have changed and picks up an '
+                                 'interrupted sync where it stopped, DIR should be outside the directory or ignored')
+        parser.add_argument('--summary', default='', metavar='FILE',
+                            help='Append a JSON summary record of every sync to FILE')
+        FileEventFilter.add_arguments(parser)
+        SyncProfiler.add_arguments(parser)
+        arguments = parser.parse_args(args)
+        # The shards receive the file data, out of reach of the front's bandwidth limits
+        if arguments.shards > 1 and arguments.class_limit:
+            parser.error('--class-limit cannot be used with --shards')
+        # Files passed over the local transport are copied in the kernel, there is no link to limit
+        if arguments.unix and arguments.class_limit:
+            parser.error('--class-limit cannot be used with --unix')
+        # The relay follows files through the front's writer
+        if arguments.shards > 1 and arguments.downstream:
+            parser.error('--downstream cannot be used with --shards')
+        return arguments
+
+    def serve_metrics(self, port):
+        """
+        Start a HTTP server on a background thread serving the metrics at /metrics, bound to localhost only
+        :param port: The port to serve the metrics on
+        """
+        SERVER_LOG.info('Serving metrics: http://localhost:%d/metrics', port)
+        metrics_server = http.server.ThreadingHTTPServer(('localhost', port), MetricsHandler)
+        metrics_server.METRICS = self.METRICS
+        threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+
+    def write_summary(self):
+        """
+        Print the summary record of the sync just completed and append it to the summary file if one was given
+        """
+        SERVER_LOG.info('Summary: %s', self.SUMMARY)
+        if self.SUMMARY_FILE:
+            with open(self.SUMMARY_FILE, 'a') as f:
+                f.write(json.dumps(self.SUMMARY) + '\n')
 
     def read_local_storage(self):
         """
         For the LOCAL_FOLDER variable set from argument passed in, traverse the directory structure beneath it and build
         a file list of every file contained beneath.
 
-        For every file discovered a new list object is created for that file and the following data is stored.
+        For every file discovered an entry is added to a FileTable holding the following data.
 
         [<root directory of the file>, <file name including extension>, <md5 of the file>]
 
@@ -99,206 +1761,531 @@ class SyncServer:
         In addition we also use the md5 to check if client files with the same name as a file on the server match in
         orde to indicate whether an update has occurred.
 
-        :return file_list - List object containing a collection of list objects that are used to store file details
-        described above
+        :return file_list - FileTable holding the file details described above
         """
-        print('SS: Local file list')
-        file_list = []
-        for root, dirs, files in os.walk(self.LOCAL_FOLDER):
-            for file in files:
-                # Create an md5 object for the file
-                file_md5 = hashlib.md5()
-                # Open the file in binary format to calculate the md5
-                with open(os.path.join(root, file), 'rb') as open_file:
-                    # Add chunks of data to the md5 object
-                    for data in iter(lambda: open_file.read(4096), b""):
-                        file_md5.update(data)
-                file_list.append([root, file, file_md5.hexdigest()])
-                print('SS: File', [root, file, file_md5.hexdigest()])
+        SERVER_LOG.info('Scanning local directory')
+        log_files = FILE_LOG.isEnabledFor(logging.DEBUG)
+        scan_start = time.perf_counter()
+        file_list = FileTable()
+        self.IGNORE = SyncIgnore.load(self.LOCAL_FOLDER, self.IGNORE_RULES)
+        if self.SHARDS is not None:
+            # Each shard scans and hashes its own files in parallel
+            file_list = self.SHARDS.scan()
+            scanner = self.SHARDS
+        else:
+            scanner = FileScanner(self.IGNORE, self.FADVISE, FileCommitter.TEMP_SUFFIX, cache=self.CACHE)
+            for root, file, file_md5, file_size in scanner.scan(self.LOCAL_FOLDER):
+                file_list.add(root, file, file_md5, file_size)
+                if log_files:
+                    FILE_LOG.debug('File %s', [root, file, file_md5.hex()])
+        # Record how long the scan took and how quickly the files were hashed
+        scan_seconds = time.perf_counter() - scan_start
+        hashed_bytes = scanner.HASHED_BYTES
+        self.METRICS.observe('scan_seconds', scan_seconds)
+        self.METRICS.inc('scanned_files_total', len(file_list))
+        self.METRICS.inc('cached_files_total', scanner.CACHED_FILES)
+        self.METRICS.inc('hashed_bytes_total', hashed_bytes)
+        if scan_seconds > 0:
+            self.METRICS.set('hash_bytes_per_second', hashed_bytes / scan_seconds)
+        self.SUMMARY['last_scan_seconds'] = scan_seconds
         return file_list
 
     def run(self):
         """
         The main run loop of the ServerSync class that is used to monitor the socket for connections and receiving the
         data from said connection and processing the messages received and acting upon them
+        Clients that open a session stay connected between syncs, so the loop watches the listening socket and every
+        connected client at once, replying to heartbeats and closing sessions that have gone quiet
         """
+        # Read in the current file list on server
+        self.CURRENT_FILE_LIST = self.read_local_storage()
+        # Allow the socket to receive connections
+        self.SELECTOR.register(self.SOCKET, selectors.EVENT_READ)
         while True:
-            # Read in the current file list on server
-            self.CURRENT_FILE_LIST = self.read_local_storage()
-            # Allow the socket to receive connections
-            client, address = self.SOCKET.accept()
-            print('SS: Connection:', address)
-
-            # Initialise variables to indicate whether we are at the start of the message <message_start> and
-            # therefore need to process the header value to find the total length of the message and <message_total>
-            # is initialised in readiness for holding the full message
-            message_start = True
-            message_total = b""
+            # Messages read while answering heartbeats are held on the connection, only wait if there are none
+            pending = any(connection.PENDING for connection in self.connections())
+            for key, mask in self.SELECTOR.select(timeout=0 if pending else self.HEARTBEAT):
+                if key.fileobj is self.SOCKET:
+                    self.accept_connection()
+                elif key.fileobj.fileno() != -1:
+                    # Only read from connections that have not been closed while processing earlier events
+                    self.receive_messages(key.data)
+            # Process any messages that arrived from other clients while a sync was running
+            for connection in self.connections():
+                while connection.PENDING != [] and connection.SOCKET.fileno() != -1:
+                    self.process_message(connection, connection.PENDING.pop(0))
+            self.expire_sessions()
 
-            while True:
-                # Receive the data
-                data = client.recv(1024)
-                if data != b"":
-                    if message_start:
-                        message_length = int(data[:self.HEADER])
-                        print("SS: New message received - Length:", message_length)
-                        # Received the start of a message and have it's length so no longer need to set the message
-                        # length until will start receiving the next message
-                        message_start = False
-
-                    # Add additional data received to the existing message we are processing
-                    message_total += data
-
-                    # if the length of all the data recieved matches that which was specified in the header then we have
-                    # a complete message
-                    if len(message_total) - self.HEADER == message_length:
-                        # The full message has now been received
-                        # Load the data in using pickle
-                        message_to_process = pickle.loads(message_total[self.HEADER:])
-                        print('SS: RCVD:', message_to_process)
-
-                        # Reset the flag for a new message and clear the full message as not needed from now
-                        message_start = True
-                        message_total = b""
-
-                        # Load in the message type which is the first string in the message and defines what the
-                        # purpose of the message is, essentially a command
-                        message_type = str(message_to_process).split(':')[0]
-                        # Load in the message data which is to be used by the command
-                        message_data = str(message_to_process).split(':')[1]
-
-                        if message_type == 'filelist':
-                            # A filelist message has been received, this gives details of the clients current file list
-                            # which can tthen be used for comparison against the servers file list
-                            self.process_file_list_message(message_data)
-
-                            # Check whether there are any files that need requesting from the client
-                            if self.REQUEST_FILE_LIST != []:
-                                for req_file in self.REQUEST_FILE_LIST:
-                                    # For each file generate a filerequest message to send to client and initiate the
-                                    # FileServer class to receive the file data
-                                    data = 'filerequest:' + str([req_file])
-                                    print('SS: SEND:', data)
-                                    message = pickle.dumps(data)
-                                    message = bytes(f"{len(message):<{self.HEADER}}", 'utf-8') + message
-                                    client.send(message)
-                                    FileServer().receive_file(req_file[1], self.LOCAL_FOLDER)
-
-                            # Finished processing the files to request from the client, so clear out the request list
-                            self.REQUEST_FILE_LIST = []
-                            # Send a sync:done message to the client to close down the current dialogue with the client
-                            data = 'sync:done'
-                            print('SS: SEND:', data)
-                            message = pickle.dumps(data)
-                            message = bytes(f"{len(message):<{self.HEADER}}", 'utf-8') + message
-                            client.send(message)
-
-                            # Shutdown the current client connection
-                            client.shutdown(socket.SHUT_RDWR)
-                            # Break out of the current loop and wait for next connection from client
-                            break
+    def connections(self):
+        """
+        :return: List of the connected clients
+        """
+        return [key.data for key in self.SELECTOR.get_map().values() if key.data is not None]
+
+    def accept_connection(self):
+        """
+        Accept a new client connection and start watching it for messages
+        """
+        client, address = self.SOCKET.accept()
+        SERVER_LOG.info('Connection: %s', address)
+        if client.family != socket.AF_UNIX:
+            # Have TCP keep the connection alive while a session sits idle between syncs
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if self.NODELAY:
+                client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.SELECTOR.register(client, selectors.EVENT_READ, ClientConnection(client, address))
+
+    def close_connection(self, connection):
+        """
+        Stop watching a client connection and close it
+        :param connection: The SyncConnection to close
+        """
+        SERVER_LOG.info('Closing connection: %s', connection.ADDRESS)
+        self.SELECTOR.unregister(connection.SOCKET)
+        connection.close()
+
+    def receive_messages(self, connection):
+        """
+        Read the data waiting from a client and process any complete messages
+        :param connection: The SyncConnection with data waiting
+        """
+        try:
+            messages = connection.receive()
+        except OSError:
+            messages = None
+        if messages is None:
+            # The client has gone away
+            self.close_connection(connection)
+            return
+        for message in messages:
+            if connection.SOCKET.fileno() == -1:
+                break
+            self.process_message(connection, message)
+
+    def poll_sessions(self, active):
+        """
+        Called between files while a sync is running, reads any data waiting from the other clients so their heartbeats
+        are answered. Any other messages are held until the sync has finished
+        :param active: The SyncConnection the sync is running for, or None when no sync is running
+        """
+        for key, mask in self.SELECTOR.select(timeout=0):
+            connection = key.data
+            if connection is None or connection is active:
+                continue
+            try:
+                messages = connection.receive()
+            except OSError:
+                messages = None
+            if messages is None:
+                self.close_connection(connection)
+                continue
+            for message in messages:
+                if str(message).split(':')[0] == 'heartbeat':
+                    self.process_message(connection, message)
+                else:
+                    connection.PENDING.append(message)
+
+    def expire_sessions(self):
+        """
+        Close any idle session that has not been heard from, the client heartbeats while idle so a session that is
+        quiet for several heartbeat intervals has been lost. Anything already waiting is read first so a session is not
+        closed just because the server was busy with a sync
+        """
+        self.poll_sessions(None)
+        for connection in self.connections():
+            if connection.SESSION and time.monotonic() - connection.LAST_SEEN > self.HEARTBEAT * 3:
+                SERVER_LOG.warning('Session timed out: %s', connection.ADDRESS)
+                self.close_connection(connection)
+
+    def notify_ready(self):
+        """
+        Push a ready message to every session, letting the clients know the server has rescanned and can take their
+        next sync
+        """
+        for connection in self.connections():
+            if connection.SESSION:
+                try:
+                    connection.send('ready:')
+                except OSError:
+                    self.close_connection(connection)
+
+    def process_message(self, connection, message_to_process):
+        """
+        Act upon a complete message from a client
+        :param connection: The SyncConnection the message came from
+        :param message_to_process: The message received
+        """
+        SERVER_LOG.debug('RCVD: %.200s', message_to_process)
+        # Load in the message type which is the first string in the message and defines what the purpose of the
+        # message is, essentially a command
+        message_type = str(message_to_process).split(':')[0]
+        # Load in the message data which is to be used by the command
+        message_data = str(message_to_process).split(':')[1]
+
+        try:
+            if message_type == 'session':
+                # The client wants to stay connected between syncs, the file list is current so it can start straight
+                # away
+                connection.SESSION = True
+                connection.send('ready:')
+            elif message_type == 'heartbeat':
+                # Echo the heartbeat back so the client knows the server is still there
+                connection.send('heartbeat:' + message_data)
+            elif message_type == 'root':
+                # The top of the client's folder, the roots in its file list are below it
+                connection.ROOT = base64.b64decode(message_data).decode()
+            elif message_type == 'ignore':
+                # The client's ignore rules, files they match are left alone in the sync that follows
+                connection.IGNORE = SyncIgnore(base64.b64decode(message_data).decode().splitlines())
+            elif message_type == 'sparse':
+                # The client can send files as extents, leaving out their holes, so they are asked for that way
+                connection.SPARSE = True
+            elif message_type == 'tune':
+                # The client's measurements of the link, used to size the receive buffers for its files
+                connection.TUNER = LinkTuner.decode(message_data)
+            elif message_type == 'filelist':
+                # A filelist message has been received, this gives details of the clients current file list
+                # which can tthen be used for comparison against the servers file list
+                with self.PROFILER.cycle():
+                    self.sync(connection, message_data)
+        except OSError as error:
+            # The client went away while being answered, a sync that lost it has already closed the connection
+            SERVER_LOG.warning('Connection lost: %s: %s', connection.ADDRESS, error)
+            if connection.SOCKET.fileno() != -1:
+                self.close_connection(connection)
+
+    def sync(self, connection, message_data):
+        """
+        Run a sync for a client: compare its file list with the local one, bring the local storage in line by
+        requesting the files that are missing or different and tell the client when the sync is done
+        :param connection: The SyncConnection the file list came from
+        :param message_data: The message data of the filelist message
+        """
+        SERVER_LOG.info('Sync started: %s', connection.ADDRESS)
+        sync_start = time.perf_counter()
+        self.SUMMARY = {'time': time.time(), 'client': str(connection.ADDRESS),
+                        'scan_seconds': self.SUMMARY.get('last_scan_seconds', 0)}
+        self.CLIENT_IGNORE = connection.IGNORE
+        self.CLIENT_ROOT = connection.ROOT
+        self.process_file_list_message(message_data)
+        # Journal the plan so a restart can pick up from the files already received
+        if self.JOURNAL is not None:
+            self.JOURNAL.start(self.LOCAL_FOLDER, self.REQUEST_FILE_LIST)
+        # Pass the client's file list on to any downstream servers, they request files as the relay receives them
+        if self.DOWNSTREAM:
+            self.RELAY.expect(os.path.join(self.LOCAL_FOLDER, req_file[1]) for req_file in self.REQUEST_FILE_LIST)
+            for downstream in self.DOWNSTREAM:
+                downstream.start(connection.ROOT, connection.IGNORE.RULES, message_data)
+        transfer_start = time.perf_counter()
+        received = []
+        failed = []
+        lost = None
+        buffer_size = 0
+        if connection.TUNER is not None:
+            buffer_size = connection.TUNER.buffer_size('tcp_rmem')
+            self.record_tuning(connection.TUNER, buffer_size)
+
+        # Check whether there are any files that need requesting from the client
+        if self.REQUEST_FILE_LIST != []:
+            self.SCHEDULER.start(self.REQUEST_FILE_LIST)
+            # Listen for the file data for the whole sync, so the client's connection for each file is queued by the
+            # kernel rather than refused while the filerequest is on its way
+            if self.UNIX_SOCKET:
+                listener = FileServer().listen_descriptor(self.UNIX_SOCKET + '.data')
+            else:
+                listener = FileServer().listen(self.DATA_PORT, buffer_size)
+            with listener:
+                for req_file in self.REQUEST_FILE_LIST:
+                    # For each file generate a filerequest message to send to client and receive the file data
+                    # Make sure the old copy of the file has been deleted before the new one is received
+                    self.LOCAL_OPS.wait_for(os.path.join(self.LOCAL_FOLDER, req_file[1]))
+                    data = 'filerequest:' + str([req_file[:3]] + (['extents'] if connection.SPARSE else []))
+                    FILE_LOG.debug('SEND: %s', data)
+                    try:
+                        connection.send(data)
+                    except OSError as error:
+                        # The client has gone, the files not yet received are requested by its next sync
+                        lost = error
+                        break
+                    file_start = time.perf_counter()
+                    try:
+                        self.receive_file(connection, req_file, buffer_size, listener)
+                    except OSError as error:
+                        # Lost part way, the file is left out and requested again by the next sync
+                        SERVER_LOG.warning('File not received: %s: %s', req_file[1], error)
+                        failed.append(req_file[1])
+                    else:
+                        received.append(req_file)
+                        # A shard receives the file after it has been handed over, it reports the time it took and
+                        # any file it lost part way with the flush
+                        if self.SHARDS is None:
+                            self.METRICS.observe('file_transfer_seconds', time.perf_counter() - file_start)
+                            self.METRICS.inc('files_transferred_total')
+                            self.METRICS.inc('bytes_transferred_total', req_file[3])
+                    # Report how much is left to transfer
+                    self.SCHEDULER.complete(req_file)
+                    self.log_progress(req_file is self.REQUEST_FILE_LIST[-1])
+                    # Keep any other sessions alive while the files are being received
+                    self.poll_sessions(connection)
+
+        # Finished processing the files to request from the client, so clear out the request list
+        # and wait for the writer to commit everything received before reporting the sync done
+        if self.DOWNSTREAM and (failed or lost is not None):
+            received_files = set(req_file[1] for req_file in received)
+            self.RELAY.abandon(os.path.join(self.LOCAL_FOLDER, req_file[1]) for req_file in self.REQUEST_FILE_LIST
+                               if req_file[1] not in received_files)
+        self.REQUEST_FILE_LIST = []
+        self.LOCAL_OPS.join()
+        self.SUMMARY['local_ops_seconds'] = max(0, self.LOCAL_OPS.FINISHED - self.LOCAL_OPS_START)
+        self.METRICS.observe('local_ops_seconds', self.SUMMARY['local_ops_seconds'])
+        rejected = self.WRITER.flush()
+        if self.SHARDS is not None:
+            rejected += self.SHARDS.flush()
+            failed += self.SHARDS.FAILED
+            shard_failed = set(self.SHARDS.FAILED)
+            received = [req_file for req_file in received if req_file[1] not in shard_failed]
+            for seconds in self.SHARDS.TRANSFER_SECONDS:
+                self.METRICS.observe('file_transfer_seconds', seconds)
+            self.METRICS.inc('files_transferred_total', len(received))
+            self.METRICS.inc('bytes_transferred_total', sum(req_file[3] for req_file in received))
+        if rejected:
+            SERVER_LOG.warning('Files rejected as they did not match their md5: %d, they will be requested again',
+                               len(rejected))
+        if failed:
+            SERVER_LOG.warning('Files lost part way: %d, they will be requested again', len(failed))
+        self.SUMMARY['files_transferred'] = len(received)
+        self.SUMMARY['bytes_transferred'] = sum(req_file[3] for req_file in received)
+        self.SUMMARY['files_rejected'] = len(rejected)
+        self.SUMMARY['files_failed'] = len(failed)
+        self.METRICS.inc('rejected_files_total', len(rejected))
+        self.METRICS.inc('failed_files_total', len(failed))
+        if self.JOURNAL is not None:
+            # The journal is only done with once every file has arrived, otherwise it is kept for a restart
+            if lost is None and not failed and not rejected:
+                self.JOURNAL.finish()
+            else:
+                self.JOURNAL.close()
+        self.SUMMARY['transfer_seconds'] = time.perf_counter() - transfer_start
+        self.SUMMARY['sync_seconds'] = time.perf_counter() - sync_start
+        self.METRICS.inc('syncs_total')
+        self.METRICS.observe('sync_seconds', self.SUMMARY['sync_seconds'])
+        self.write_summary()
+        if lost is None:
+            # Send a sync:done message to the client to close down the current dialogue with the client
+            data = 'sync:done'
+            SERVER_LOG.debug('SEND: %s', data)
+            try:
+                connection.send(data)
+            except OSError as error:
+                lost = error
+        if lost is not None:
+            SERVER_LOG.warning('Connection lost during sync: %s: %s', connection.ADDRESS, lost)
+            self.close_connection(connection)
+        elif not connection.SESSION:
+            # Shutdown the current client connection, the client may already have closed its end
+            try:
+                connection.SOCKET.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.close_connection(connection)
+        if self.DOWNSTREAM:
+            self.join_downstream()
+        # Read in the updated file list on server and let the sessions know the server is ready for them
+        self.CURRENT_FILE_LIST = self.read_local_storage()
+        self.notify_ready()
+
+    def receive_file(self, connection, req_file, buffer_size, listener):
+        """
+        Receive a file requested from the client, over the local transport or TCP and by the shard that owns the file
+        when the server is sharded
+        :param connection: The ClientConnection the file was requested over
+        :param req_file: The entry of the file in REQUEST_FILE_LIST
+        :param buffer_size: The receive buffer set for the client's files, 0 when left to the kernel
+        :param listener: The socket listening for the file data
+        """
+        digest = bytes.fromhex(req_file[2])
+        data_path = self.UNIX_SOCKET + '.data'
+        if self.SHARDS is not None and self.UNIX_SOCKET:
+            # The shard owning the file receives it while the next file is requested
+            self.SHARDS.receive_descriptor(req_file[1], data_path, digest, listener)
+        elif self.SHARDS is not None:
+            self.SHARDS.receive_file(req_file[1], self.DATA_PORT, buffer_size, connection.SPARSE, digest, listener)
+        elif self.UNIX_SOCKET:
+            FileServer().receive_descriptor(req_file[1], self.LOCAL_FOLDER, self.WRITER, data_path, digest, listener)
+        else:
+            FileServer().receive_file(req_file[1], self.LOCAL_FOLDER, self.WRITER, self.SCHEDULER.limiter(req_file),
+                                      self.DATA_PORT, buffer_size, connection.SPARSE, digest, listener)
+
+    def record_tuning(self, tuner, buffer_size):
+        """
+        Add the client's link measurements and the receive buffer chosen from them to the summary and metrics
+        :param tuner: The LinkTuner holding the client's measurements
+        :param buffer_size: The receive buffer set for the client's files, 0 when left to the kernel
+        """
+        self.SUMMARY['rtt_seconds'] = tuner.RTT
+        self.SUMMARY['link_bytes_per_second'] = tuner.RATE
+        self.SUMMARY['socket_buffer'] = buffer_size
+        self.METRICS.set('link_rtt_seconds', tuner.RTT)
+        self.METRICS.set('link_bytes_per_second', tuner.RATE)
+        self.METRICS.set('socket_buffer_bytes', buffer_size)
+
+    def join_downstream(self):
+        """
+        Wait for the downstream servers to finish the sync relayed to them
+        """
+        relay_start = time.perf_counter()
+        failed = [downstream for downstream in self.DOWNSTREAM if downstream.join() is not None]
+        self.RELAY.clear()
+        self.METRICS.observe('relay_wait_seconds', time.perf_counter() - relay_start)
+        self.METRICS.inc('relay_failures_total', len(failed))
+        SERVER_LOG.info('Relayed to %d of %d downstream servers', len(self.DOWNSTREAM) - len(failed),
+                        len(self.DOWNSTREAM))
+
+    def log_progress(self, final=False):
+        """
+        Update the progress metrics and log the files and bytes still to transfer and the estimated time until the
+        transfers complete. The log is only written every PROGRESS_INTERVAL seconds and for the final file
+        :param final: Whether the last file has been transferred
+        """
+        progress = self.SCHEDULER.progress()
+        eta = progress['eta_seconds']
+        self.METRICS.set('transfer_files_remaining', progress['files_remaining'])
+        self.METRICS.set('transfer_bytes_remaining', progress['bytes_remaining'])
+        self.METRICS.set('transfer_eta_seconds', 0 if eta is None else eta)
+        if final or time.monotonic() - self.LAST_PROGRESS >= self.PROGRESS_INTERVAL:
+            self.LAST_PROGRESS = time.monotonic()
+            SERVER_LOG.info('Progress: %d files %d bytes remaining at %d bytes/s ETA %s',
+                            progress['files_remaining'], progress['bytes_remaining'],
+                            progress['bytes_per_second'], 'unknown' if eta is None else str(round(eta)) + 's')
 
     def process_file_list_message(self, data):
         """
-        Take in the data from the filelist message which is a string, convert it into a list, print the details and
+        Take in the data from the filelist message which is a string, convert it into a FileTable, print the details and
         go on to compare the list with the servers file list
         :param data: message data received from the filelist message
         """
-        # Load the message data into a list object (converts string to list)
-        file_list = ast.literal_eval(data)
-        print('SS: Client file list')
-        for file in file_list:
-            print('SS: File', file)
+        # Load the message data into a FileTable object (unpacks the encoded table)
+        file_list = FileTable.decode(data)
+        SERVER_LOG.info('Client file list: %d files', len(file_list))
+        if FILE_LOG.isEnabledFor(logging.DEBUG):
+            for file in file_list:
+                FILE_LOG.debug('Client file %s', file)
         # Compare the client file list with the server file list
         self.compare_client_files_with_local(file_list)
 
     def compare_client_files_with_local(self, files):
         """
-        Take the file list from the client and compare against the file list the server current has.
+        Take the file table from the client and compare against the file table the server current has.
         Find any missing files (by file name)
         Find any deletable files (by file name)
         Find any to update (if the file name matches but not the md5)
         Find any files that are missing on the server but there is already a file on the server with matching md5
         so we can copy that file locally and rename it to avoid transferring unnecessary data
-        :param files: The client file list to process
+        :param files: The client FileTable to process
         """
+        diff_start = time.perf_counter()
         # Initialise the list to store lists of file with different files requiring actions
         files_to_get = []
         files_to_delete = []
         files_to_duplicate = []
 
+        # Look up every client file in the server table by name and by md5, each lookup is a single pass over the
+        # tables rather than a scan of the server files per client file
+        name_matches = self.CURRENT_FILE_LIST.find_names(files)
+        digest_matches = self.CURRENT_FILE_LIST.find_digests(files)
+
         # Check for files to add or update or copy/rename locally, working through the list of files from the client
         # first
-        for client_file in files:
-            found = False
-            # For the file from the client, go through each server file and see if we have a match
-            for server_file in self.CURRENT_FILE_LIST:
-                if client_file[1] == server_file[1]:
-                    # Found a matching file on the server with name
-                    found = True
-                    # Check the md5 for the file so see if they differ
-                    if client_file[2] != server_file[2]:
-                        # The md5 do not match for the two files so need a new copy from the client
-                        # Delete the server copy of the file
-                        files_to_delete.append(server_file)
-                        # Request a new copy from the client
-                        files_to_get.append(client_file)
-                    # We found a match in the server file list so break out to avoid going through entire server files
-                    break
-
-            # If a matching file has not been found in the server list check through server list for a file with
-            # match md5 which can be copied and renamed locally, if this can't be done then request file from the client
-            if not found:
-                for file in self.CURRENT_FILE_LIST:
-                    found = False
-                    # Check for matching md5 of client file locally
-                    if client_file[2] == file[2]:
-                        # Found a file with matching md5 so can be copied/renamed locally
-                        files_to_duplicate.append([file[1], client_file[1]])
-                        found = True
-                        break
+        for index in range(len(files)):
+            # Never request a file the server's own rules leave out, it would be left out of the next scan and
+            # requested again every sync
+            if self.IGNORE and self.IGNORE.ignored_path(self.client_path(files, index)):
+                continue
+            server_index = name_matches[index]
+            if server_index != -1:
+                # Found a matching file on the server with name, check the md5 for the file so see if they differ
+                if files.digest(index) != self.CURRENT_FILE_LIST.digest(server_index):
+                    # The md5 do not match for the two files so need a new copy from the client
+                    # Delete the server copy of the file
+                    files_to_delete.append(self.CURRENT_FILE_LIST.entry(server_index))
+                    # Request a new copy from the client
+                    files_to_get.append(files.entry(index) + [files.size(index)])
+            elif digest_matches[index] != -1:
+                # Found a file with matching md5 so can be copied/renamed locally
+                files_to_duplicate.append([self.CURRENT_FILE_LIST.name(digest_matches[index]), files.name(index)])
+            else:
                 # If no matching file found on server by md5 then request file from client
-                if not found:
-                    files_to_get.append(client_file)
+                files_to_get.append(files.entry(index) + [files.size(index)])
 
         # Go through each file on the server and find match in client list, if not found then the server file needs to
         # be deleted
-        for server_file in self.CURRENT_FILE_LIST:
-            found = False
-            for client_file in files:
-                if client_file[1] == server_file[1]:
-                    # Found a client file that matches the server so keep the file
-                    found = True
-                    break
-            if not found:
+        client_matches = files.find_names(self.CURRENT_FILE_LIST)
+        for server_index in range(len(self.CURRENT_FILE_LIST)):
+            if client_matches[server_index] == -1 and not self.client_ignored(server_index):
                 # No match found on the client so we can delete the server file
-                files_to_delete.append(server_file)
+                files_to_delete.append(self.CURRENT_FILE_LIST.entry(server_index))
+
+        # The lookups are only needed for the comparison so free them up
+        files.release_lookups()
+        self.CURRENT_FILE_LIST.release_lookups()
+        self.SUMMARY['client_files'] = len(files)
+        self.SUMMARY['diff_seconds'] = time.perf_counter() - diff_start
+        self.METRICS.observe('diff_seconds', self.SUMMARY['diff_seconds'])
         # Perform the updates on the server file system
         self.update(files_to_get, files_to_delete, files_to_duplicate)
 
+    def client_path(self, files, index):
+        """
+        :param files: The client FileTable
+        :param index: The index of a file in the client's table
+        :return: The path of the file relative to the top of the client's folder, separated by /, or just its name for
+        a client that did not send its root
+        """
+        if not self.CLIENT_ROOT:
+            return files.name(index)
+        path = os.path.relpath(os.path.join(files.root(index), files.name(index)), self.CLIENT_ROOT)
+        return path.replace(os.sep, '/')
+
+    def client_ignored(self, server_index):
+        """
+        :param server_index: The index of a file in the server's table
+        :return: Whether the client's ignore rules leave the file out of the sync, so it is kept even though the client
+        did not list it
+        """
+        if not self.CLIENT_IGNORE:
+            return False
+        root, name = self.CURRENT_FILE_LIST.entry(server_index)[:2]
+        path = os.path.relpath(os.path.join(root, name), self.LOCAL_FOLDER).replace(os.sep, '/')
+        return self.CLIENT_IGNORE.ignored_path(path)
+
     def update(self, get_files, delete_files, copy_rename_files):
         """
-        Update the file system on the server, firstly we perform the copy and rename of files local to the server.
-        This step is performed first in case the file we are copying is due to be deleted in a later step.
-        Then any files that are no longer needed are deleted.
+        Update the file system on the server, firstly we queue the copy and rename of files local to the server.
+        These are queued first in case the file we are copying is due to be deleted in a later step.
+        Then any files that are no longer needed are queued for deletion. The operations run on the LOCAL_OPS pool
+        while the transfers start, sync() waits for them to finish before reporting the sync done.
         Finally the global REQUEST_FILE_LIST is updated with any files the server needs from the client, which is used
-        in run() to send requests
+        in sync() to send requests
         :param get_files: List of files to request from the client
         :param delete_files: List of files to delete from the server
         :param copy_rename_files: List of files to locally copy and rename on the server
         """
-        # Copy and rename any files the server has locally
+        self.LOCAL_OPS_START = time.perf_counter()
+        # Queue the copy and rename of any files the server has locally, the copies run on the pool of workers
         for file in copy_rename_files:
-            print('SS: Copying file: ' + file[0] + ' and renaming to ' + file[1])
-            shutil.copy(os.path.join(self.LOCAL_FOLDER, file[0]), os.path.join(self.LOCAL_FOLDER, file[1]))
+            self.LOCAL_OPS.copy(os.path.join(self.LOCAL_FOLDER, file[0]), os.path.join(self.LOCAL_FOLDER, file[1]))
 
-        # Delete any files no longer present on client
+        # Queue the delete of any files no longer present on client, each waits for any copies of the file
         for file in delete_files:
-            print('SS: Deleting file:', file)
-            os.remove(os.path.join(file[0], file[1]))
+            self.LOCAL_OPS.delete(os.path.join(file[0], file[1]))
+
+        self.METRICS.inc('local_copies_total', len(copy_rename_files))
+        self.METRICS.inc('deletes_total', len(delete_files))
+        self.SUMMARY['local_copies'] = len(copy_rename_files)
+        self.SUMMARY['deletes'] = len(delete_files)
 
-        # Update the global REQUEST_FILE_LIST with files required from client
-        self.REQUEST_FILE_LIST = get_files
+        # Update the global REQUEST_FILE_LIST with files required from client, in the order the scheduler wants them
+        self.REQUEST_FILE_LIST = self.SCHEDULER.order(get_files)
 
 
 if __name__ == '__main__':
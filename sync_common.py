@@ -0,0 +1,1147 @@
+import time
+import sys
+import os
+import socket
+import errno
+import re
+import hashlib
+import mmap
+import pickle
+import struct
+import base64
+import logging
+import threading
+import contextlib
+import random
+import cProfile
+import tracemalloc
+from array import array
+
+
+class FileEventFilter(logging.Filter):
+    """
+    FileEventFilter class:
+    Thins out per-file log events so large trees do not spend their time writing to the log. Events can be sampled,
+    keeping one in every SAMPLE, and rate limited, keeping at most RATE a second. The filter is attached to the per-file
+    loggers only so events about the sync as a whole are always logged.
+    """
+
+    def __init__(self, sample=1, rate=0):
+        """
+        Initialise the filter
+        :param sample: Keep one in every sample events, 1 keeps them all
+        :param rate: Keep at most this many events a second, 0 for no limit
+        """
+        super().__init__()
+        self.SAMPLE = max(1, sample)
+        self.RATE = rate
+        self.COUNT = 0
+        self.WINDOW = 0
+        self.WINDOW_COUNT = 0
+
+    def filter(self, record):
+        """
+        :param record: The log record
+        :return: Whether the record should be logged
+        """
+        self.COUNT += 1
+        if self.COUNT % self.SAMPLE != 0:
+            return False
+        if self.RATE:
+            window = int(time.monotonic())
+            if window != self.WINDOW:
+                self.WINDOW = window
+                self.WINDOW_COUNT = 0
+            self.WINDOW_COUNT += 1
+            if self.WINDOW_COUNT > self.RATE:
+                return False
+        return True
+
+    @staticmethod
+    def configure_logging(arguments, file_loggers):
+        """
+        Send the log to stdout at the level given on the command line, with the per-file loggers thinned out by a
+        FileEventFilter
+        :param arguments: The parsed command line arguments
+        :param file_loggers: The loggers used for per-file events
+        """
+        logging.basicConfig(stream=sys.stdout, level=getattr(logging, arguments.log_level),
+                            format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+        event_filter = FileEventFilter(arguments.log_sample, arguments.log_rate)
+        for logger in file_loggers:
+            for old_filter in [f for f in logger.filters if isinstance(f, FileEventFilter)]:
+                logger.removeFilter(old_filter)
+            logger.addFilter(event_filter)
+
+    @staticmethod
+    def add_arguments(parser):
+        """
+        Add the logging options to a command line parser
+        :param parser: The ArgumentParser to add the options to
+        """
+        parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO',
+                            help='Only log events at this level or above, per-file events are logged at DEBUG '
+                                 '(default: INFO)')
+        parser.add_argument('--log-sample', type=int, default=1, metavar='N',
+                            help='Only log one in every N per-file events (default: 1, log them all)')
+        parser.add_argument('--log-rate', type=int, default=0, metavar='N',
+                            help='Log at most N per-file events a second (default: 0, no limit)')
+
+
+class FileTable:
+    """
+    FileTable class:
+    A compact store for a file list. Rather than holding a list of [root, name, md5] lists, where every entry repeats
+    the full root directory string and carries a 32 character hex md5, the table keeps:
+    * Each directory once, with every entry holding a small integer directory id
+    * Every file name packed into a single string table with an offsets array
+    * Raw 16 byte md5 digests packed into one contiguous bytearray
+    * The size of each file in an array of integers
+
+    Entries are addressed by index and are handed out in the original [root, name, md5] form on demand, so messages
+    and log output keep the same format.
+    """
+
+    DIGEST_SIZE = 16
+    ENCODING = 'utf-8'
+    ERRORS = 'surrogateescape'
+    # Packed header: directory count, entry count, directory table length, name table length
+    HEADER_FORMAT = '<4Q'
+
+    def __init__(self):
+        """
+        Initialise an empty table
+        """
+        self.DIRECTORIES = []
+        self.DIRECTORY_IDS = {}
+        self.DIRECTORY_INDEX = array('I')
+        self.NAMES = bytearray()
+        self.NAME_OFFSETS = array('Q', [0])
+        self.DIGESTS = bytearray()
+        self.SIZES = array('Q')
+        self.NAME_LOOKUP = None
+        self.DIGEST_LOOKUP = None
+
+    def __len__(self):
+        return len(self.DIRECTORY_INDEX)
+
+    def __iter__(self):
+        """
+        Iterate over the table returning each entry in the [root, name, md5] form
+        """
+        for index in range(len(self)):
+            yield self.entry(index)
+
+    def add(self, root, name, digest, size=0):
+        """
+        Add a file to the table, interning the root directory so it is only ever stored once
+        :param root: The directory the file is held in
+        :param name: The file name including extension
+        :param digest: The raw 16 byte md5 digest of the file
+        :param size: The size of the file in bytes
+        :return: The index of the new entry
+        """
+        directory_id = self.DIRECTORY_IDS.get(root)
+        if directory_id is None:
+            directory_id = len(self.DIRECTORIES)
+            self.DIRECTORIES.append(root)
+            self.DIRECTORY_IDS[root] = directory_id
+        index = len(self)
+        self.DIRECTORY_INDEX.append(directory_id)
+        self.NAMES += name.encode(self.ENCODING, self.ERRORS)
+        self.NAME_OFFSETS.append(len(self.NAMES))
+        self.DIGESTS += digest
+        self.SIZES.append(size)
+        # Any lookups built so far no longer cover the table
+        self.NAME_LOOKUP = None
+        self.DIGEST_LOOKUP = None
+        return index
+
+    def extend(self, other):
+        """
+        Add every entry of another table to the end of this one, used to merge the tables scanned by the shards
+        :param other: The FileTable to add
+        """
+        for index in range(len(other)):
+            self.add(other.root(index), other.name(index), other.digest(index), other.size(index))
+
+    def root(self, index):
+        """
+        :param index: Index of the entry
+        :return: The root directory of the entry
+        """
+        return self.DIRECTORIES[self.DIRECTORY_INDEX[index]]
+
+    def name(self, index):
+        """
+        :param index: Index of the entry
+        :return: The file name of the entry
+        """
+        return self.NAMES[self.NAME_OFFSETS[index]:self.NAME_OFFSETS[index + 1]].decode(self.ENCODING, self.ERRORS)
+
+    def digest(self, index):
+        """
+        :param index: Index of the entry
+        :return: The raw 16 byte md5 of the entry
+        """
+        start = index * self.DIGEST_SIZE
+        return bytes(self.DIGESTS[start:start + self.DIGEST_SIZE])
+
+    def size(self, index):
+        """
+        :param index: Index of the entry
+        :return: The size of the entry in bytes
+        """
+        return self.SIZES[index]
+
+    def hexdigest(self, index):
+        """
+        :param index: Index of the entry
+        :return: The md5 of the entry as a hex string
+        """
+        return self.digest(index).hex()
+
+    def entry(self, index):
+        """
+        :param index: Index of the entry
+        :return: The entry in the [root, name, md5] form used in messages
+        """
+        return [self.root(index), self.name(index), self.hexdigest(index)]
+
+    def name_lookup(self):
+        """
+        Build the name lookup in one pass if it is not already built, keeping the first entry for each name so matches
+        follow the walk order
+        :return: dict of encoded file name to entry index
+        """
+        if self.NAME_LOOKUP is None:
+            self.NAME_LOOKUP = {}
+            names = bytes(self.NAMES)
+            offsets = self.NAME_OFFSETS
+            for index in range(len(self)):
+                self.NAME_LOOKUP.setdefault(names[offsets[index]:offsets[index + 1]], index)
+        return self.NAME_LOOKUP
+
+    def digest_lookup(self):
+        """
+        Build the md5 lookup in one pass if it is not already built, keeping the first entry for each md5
+        :return: dict of raw md5 to entry index
+        """
+        if self.DIGEST_LOOKUP is None:
+            self.DIGEST_LOOKUP = {}
+            digests = bytes(self.DIGESTS)
+            size = self.DIGEST_SIZE
+            for index in range(len(self)):
+                self.DIGEST_LOOKUP.setdefault(digests[index * size:(index + 1) * size], index)
+        return self.DIGEST_LOOKUP
+
+    def find_name(self, name):
+        """
+        Find the first entry with the given file name
+        :param name: The file name to look for
+        :return: The index of the first matching entry or -1 if there is no match
+        """
+        return self.name_lookup().get(name.encode(self.ENCODING, self.ERRORS), -1)
+
+    def find_digest(self, digest):
+        """
+        Find the first entry with the given md5
+        :param digest: The raw 16 byte md5 to look for
+        :return: The index of the first matching entry or -1 if there is no match
+        """
+        return self.digest_lookup().get(bytes(digest), -1)
+
+    def find_names(self, other):
+        """
+        Look up every entry of another table by name in one pass
+        :param other: The FileTable whose names should be looked up in this table
+        :return: An array holding, for each entry in other, the index of the first entry here with the same name or -1
+        """
+        names = bytes(other.NAMES)
+        offsets = other.NAME_OFFSETS
+        lookup = self.name_lookup()
+        return array('q', (lookup.get(names[offsets[index]:offsets[index + 1]], -1) for index in range(len(other))))
+
+    def find_digests(self, other):
+        """
+        Look up every entry of another table by md5 in one pass
+        :param other: The FileTable whose md5s should be looked up in this table
+        :return: An array holding, for each entry in other, the index of the first entry here with the same md5 or -1
+        """
+        digests = bytes(other.DIGESTS)
+        size = self.DIGEST_SIZE
+        lookup = self.digest_lookup()
+        return array('q', (lookup.get(digests[index * size:(index + 1) * size], -1) for index in range(len(other))))
+
+    def release_lookups(self):
+        """
+        Drop the name and md5 lookups, they are rebuilt on the next find
+        """
+        self.NAME_LOOKUP = None
+        self.DIGEST_LOOKUP = None
+
+    def to_bytes(self):
+        """
+        Serialise the table into a single packed block of bytes for sending to the server
+        :return: bytes holding the table
+        """
+        directories = b'\0'.join(directory.encode(self.ENCODING, self.ERRORS) for directory in self.DIRECTORIES)
+        directory_index = array('I', self.DIRECTORY_INDEX)
+        name_offsets = array('Q', self.NAME_OFFSETS)
+        sizes = array('Q', self.SIZES)
+        if sys.byteorder == 'big':
+            directory_index.byteswap()
+            name_offsets.byteswap()
+            sizes.byteswap()
+        header = struct.pack(self.HEADER_FORMAT, len(self.DIRECTORIES), len(self), len(directories), len(self.NAMES))
+        return b''.join([header, directories, directory_index.tobytes(), name_offsets.tobytes(), self.NAMES,
+                         self.DIGESTS, sizes.tobytes()])
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Rebuild a table from the packed bytes created by to_bytes()
+        :param data: bytes holding the table
+        :return: FileTable
+        """
+        table = cls()
+        directory_count, entry_count, directories_length, names_length = struct.unpack_from(cls.HEADER_FORMAT, data)
+        position = struct.calcsize(cls.HEADER_FORMAT)
+        if directory_count:
+            table.DIRECTORIES = [directory.decode(cls.ENCODING, cls.ERRORS)
+                                 for directory in data[position:position + directories_length].split(b'\0')]
+        table.DIRECTORY_IDS = {directory: i for i, directory in enumerate(table.DIRECTORIES)}
+        position += directories_length
+        table.DIRECTORY_INDEX = array('I')
+        table.DIRECTORY_INDEX.frombytes(data[position:position + entry_count * table.DIRECTORY_INDEX.itemsize])
+        position += entry_count * table.DIRECTORY_INDEX.itemsize
+        table.NAME_OFFSETS = array('Q')
+        table.NAME_OFFSETS.frombytes(data[position:position + (entry_count + 1) * table.NAME_OFFSETS.itemsize])
+        position += (entry_count + 1) * table.NAME_OFFSETS.itemsize
+        table.NAMES = bytearray(data[position:position + names_length])
+        position += names_length
+        table.DIGESTS = bytearray(data[position:position + entry_count * cls.DIGEST_SIZE])
+        position += entry_count * cls.DIGEST_SIZE
+        table.SIZES = array('Q')
+        table.SIZES.frombytes(data[position:position + entry_count * table.SIZES.itemsize])
+        if sys.byteorder == 'big':
+            table.DIRECTORY_INDEX.byteswap()
+            table.NAME_OFFSETS.byteswap()
+            table.SIZES.byteswap()
+        return table
+
+    def encode(self):
+        """
+        :return: The table packed and base64 encoded so it can be carried as the data of a text message
+        """
+        return base64.b64encode(self.to_bytes()).decode('ascii')
+
+    @classmethod
+    def decode(cls, data):
+        """
+        :param data: The base64 string created by encode()
+        :return: FileTable
+        """
+        return cls.from_bytes(base64.b64decode(data))
+
+
+class SyncIgnore:
+    """
+    SyncIgnore class:
+    gitignore style rules for files and directories to leave out of the sync, read from a .syncignore file at the top
+    of the synced folder and any --ignore options. Each rule is matched against the path relative to the top of the
+    folder:
+    * blank lines and lines starting with # are skipped
+    * a rule ending in / only matches directories
+    * a rule with a / anywhere else is matched against the whole path, otherwise against the name at any depth
+    * * and ? match within a name and ** matches any number of directories
+    * a rule starting with ! includes again anything an earlier rule left out
+    The last rule to match a path decides whether it is ignored. Rules are compiled to regular expressions once, and an
+    ignored directory is pruned from the walk so nothing beneath it is listed or read.
+    """
+
+    FILE_NAME = '.syncignore'
+
+    def __init__(self, rules=()):
+        """
+        Compile the rules
+        :param rules: The lines of the rules
+        """
+        self.RULES = []
+        self.PATTERNS = []
+        for rule in rules:
+            rule = rule.rstrip()
+            if not rule or rule.startswith('#'):
+                continue
+            self.RULES.append(rule)
+            negate = rule.startswith('!')
+            if negate or rule.startswith('\\#') or rule.startswith('\\!'):
+                rule = rule[1:]
+            directory_only = rule.endswith('/')
+            rule = rule.rstrip('/')
+            if rule:
+                self.PATTERNS.append((self.translate(rule), negate, directory_only))
+        # Matched from the last rule back as the last match wins
+        self.PATTERNS.reverse()
+
+    def __bool__(self):
+        return bool(self.PATTERNS)
+
+    @staticmethod
+    def load(folder, extra_rules=()):
+        """
+        Read the rules from the .syncignore file at the top of a folder, if there is one, followed by any extra rules
+        :param folder: The folder being synced
+        :param extra_rules: Rules given on the command line
+        :return: The SyncIgnore
+        """
+        rules = []
+        try:
+            with open(os.path.join(folder, SyncIgnore.FILE_NAME)) as f:
+                rules = f.read().splitlines()
+        except FileNotFoundError:
+            pass
+        return SyncIgnore(rules + list(extra_rules))
+
+    @staticmethod
+    def translate(rule):
+        """
+        Convert a rule into a regular expression matching the paths it applies to
+        :param rule: The rule without any leading ! or trailing /
+        :return: The compiled regular expression
+        """
+        # A rule with a / in it is anchored to the top of the folder, otherwise it matches a name at any depth
+        regex = '' if '/' in rule else '(?:.*/)?'
+        rule = rule.lstrip('/')
+        i = 0
+        while i < len(rule):
+            if rule.startswith('**/', i):
+                regex += '(?:.*/)?'
+                i += 3
+            elif rule.startswith('**', i):
+                regex += '.*'
+                i += 2
+            elif rule[i] == '*':
+                regex += '[^/]*'
+                i += 1
+            elif rule[i] == '?':
+                regex += '[^/]'
+                i += 1
+            elif rule[i] == '[' and rule.find(']', i + 2) != -1:
+                end = rule.find(']', i + 2)
+                characters = rule[i + 1:end].replace('\\', '\\\\')
+                regex += '[' + ('^' + characters[1:] if characters.startswith('!') else characters) + ']'
+                i = end + 1
+            else:
+                regex += re.escape(rule[i])
+                i += 1
+        return re.compile(regex + r'\Z')
+
+    def ignored(self, path, directory=False):
+        """
+        :param path: The path relative to the top of the folder, separated by /
+        :param directory: Whether the path is a directory
+        :return: Whether the rules leave the path out of the sync
+        """
+        for pattern, negate, directory_only in self.PATTERNS:
+            if (directory or not directory_only) and pattern.match(path):
+                return not negate
+        return False
+
+    def ignored_path(self, path):
+        """
+        The version of ignored() for a file found without walking down to it, the directories above the file are checked
+        as well as the file itself
+        :param path: The path of the file relative to the top of the folder, separated by /
+        :return: Whether the rules leave the file out of the sync
+        """
+        parts = path.split('/')
+        for depth in range(1, len(parts)):
+            if self.ignored('/'.join(parts[:depth]), True):
+                return True
+        return self.ignored(path)
+
+
+class StatCache:
+    """
+    StatCache class:
+    Remembers the md5 of each file scanned along with the size, modification time and inode the file had, so a rescan
+    only hashes the files whose stat has changed. A file modified within RACY_SECONDS of being hashed is not cached, as
+    a change straight after the hash could leave its modification time as it was. The cache can be saved to a file so
+    it survives a restart as well.
+    """
+
+    RACY_SECONDS = 2
+
+    def __init__(self, path=''):
+        """
+        Initialise the cache, loading it from the file if one is given and has been saved before
+        :param path: The file the cache is saved to after each scan, not saved when not given
+        """
+        self.PATH = path
+        self.ENTRIES = {}
+        self.SCANNED = {}
+        self.CHANGED = False
+        if path and os.path.exists(path):
+            # A cache that cannot be read is rebuilt by the next scan
+            try:
+                with open(path, 'rb') as f:
+                    self.ENTRIES = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                self.ENTRIES = {}
+
+    @staticmethod
+    def key(stat):
+        """
+        :param stat: The os.stat_result of a file
+        :return: The parts of the stat that change when the file does
+        """
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def lookup(self, path, stat):
+        """
+        Find the md5 of a file, keeping the entry for the scan in progress
+        :param path: The path of the file
+        :param stat: The os.stat_result of the file
+        :return: The raw md5 of the file or None if the file is not cached or has changed
+        """
+        entry = self.ENTRIES.get(path)
+        if entry is None or entry[0] != self.key(stat):
+            return None
+        self.SCANNED[path] = entry
+        return entry[1]
+
+    def store(self, path, stat, digest):
+        """
+        Cache the md5 of a file just hashed by the scan in progress
+        :param path: The path of the file
+        :param stat: The os.stat_result of the file taken before it was hashed
+        :param digest: The raw md5 of the file
+        """
+        self.CHANGED = True
+        if time.time_ns() - stat.st_mtime_ns > self.RACY_SECONDS * 1000000000:
+            self.SCANNED[path] = (self.key(stat), digest)
+
+    def remember(self, path, stat, digest):
+        """
+        Cache the md5 of a file known without hashing it, for the next scan to find
+        :param path: The path of the file
+        :param stat: The os.stat_result of the file
+        :param digest: The raw md5 of the file
+        """
+        self.CHANGED = True
+        self.ENTRIES[path] = (self.key(stat), digest)
+
+    def finish(self):
+        """
+        End a scan, dropping the entries of files no longer found and saving the cache if it has changed
+        """
+        self.CHANGED = self.CHANGED or len(self.SCANNED) != len(self.ENTRIES)
+        self.ENTRIES, self.SCANNED = self.SCANNED, {}
+        if self.PATH and self.CHANGED:
+            temp_path = self.PATH + '.tmp'
+            with open(temp_path, 'wb') as f:
+                pickle.dump(self.ENTRIES, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.PATH)
+        self.CHANGED = False
+
+
+class FileScanner:
+    """
+    FileScanner class:
+    Walks a folder with os.scandir and hashes every file in it, in the same order os.walk would. The type of each entry
+    comes from the directory listing and its size from the entry's stat, files up to SMALL_FILE bytes are hashed from a
+    single read and larger files are read into one buffer reused for every file, so a scan makes as few system calls
+    per file as it can. With fadvise the kernel is told large files are read sequentially, for a deeper readahead, and
+    each file's pages are dropped from the page cache once it has been hashed so a full scan does not push everything
+    else out of the cache. Files of MMAP_THRESHOLD bytes or more are hashed straight from a memory mapping of the file,
+    saving the copy of every block into the buffer. Given a StatCache, files whose stat is unchanged since they were
+    last hashed are not read at all.
+    """
+
+    SMALL_FILE = 256 * 1024
+    BUFFER_SIZE = 1024 * 1024
+    MMAP_THRESHOLD = 64 * 1024 * 1024
+    MMAP_SLICE = 16 * 1024 * 1024
+
+    def __init__(self, ignore=None, fadvise=False, skip_suffix='', mmap_threshold=MMAP_THRESHOLD, select=None,
+                 cache=None):
+        """
+        Initialise the scanner
+        :param ignore: The SyncIgnore rules of files and directories to leave out
+        :param fadvise: Whether to give the kernel readahead and page cache advice, where posix_fadvise is available
+        :param skip_suffix: Files with names ending in this suffix are skipped
+        :param mmap_threshold: Files of this many bytes or more are hashed from a memory mapping, 0 to never map files
+        :param select: Called with the path of each file relative to the folder, only files it returns True for are
+        hashed, all files when not given
+        :param cache: The StatCache of md5s to use and update, if any
+        """
+        self.IGNORE = ignore or SyncIgnore()
+        self.SELECT = select
+        self.CACHE = cache
+        # The bytes read to hash files and the number of files taken from the cache instead
+        self.HASHED_BYTES = 0
+        self.CACHED_FILES = 0
+        self.FADVISE = fadvise and hasattr(os, 'posix_fadvise')
+        self.SKIP_SUFFIX = skip_suffix
+        self.MMAP_THRESHOLD = mmap_threshold
+        self.BUFFER = bytearray(self.BUFFER_SIZE)
+        self.VIEW = memoryview(self.BUFFER)
+
+    def scan(self, folder):
+        """
+        Walk the folder, directories that cannot be listed are skipped as they are by os.walk
+        :param folder: The folder to scan
+        :return: Generator of (root, name, raw md5, size) for every file beneath the folder
+        """
+        # Directories still to walk along with their path relative to the folder, used for the ignore rules
+        stack = [(folder, '')]
+        while stack:
+            root, prefix = stack.pop()
+            directories = []
+            try:
+                with os.scandir(root) as listing:
+                    entries = list(listing)
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_dir():
+                    # Symbolic links to directories are not followed, as with os.walk
+                    if entry.is_symlink() or (self.IGNORE and self.IGNORE.ignored(prefix + entry.name, True)):
+                        continue
+                    directories.append((entry.path, prefix + entry.name + '/'))
+                    continue
+                if self.SKIP_SUFFIX and entry.name.endswith(self.SKIP_SUFFIX):
+                    continue
+                if self.IGNORE and self.IGNORE.ignored(prefix + entry.name):
+                    continue
+                if self.SELECT is not None and not self.SELECT(prefix + entry.name):
+                    continue
+                stat = entry.stat()
+                digest = self.CACHE.lookup(entry.path, stat) if self.CACHE is not None else None
+                if digest is not None:
+                    self.CACHED_FILES += 1
+                    yield root, entry.name, digest, stat.st_size
+                    continue
+                digest, size = self.hash_file(entry.path, stat.st_size)
+                self.HASHED_BYTES += size
+                # A file that changed size while it was hashed is hashed again next time
+                if self.CACHE is not None and size == stat.st_size:
+                    self.CACHE.store(entry.path, stat, digest)
+                yield root, entry.name, digest, size
+            # Walk the subdirectories depth first in the order they were listed
+            stack.extend(reversed(directories))
+        if self.CACHE is not None:
+            self.CACHE.finish()
+
+    def hash_file(self, path, size):
+        """
+        Hash a file, a small file in a single read, a large file in BUFFER_SIZE reads into the reused buffer and a file
+        of MMAP_THRESHOLD bytes or more from a memory mapping, with anything the file has grown by since the stat read
+        after the mapped part
+        :param path: The path of the file
+        :param size: The size of the file from its stat
+        :return: Tuple of the raw md5 and the number of bytes hashed
+        """
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if size <= self.SMALL_FILE:
+                # A short read of a regular file means the end of the file, so one read covers the whole file unless it
+                # has grown since the stat
+                data = os.read(fd, size + 1)
+                file_md5 = hashlib.md5(data)
+                hashed = len(data)
+                if hashed <= size:
+                    return file_md5.digest(), hashed
+            else:
+                if self.FADVISE:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                file_md5 = hashlib.md5()
+                hashed = 0
+                if self.MMAP_THRESHOLD and size >= self.MMAP_THRESHOLD:
+                    hashed = self.hash_mapped(fd, size, file_md5)
+                    os.lseek(fd, hashed, os.SEEK_SET)
+            while True:
+                length = os.readv(fd, [self.BUFFER])
+                if not length:
+                    break
+                file_md5.update(self.VIEW[:length])
+                hashed += length
+            return file_md5.digest(), hashed
+        finally:
+            if self.FADVISE:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            os.close(fd)
+
+    def hash_mapped(self, fd, size, file_md5):
+        """
+        Hash the start of a file by mapping it into memory and handing the hasher MMAP_SLICE sized views of the mapping,
+        so the data is never copied into Python. Files that cannot be mapped, such as special files or files that have
+        shrunk since the stat, are left for the read loop
+        :param fd: The open file descriptor
+        :param size: The number of bytes to map
+        :param file_md5: The md5 object to update
+        :return: The number of bytes hashed
+        """
+        try:
+            mapping = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return 0
+        with mapping:
+            if hasattr(mapping, 'madvise'):
+                mapping.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mapping)
+            try:
+                for offset in range(0, size, self.MMAP_SLICE):
+                    file_md5.update(view[offset:offset + self.MMAP_SLICE])
+            finally:
+                view.release()
+        return size
+
+
+class FileExtents:
+    """
+    FileExtents class:
+    Finds the runs of data in a file with SEEK_DATA and SEEK_HOLE, so the client can send a sparse file and the server
+    can copy and hash one without reading its holes.
+    """
+
+    @staticmethod
+    def find(fd, size):
+        """
+        Find the runs of data in a file, skipping its holes
+        :param fd: The file descriptor of the file
+        :param size: The size of the file
+        :return: List of the [offset, length] of each run of data, the whole file where holes cannot be found
+        """
+        if not hasattr(os, 'SEEK_DATA'):
+            return [[0, size]] if size else []
+        extents = []
+        offset = 0
+        try:
+            while offset < size:
+                try:
+                    start = os.lseek(fd, offset, os.SEEK_DATA)
+                except OSError as error:
+                    # No data after the offset, the rest of the file is a hole
+                    if error.errno == errno.ENXIO:
+                        break
+                    raise
+                offset = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+                extents.append([start, offset - start])
+        except OSError:
+            return [[0, size]] if size else []
+        return extents
+
+
+class SocketConnector:
+    """
+    SocketConnector class:
+    Connects to a server that may not be listening yet, used by the client for its file data connections and by a
+    relay for its connections to the servers downstream of it. A refused connection is retried with a delay that
+    doubles from CONNECT_RETRY up to CONNECT_RETRY_MAX, rather than waiting a fixed time before every attempt, until
+    CONNECT_TIMEOUT has passed.
+    """
+
+    CONNECT_TIMEOUT = 10
+    CONNECT_RETRY = 0.001
+    CONNECT_RETRY_MAX = 0.1
+
+    def connect(self, family, address, buffer_size=0):
+        """
+        Connect to a server, retrying until it accepts the connection
+        :param family: The socket family, AF_INET or AF_UNIX
+        :param address: The address to connect to
+        :param buffer_size: The send buffer to set before connecting, 0 to leave it to the kernel
+        :return: The connected socket
+        """
+        deadline = time.monotonic() + self.CONNECT_TIMEOUT
+        retry = self.CONNECT_RETRY
+        while True:
+            s = socket.socket(family, socket.SOCK_STREAM)
+            if buffer_size:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+            try:
+                s.connect(address)
+                return s
+            except (ConnectionRefusedError, FileNotFoundError):
+                s.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(retry)
+                retry = min(retry * 2, self.CONNECT_RETRY_MAX)
+
+
+class LinkTuner:
+    """
+    LinkTuner class:
+    Follows the round trip time and throughput of the link between the client and server and sizes the socket buffers
+    and the chunks file data is sent in to match. Keeping a link busy takes a window of its bandwidth-delay product,
+    the round trip time multiplied by the throughput. The kernel tunes the socket buffers itself up to the limits in
+    tcp_wmem and tcp_rmem and setting a buffer turns that off, so a buffer is only set when the link needs more.
+    """
+
+    MIN_CHUNK = 64 * 1024
+    MAX_CHUNK = 4 * 1024 * 1024
+    MAX_BUFFER = 32 * 1024 * 1024
+    MIN_SAMPLE = 256 * 1024
+    WEIGHT = 0.3
+
+    def __init__(self, rtt=0.0, rate=0.0):
+        """
+        Initialise the tuner
+        :param rtt: The round trip time in seconds, 0 until measured
+        :param rate: The throughput in bytes per second, 0 until measured
+        """
+        self.RTT = rtt
+        self.RATE = rate
+
+    @staticmethod
+    def parse_rate(rate):
+        """
+        Convert a rate such as 500K, 10M or 1G into bytes per second
+        :param rate: The rate string
+        :return: The rate in bytes per second
+        """
+        multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+        rate = rate.strip().upper()
+        if rate[-1:] in multipliers:
+            return float(rate[:-1]) * multipliers[rate[-1]]
+        return float(rate)
+
+    def average(self, current, sample):
+        """
+        :param current: The current average, 0 if there is none yet
+        :param sample: The new measurement
+        :return: The exponentially weighted average of the measurements
+        """
+        return sample if not current else current + self.WEIGHT * (sample - current)
+
+    def add_rtt(self, seconds):
+        """
+        Add a measured round trip time
+        :param seconds: The round trip time in seconds
+        """
+        self.RTT = self.average(self.RTT, seconds)
+
+    def add_transfer(self, size, seconds):
+        """
+        Add a measured transfer, files too small to get past TCP slow start are left out
+        :param size: The number of bytes transferred
+        :param seconds: The time the transfer took
+        """
+        if size >= self.MIN_SAMPLE and seconds > 0:
+            self.RATE = self.average(self.RATE, size / seconds)
+
+    def bdp(self):
+        """
+        :return: The bandwidth-delay product in bytes, 0 until both have been measured
+        """
+        return int(self.RTT * self.RATE)
+
+    @staticmethod
+    def autotune_limit(name):
+        """
+        :param name: tcp_wmem or tcp_rmem
+        :return: The largest buffer the kernel grows a socket's buffer to by itself, 0 if it cannot be read
+        """
+        try:
+            with open(os.path.join('/proc/sys/net/ipv4', name)) as f:
+                return int(f.read().split()[2])
+        except (OSError, ValueError, IndexError):
+            return 0
+
+    def buffer_size(self, name):
+        """
+        The socket buffer to set for the link, twice the bandwidth-delay product as the kernel keeps part of the buffer
+        for its own use
+        :param name: tcp_wmem for a send buffer or tcp_rmem for a receive buffer
+        :return: The buffer size in bytes, 0 to leave the buffer to the kernel
+        """
+        size = min(2 * self.bdp(), self.MAX_BUFFER)
+        return size if size > self.autotune_limit(name) else 0
+
+    def chunk_size(self):
+        """
+        :return: The size of the chunks to send file data in, the bandwidth-delay product in whole MIN_CHUNKs up to
+        MAX_CHUNK
+        """
+        return max(self.MIN_CHUNK, min(self.bdp() // self.MIN_CHUNK * self.MIN_CHUNK, self.MAX_CHUNK))
+
+    def encode(self):
+        """
+        :return: The measurements as sent in the tune message
+        """
+        return '%r %r' % (self.RTT, self.RATE)
+
+    @classmethod
+    def decode(cls, data):
+        """
+        :param data: The data of a tune message
+        :return: A LinkTuner holding the client's measurements
+        """
+        rtt, rate = data.split()
+        return cls(float(rtt), float(rate))
+
+
+class SyncMetrics:
+    """
+    SyncMetrics class:
+    Holds the counters, gauges and histograms describing where syncs spend their time and renders them in the
+    Prometheus text format. Every metric is listed in DESCRIPTIONS with its type and help text, along with those the
+    client or server add of their own, updates are made under a lock as the metrics may be read from another thread.
+    """
+
+    BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600]
+    DESCRIPTIONS = {
+        'syncs_total': ['counter', 'Number of syncs completed'],
+        'sync_seconds': ['histogram', 'Time taken by each sync'],
+        'scan_seconds': ['histogram', 'Time taken to scan and hash the local directory'],
+        'scanned_files_total': ['counter', 'Number of files scanned'],
+        'hashed_bytes_total': ['counter', 'Number of bytes read and hashed while scanning'],
+        'hash_bytes_per_second': ['gauge', 'Hashing throughput of the last scan'],
+        'cached_files_total': ['counter', 'Number of files scanned whose md5 was taken from the stat cache'],
+        'files_transferred_total': ['counter', 'Number of files transferred'],
+        'bytes_transferred_total': ['counter', 'Number of bytes transferred'],
+        'file_transfer_seconds': ['histogram', 'Time taken to transfer each file'],
+        'link_rtt_seconds': ['gauge', 'Measured round trip time of the link between the client and server'],
+        'link_bytes_per_second': ['gauge', 'Measured throughput of the link between the client and server'],
+        'socket_buffer_bytes': ['gauge', 'Socket buffer set for file data, 0 when left to the kernel'],
+    }
+
+    def __init__(self, prefix, descriptions=None):
+        """
+        Initialise the metrics with every counter at zero
+        :param prefix: The prefix for every metric name, e.g. server_sync
+        :param descriptions: The type and help text of the metrics only one side keeps, added to DESCRIPTIONS
+        """
+        self.PREFIX = prefix
+        self.DESCRIPTIONS = dict(self.DESCRIPTIONS, **(descriptions or {}))
+        self.LOCK = threading.Lock()
+        self.VALUES = {}
+        self.HISTOGRAMS = {}
+        for name, (kind, description) in self.DESCRIPTIONS.items():
+            if kind == 'histogram':
+                self.HISTOGRAMS[name] = [[0] * len(self.BUCKETS), 0, 0]
+            else:
+                self.VALUES[name] = 0
+
+    def inc(self, name, value=1):
+        """
+        Add to a counter
+        :param name: The name of the counter
+        :param value: The amount to add
+        """
+        with self.LOCK:
+            self.VALUES[name] += value
+
+    def set(self, name, value):
+        """
+        Set a gauge
+        :param name: The name of the gauge
+        :param value: The value to set
+        """
+        with self.LOCK:
+            self.VALUES[name] = value
+
+    def observe(self, name, value):
+        """
+        Record a value in a histogram
+        :param name: The name of the histogram
+        :param value: The value to record
+        """
+        with self.LOCK:
+            histogram = self.HISTOGRAMS[name]
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        """
+        :return: Every metric in the Prometheus text exposition format
+        """
+        lines = []
+        with self.LOCK:
+            for name, (kind, description) in self.DESCRIPTIONS.items():
+                metric = self.PREFIX + '_' + name
+                lines.append('# HELP ' + metric + ' ' + description)
+                lines.append('# TYPE ' + metric + ' ' + kind)
+                if kind == 'histogram':
+                    buckets, total, count = self.HISTOGRAMS[name]
+                    for bound, bucket_count in zip(self.BUCKETS, buckets):
+                        lines.append('%s_bucket{le="%s"} %d' % (metric, bound, bucket_count))
+                    lines.append('%s_bucket{le="+Inf"} %d' % (metric, count))
+                    lines.append('%s_sum %s' % (metric, total))
+                    lines.append('%s_count %d' % (metric, count))
+                else:
+                    lines.append('%s %s' % (metric, self.VALUES[name]))
+        return '\n'.join(lines) + '\n'
+
+
+class SyncProfiler:
+    """
+    SyncProfiler class:
+    Wraps sync cycles with cProfile and/or tracemalloc when asked for on the command line. Each profiled cycle writes a
+    .pstats file (readable with pstats or snakeviz) and/or a report of the lines allocating the most memory, only the
+    newest KEEP files of each kind are kept. A fraction of cycles can be sampled so profiling can be left on with little
+    overhead, cycles that are not sampled run without any profiling at all.
+    """
+
+    ALLOCATION_LINES = 25
+
+    def __init__(self, prefix, log, profile_folder='', alloc_folder='', rate=1.0, keep=10):
+        """
+        Initialise the profiler
+        :param prefix: The prefix for the files written, e.g. server
+        :param log: The logger the files written are reported to
+        :param profile_folder: The folder to write .pstats files to, empty to not run cProfile
+        :param alloc_folder: The folder to write allocation reports to, empty to not trace allocations
+        :param rate: The fraction of cycles to profile
+        :param keep: The number of files of each kind to keep
+        """
+        self.PREFIX = prefix
+        self.LOG = log
+        self.PROFILE_FOLDER = profile_folder
+        self.ALLOC_FOLDER = alloc_folder
+        self.RATE = rate
+        self.KEEP = keep
+        for folder in (profile_folder, alloc_folder):
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def add_arguments(parser):
+        """
+        Add the profiling options to a command line parser
+        :param parser: The ArgumentParser to add the options to
+        """
+        parser.add_argument('--profile', default='', metavar='FOLDER',
+                            help='Run each sync cycle under cProfile and write a .pstats file per cycle to FOLDER')
+        parser.add_argument('--trace-alloc', default='', metavar='FOLDER',
+                            help='Trace memory allocations during each sync cycle with tracemalloc and write a report '
+                                 'of the top allocating lines per cycle to FOLDER')
+        parser.add_argument('--profile-rate', type=float, default=1.0, metavar='FRACTION',
+                            help='Only profile this fraction of sync cycles, e.g. 0.05 for one in twenty (default: 1)')
+        parser.add_argument('--profile-keep', type=int, default=10, metavar='N',
+                            help='Keep the newest N files of each kind in the profile folders (default: 10)')
+
+    @contextlib.contextmanager
+    def cycle(self):
+        """
+        Profile the body of a with statement as one sync cycle, if profiling is on and the cycle is sampled
+        """
+        if not (self.PROFILE_FOLDER or self.ALLOC_FOLDER) or random.random() >= self.RATE:
+            yield
+            return
+        now = time.time_ns()
+        name = '%s-%s-%09d' % (self.PREFIX, time.strftime('%Y%m%d-%H%M%S', time.localtime(now // 1000000000)),
+                               now % 1000000000)
+        profiler = None
+        if self.ALLOC_FOLDER:
+            tracemalloc.start()
+        if self.PROFILE_FOLDER:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                path = os.path.join(self.PROFILE_FOLDER, name + '.pstats')
+                profiler.dump_stats(path)
+                self.LOG.info('Profile written: %s', path)
+                self.rotate(self.PROFILE_FOLDER, '.pstats')
+            if self.ALLOC_FOLDER:
+                self.write_allocations(os.path.join(self.ALLOC_FOLDER, name + '.alloc.txt'))
+                self.rotate(self.ALLOC_FOLDER, '.alloc.txt')
+
+    def write_allocations(self, path):
+        """
+        Write the lines that allocated the most memory during the cycle, then stop tracing
+        :param path: The path of the report
+        """
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # Leave out the profilers' own bookkeeping so the report shows what the sync allocated
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, module.__file__)
+                                           for module in (tracemalloc, cProfile, contextlib)])
+        statistics = snapshot.statistics('lineno')
+        with open(path, 'w') as f:
+            f.write('Current: %d bytes Peak: %d bytes\n' % (current, peak))
+            for statistic in statistics[:self.ALLOCATION_LINES]:
+                f.write(str(statistic) + '\n')
+        self.LOG.info('Allocation report written: %s', path)
+
+    def rotate(self, folder, suffix):
+        """
+        Remove all but the newest KEEP files written by this profiler with the given suffix
+        :param folder: The folder to clean up
+        :param suffix: The suffix of the files
+        """
+        files = sorted(file for file in os.listdir(folder) if file.startswith(self.PREFIX + '-') and
+                       file.endswith(suffix))
+        for file in files[:-self.KEEP] if self.KEEP > 0 else []:
+            os.remove(os.path.join(folder, file))
+
+
+class SyncConnection:
+    """
+    SyncConnection class:
+    Wraps a connected socket along with any partly received message data. Each message is the pickled message
+    string preceded by a fixed length header holding the length of the pickled data. Data is added to the buffer as it
+    arrives and any complete messages are handed back, so several connections can be read as their data arrives.
+    """
+
+    HEADER = 10
+    RECEIVE_SIZE = 65536
+
+    def __init__(self, sock, address):
+        """
+        Initialise the connection
+        :param sock: The connected socket
+        :param address: The address of the other end of the connection
+        """
+        self.SOCKET = sock
+        self.ADDRESS = address
+        self.BUFFER = bytearray()
+        self.PENDING = []
+        self.SESSION = False
+        self.LAST_SEEN = time.monotonic()
+
+    def send(self, data):
+        """
+        Send a message over the connection
+        :param data: The message string to send
+        """
+        message = pickle.dumps(data)
+        message = bytes(f"{len(message):<{self.HEADER}}", 'utf-8') + message
+        self.SOCKET.sendall(message)
+
+    def receive(self):
+        """
+        Read the data waiting on the socket and return any messages it completes
+        :return: List of the complete messages received, or None if the connection has been closed
+        """
+        data = self.SOCKET.recv(self.RECEIVE_SIZE)
+        if data == b"":
+            return None
+        self.LAST_SEEN = time.monotonic()
+        self.BUFFER += data
+        messages = []
+        # Take every complete message from the front of the buffer, leaving any partial message for the next read
+        while len(self.BUFFER) >= self.HEADER:
+            message_length = int(self.BUFFER[:self.HEADER])
+            if len(self.BUFFER) - self.HEADER < message_length:
+                break
+            messages.append(pickle.loads(self.BUFFER[self.HEADER:self.HEADER + message_length]))
+            del self.BUFFER[:self.HEADER + message_length]
+        return messages
+
+    def close(self):
+        """
+        Close the connection
+        """
+        self.SOCKET.close()
@@ -5,6 +5,15 @@ import logging
 import hashlib
 import os
 import shutil
+import runpy
+import pickle
+import threading
+import selectors
+import socket
+import tempfile
+from unittest import mock
+
+from sync_common import FileTable, SyncIgnore, LinkTuner, StatCache, FileExtents, SocketConnector
 
 logging.basicConfig(filename='test_sync.log',
                     format='%(asctime)s - %(levelname)s - %(message)s',
@@ -607,5 +616,711 @@ class ServerSyncTest(unittest.TestCase):
         logging.info('END - test_007_server_file_delete')
 
 
+
+class TemporaryFolderTest(unittest.TestCase):
+    """
+    The base of the tests that load the server and client scripts and work in their own temporary directory, so they
+    need no folders setting
+    """
+
+    SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server-sync.py')
+    CLIENT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'client-sync.py')
+
+    @classmethod
+    def setUpClass(cls):
+        # Load the server and client scripts without running them, as bench-sync.py does
+        cls.SERVER = runpy.run_path(cls.SERVER_SCRIPT)
+        cls.CLIENT = runpy.run_path(cls.CLIENT_SCRIPT)
+
+    def setUp(self):
+        self.TEMP = tempfile.TemporaryDirectory()
+        self.FOLDER = self.TEMP.name
+
+    def tearDown(self):
+        self.TEMP.cleanup()
+
+    def write_file(self, name, data):
+        """
+        Write a file into the temporary directory
+        :param name: The name of the file
+        :param data: The bytes to write
+        :return: The path of the file
+        """
+        path = os.path.join(self.FOLDER, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def server(self, folder, *options):
+        """
+        Start a SyncServer for a folder without running it, listening on a unix domain socket in the temporary directory
+        :param folder: The folder the server keeps in sync
+        :param options: Any further command line options
+        :return: The SyncServer
+        """
+        server = self.SERVER['SyncServer']([folder, '--unix', os.path.join(self.FOLDER, 'server.sock')] + list(options))
+        self.addCleanup(server.SOCKET.close)
+        return server
+
+
+class SyncComponentTest(TemporaryFolderTest):
+    """
+    Tests of the parts of the sync that can be run on their own, without starting a client or server. Each test works
+    in its own temporary directory, so they need no folders setting and can be run alone with:
+    python3 test-sync.py SyncComponentTest
+    """
+
+    def test_server_ignores_client_paths(self):
+        """
+        Check the server does not request client files its own directory and anchored rules leave out.
+        """
+        server_folder = os.path.join(self.FOLDER, 'server')
+        client_folder = os.path.join(self.FOLDER, 'client')
+        os.makedirs(server_folder)
+        with open(os.path.join(server_folder, SyncIgnore.FILE_NAME), 'w') as f:
+            f.write('cache/\n/top.txt\n')
+        server = self.server(server_folder)
+        server.CURRENT_FILE_LIST = server.read_local_storage()
+        files = FileTable()
+        for root, name in [['', 'keep.txt'], ['cache', 'data.bin'], ['sub/cache', 'data2.bin'], ['', 'top.txt'],
+                           ['sub', 'top2.txt']]:
+            files.add(os.path.join(client_folder, root), name, hashlib.md5(name.encode()).digest(), 1)
+        server.CLIENT_ROOT = client_folder
+        server.compare_client_files_with_local(files)
+        self.assertEqual(sorted(file[1] for file in server.REQUEST_FILE_LIST), ['keep.txt', 'top2.txt'])
+
+    def test_journal_kept_after_lost_sync(self):
+        """
+        Check a sync that loses its client keeps the journal, and a restart picks up the files it committed.
+        """
+        server_folder = os.path.join(self.FOLDER, 'server')
+        state_folder = os.path.join(self.FOLDER, 'state')
+        os.makedirs(server_folder)
+        server = self.server(server_folder, '--state', state_folder)
+        server.CURRENT_FILE_LIST = server.read_local_storage()
+        files = FileTable()
+        files.add(os.path.join(self.FOLDER, 'client'), 'wanted.txt', hashlib.md5(b'wanted').digest(), 6)
+        client, server_end = socket.socketpair()
+        connection = self.SERVER['ClientConnection'](server_end, 'test')
+        server.SELECTOR.register(server_end, selectors.EVENT_READ, connection)
+        # The client is gone before the server can request its file
+        client.close()
+        server.sync(connection, files.encode())
+        self.assertEqual(server.SUMMARY['files_transferred'], 0)
+        journal_path = os.path.join(state_folder, 'server-journal')
+        self.assertTrue(os.path.exists(journal_path))
+        # A file committed by the journal is taken from it after a restart
+        journal = self.SERVER['SyncJournal'](journal_path)
+        path = self.write_file('committed.txt', b'committed')
+        journal.start(self.FOLDER, [['', 'committed.txt', hashlib.md5(b'committed').hexdigest(), 9]])
+        journal.committed([path])
+        journal.close()
+        cache = self.SERVER['StatCache']()
+        self.assertEqual(journal.recover(cache), (1, 1))
+        self.assertEqual(cache.lookup(path, os.stat(path)), hashlib.md5(b'committed').digest())
+        journal.finish()
+        self.assertFalse(os.path.exists(journal_path))
+
+    def test_stat_cache_saves_remembered(self):
+        """
+        Check a file remembered at a path already cached is saved, so the cache on disk is not left stale.
+        """
+        cache_path = os.path.join(self.FOLDER, 'cache')
+        path = self.write_file('file.txt', b'old')
+        # Old enough to be cached by a scan
+        os.utime(path, ns=(time.time_ns() - 10 ** 10, time.time_ns() - 10 ** 10))
+        cache = StatCache(cache_path)
+        cache.store(path, os.stat(path), hashlib.md5(b'old').digest())
+        cache.finish()
+        # The file is received again and its md5 remembered, then the rescan finds it
+        self.write_file('file.txt', b'new')
+        cache = StatCache(cache_path)
+        cache.remember(path, os.stat(path), hashlib.md5(b'new').digest())
+        cache.lookup(path, os.stat(path))
+        cache.finish()
+        self.assertEqual(StatCache(cache_path).lookup(path, os.stat(path)), hashlib.md5(b'new').digest())
+
+    def test_shard_worker_long_messages(self):
+        """
+        Check a shard worker takes a file passed with a message longer than 1KB, and the longest path fits a message.
+        """
+        shard_pool = self.SERVER['ShardPool']
+        longest = ['socket', 'p' * self.SERVER['FileServer'].PATH_MAX, True, bytes(16)]
+        self.assertLessEqual(len(pickle.dumps(longest)), shard_pool.MESSAGE_SIZE)
+        front, back = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.addCleanup(front.close)
+        front.settimeout(5)
+        worker = self.SERVER['ShardWorker'](0, 1, 'path', self.FOLDER)
+        threading.Thread(target=worker.run, args=(back,), daemon=True).start()
+        # A long name of multibyte characters, with the message padded past 1KB as pickle ignores anything after its end
+        name = '\u6587' * 80
+        source = self.write_file('source.bin', b'shard data')
+        with open(source, 'rb') as f:
+            message = pickle.dumps(['descriptor', name, False, hashlib.md5(b'shard data').digest()])
+            message += bytes(max(0, 1100 - len(message)))
+            socket.send_fds(front, [message], [f.fileno()])
+        front.send(pickle.dumps(['flush']))
+        reply = pickle.loads(front.recv(shard_pool.CHUNK_SIZE))
+        self.assertEqual(reply[:3], ['flushed', None, []])
+        with open(os.path.join(self.FOLDER, name), 'rb') as f:
+            self.assertEqual(f.read(), b'shard data')
+
+    def test_file_extents_skip_holes(self):
+        """
+        Check the runs of data found in a sparse file leave out its holes, and an empty file has none.
+        """
+        path = os.path.join(self.FOLDER, 'sparse.bin')
+        with open(path, 'wb') as f:
+            f.seek(4 * 1024 * 1024)
+            f.write(b'data')
+            f.truncate(8 * 1024 * 1024)
+        with open(path, 'rb') as f:
+            extents = FileExtents.find(f.fileno(), 8 * 1024 * 1024)
+            # Reading only the runs of data and filling the rest with zeros gives the file back
+            rebuilt = bytearray(8 * 1024 * 1024)
+            for offset, length in extents:
+                rebuilt[offset:offset + length] = os.pread(f.fileno(), length, offset)
+            f.seek(0)
+            self.assertEqual(rebuilt, f.read())
+        if os.stat(path).st_blocks * 512 < 8 * 1024 * 1024:
+            # The file system keeps holes, so they are left out
+            self.assertLess(sum(length for offset, length in extents), 8 * 1024 * 1024)
+        with open(self.write_file('empty.bin', b''), 'rb') as f:
+            self.assertEqual(FileExtents.find(f.fileno(), 0), [])
+
+    def test_socket_connector_retries(self):
+        """
+        Check a connection refused while the server is not yet listening is retried until the server listens.
+        """
+        path = os.path.join(self.FOLDER, 'late.sock')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(listener.close)
+
+        def listen_late():
+            time.sleep(0.2)
+            listener.bind(path)
+            listener.listen(1)
+
+        threading.Thread(target=listen_late).start()
+        connected = SocketConnector().connect(socket.AF_UNIX, path)
+        connected.close()
+        connector = SocketConnector()
+        connector.CONNECT_TIMEOUT = 0.2
+        with self.assertRaises(FileNotFoundError):
+            connector.connect(socket.AF_UNIX, os.path.join(self.FOLDER, 'missing.sock'))
+
+    def test_file_table_round_trip(self):
+        """
+        Encode a FileTable with repeated directories and duplicate names and check it decodes to the same entries.
+        """
+        table = FileTable()
+        entries = [['/a', 'one.txt', hashlib.md5(b'1').digest(), 1], ['/a/b', 'one.txt', hashlib.md5(b'2').digest(), 2],
+                   ['/a', 'one.txt', hashlib.md5(b'3').digest(), 3], ['/a', 'caf\u00e9', hashlib.md5(b'').digest(), 0]]
+        for root, name, digest, size in entries:
+            table.add(root, name, digest, size)
+        decoded = FileTable.decode(table.encode())
+        self.assertEqual(list(decoded), [[root, name, digest.hex()] for root, name, digest, size in entries])
+        self.assertEqual([decoded.size(index) for index in range(len(decoded))], [entry[3] for entry in entries])
+        self.assertEqual(decoded.DIRECTORIES, ['/a', '/a/b'])
+        # Duplicate names resolve to the first entry in walk order
+        self.assertEqual(decoded.find_name('one.txt'), 0)
+        self.assertEqual(decoded.find_digest(hashlib.md5(b'3').digest()), 2)
+
+    def test_file_table_empty_round_trip(self):
+        """
+        Encode an empty FileTable and check it decodes to an empty table.
+        """
+        decoded = FileTable.decode(FileTable().encode())
+        self.assertEqual(len(decoded), 0)
+        self.assertEqual(list(decoded), [])
+        self.assertEqual(decoded.DIRECTORIES, [])
+        self.assertEqual(decoded.find_name('missing'), -1)
+
+    def test_sync_ignore_rules(self):
+        """
+        Check .syncignore rules with **, ! re-includes, directory only rules and anchored rules.
+        """
+        ignore = SyncIgnore(['# comment', '', '*.log', '!keep.log', 'build/', '/top.txt', 'logs/**/*.tmp', 'a/**'])
+        # Unanchored rules match a name at any depth and a later ! rule includes a file again
+        self.assertTrue(ignore.ignored('debug.log'))
+        self.assertTrue(ignore.ignored('deep/down/debug.log'))
+        self.assertFalse(ignore.ignored('keep.log'))
+        self.assertFalse(ignore.ignored('deep/keep.log'))
+        # A rule ending in / only matches directories, and files beneath them are left out too
+        self.assertTrue(ignore.ignored('build', directory=True))
+        self.assertFalse(ignore.ignored('build'))
+        self.assertTrue(ignore.ignored_path('build/out.o'))
+        # A rule with a leading / is anchored to the top of the folder
+        self.assertTrue(ignore.ignored('top.txt'))
+        self.assertFalse(ignore.ignored('sub/top.txt'))
+        # ** matches any number of directories, including none
+        self.assertTrue(ignore.ignored('logs/x.tmp'))
+        self.assertTrue(ignore.ignored('logs/one/two/x.tmp'))
+        self.assertFalse(ignore.ignored('other/logs/x.tmp'))
+        self.assertTrue(ignore.ignored('a/b/c.txt'))
+        self.assertFalse(ignore.ignored('b/a/c.txt'))
+        self.assertFalse(SyncIgnore(['# only a comment', '']))
+
+    def test_transfer_scheduler_order(self):
+        """
+        Check the order files are requested in under each --schedule policy.
+        """
+        files = [['/b', 'big.mov', 'm1', 300], ['/a', 'z.jpg', 'm2', 200], ['/b', 'a.txt', 'm3', 100],
+                 ['/a', 'small.mov', 'm4', 50]]
+        scheduler_class = self.SERVER['TransferScheduler']
+        self.assertEqual(scheduler_class('walk').order(files), files)
+        self.assertEqual([file[2] for file in scheduler_class('smallest').order(files)], ['m4', 'm3', 'm2', 'm1'])
+        self.assertEqual([file[2] for file in scheduler_class('locality').order(files)], ['m4', 'm2', 'm3', 'm1'])
+        scheduler = scheduler_class('priority', [['photos', '*.jpg'], ['video', '*.mov']])
+        self.assertEqual([file[2] for file in scheduler.order(files)], ['m2', 'm4', 'm1', 'm3'])
+        self.assertEqual(scheduler.file_class(files[2]), scheduler_class.DEFAULT_CLASS)
+
+    def test_rate_limiter_pacing(self):
+        """
+        Check a RateLimiter allows a second's burst and then holds the caller back to its rate.
+        """
+        limiter = self.SERVER['RateLimiter'](100000)
+        start = time.monotonic()
+        # A full bucket allows a second's worth of bytes at once, the next half second's worth has to wait for it
+        limiter.consume(100000)
+        self.assertLess(time.monotonic() - start, 0.2)
+        limiter.consume(50000)
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+        self.assertLess(time.monotonic() - start, 1.5)
+
+    def test_link_tuner_clamping(self):
+        """
+        Check the chunk and buffer sizes the LinkTuner picks are kept within their limits.
+        """
+        self.assertEqual(LinkTuner().chunk_size(), LinkTuner.MIN_CHUNK)
+        self.assertEqual(LinkTuner(0.001, 1000).chunk_size(), LinkTuner.MIN_CHUNK)
+        self.assertEqual(LinkTuner(1, 10 * LinkTuner.MIN_CHUNK + 1).chunk_size(), 10 * LinkTuner.MIN_CHUNK)
+        self.assertEqual(LinkTuner(10, 1024 ** 3).chunk_size(), LinkTuner.MAX_CHUNK)
+        with mock.patch.object(LinkTuner, 'autotune_limit', return_value=4 * 1024 * 1024):
+            self.assertEqual(LinkTuner(10, 1024 ** 3).buffer_size('tcp_rmem'), LinkTuner.MAX_BUFFER)
+            # A buffer the kernel would reach by itself is left to the kernel
+            self.assertEqual(LinkTuner(0.01, 1024 ** 2).buffer_size('tcp_rmem'), 0)
+        # Only transfers large enough to get past slow start are measured
+        tuner = LinkTuner()
+        tuner.add_transfer(LinkTuner.MIN_SAMPLE - 1, 0.001)
+        self.assertEqual(tuner.RATE, 0)
+        self.assertEqual(LinkTuner.decode(LinkTuner(0.25, 1e6).encode()).bdp(), 250000)
+
+    def test_parse_rate(self):
+        """
+        Check the rates given to --class-limit and netem-sync.py's --bandwidth are read with and without a suffix.
+        """
+        self.assertEqual(LinkTuner.parse_rate('500'), 500)
+        self.assertEqual(LinkTuner.parse_rate('500k'), 500 * 1024)
+        self.assertEqual(LinkTuner.parse_rate(' 1.5M '), 1.5 * 1024 ** 2)
+        self.assertEqual(LinkTuner.parse_rate('2G'), 2 * 1024 ** 3)
+
+    def test_local_operations_copy_before_delete(self):
+        """
+        Queue copies of files followed by their deletes and check every copy is made before its source goes.
+        """
+        local_ops = self.SERVER['LocalOperations']()
+        for number in range(20):
+            source = self.write_file('source%d' % number, b'data%d' % number)
+            local_ops.copy(source, os.path.join(self.FOLDER, 'copy%d' % number))
+            local_ops.delete(source)
+        local_ops.join()
+        self.assertEqual(sorted(os.listdir(self.FOLDER)), sorted('copy%d' % number for number in range(20)))
+        for number in range(20):
+            with open(os.path.join(self.FOLDER, 'copy%d' % number), 'rb') as f:
+                self.assertEqual(f.read(), b'data%d' % number)
+
+    def test_local_operations_join_raises(self):
+        """
+        Check a failed local operation is raised by join() once the other operations have run.
+        """
+        local_ops = self.SERVER['LocalOperations']()
+        local_ops.copy(os.path.join(self.FOLDER, 'missing'), os.path.join(self.FOLDER, 'copy'))
+        local_ops.copy(self.write_file('present', b'data'), os.path.join(self.FOLDER, 'copy_present'))
+        with self.assertRaises(FileNotFoundError):
+            local_ops.join()
+        # The other operations still ran and the error is only raised once
+        self.assertTrue(os.path.exists(os.path.join(self.FOLDER, 'copy_present')))
+        local_ops.join()
+
+    def receive(self, name, data, digest, complete=True):
+        """
+        Pass a file through a FileWriter as the network side would
+        :param name: The name of the file
+        :param data: The bytes received
+        :param digest: The raw md5 the file was requested with
+        :param complete: Whether the whole file was received
+        :return: The list of rejected paths returned by the writer's flush
+        """
+        writer = self.SERVER['FileWriter'](self.SERVER['FileCommitter']())
+        writer.open(self.FOLDER, name, digest)
+        buffer = writer.get_buffer()
+        buffer[:len(data)] = data
+        writer.write(buffer, len(data))
+        writer.close(complete)
+        return writer.flush()
+
+    def test_file_writer_commits_match(self):
+        """
+        Check a file received with the md5 it was requested with is committed.
+        """
+        self.assertEqual(self.receive('good.txt', b'good data', hashlib.md5(b'good data').digest()), [])
+        self.assertEqual(os.listdir(self.FOLDER), ['good.txt'])
+        with open(os.path.join(self.FOLDER, 'good.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b'good data')
+
+    def test_file_writer_rejects_mismatch(self):
+        """
+        Check a file received with a different md5 than requested is rejected and removed.
+        """
+        path = os.path.join(self.FOLDER, 'bad.txt')
+        self.assertEqual(self.receive('bad.txt', b'bad data', hashlib.md5(b'other data').digest()), [path])
+        self.assertEqual(os.listdir(self.FOLDER), [])
+
+    def test_file_writer_checks_out_of_order(self):
+        """
+        Check a file written out of order, so it cannot be hashed as it is written, is read back and checked.
+        """
+        for name, requested in [['ordered.txt', b'abcdefgh'], ['changed.txt', b'abcdefgX']]:
+            writer = self.SERVER['FileWriter'](self.SERVER['FileCommitter']())
+            writer.open(self.FOLDER, name, hashlib.md5(requested).digest())
+            for offset, data in [[4, b'efgh'], [0, b'abcd']]:
+                buffer = writer.get_buffer()
+                buffer[:len(data)] = data
+                writer.seek(offset)
+                writer.write(buffer, len(data))
+            writer.close()
+            writer.flush()
+        self.assertEqual(os.listdir(self.FOLDER), ['ordered.txt'])
+
+    def test_file_server_times_out_stalled_client(self):
+        """
+        Check a client that stops sending without closing the connection times out and its partial file is removed.
+        """
+        writer = self.SERVER['FileWriter'](self.SERVER['FileCommitter']())
+        file_server = self.SERVER['FileServer']()
+        file_server.DATA_TIMEOUT = 0.2
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        client.sendall(b'part of a file')
+        with self.assertRaises(socket.timeout):
+            file_server.receive_data(server, 'stalled.txt', self.FOLDER, writer,
+                                     digest=hashlib.md5(b'part of a file and the rest').digest())
+        writer.flush()
+        self.assertEqual(os.listdir(self.FOLDER), [])
+
+    def test_file_client_times_out_stalled_server(self):
+        """
+        Check the client gives up on a server that takes the file data but never closes the connection.
+        """
+        listener = socket.create_server(('localhost', 0))
+        self.addCleanup(listener.close)
+        self.write_file('large.bin', os.urandom(LinkTuner.MIN_SAMPLE))
+        file_client = self.CLIENT['FileClient']()
+        file_client.DATA_TIMEOUT = 0.2
+        start = time.monotonic()
+        with self.assertRaises(socket.timeout):
+            file_client.send_file(self.FOLDER, 'large.bin', port=listener.getsockname()[1], tuner=LinkTuner())
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_file_writer_commits_waiting_batch(self):
+        """
+        Check a batch too small to commit is committed by the writer once it has waited COMMIT_SECONDS, without another
+        file arriving or a flush.
+        """
+        committer = self.SERVER['FileCommitter']()
+        committer.COMMIT_SECONDS = 0.2
+        writer = self.SERVER['FileWriter'](committer)
+        writer.open(self.FOLDER, 'waiting.txt')
+        buffer = writer.get_buffer()
+        buffer[:7] = b'waiting'
+        writer.write(buffer, 7)
+        writer.close()
+        path = os.path.join(self.FOLDER, 'waiting.txt')
+        deadline = time.monotonic() + 5
+        while not os.path.exists(path) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(os.path.exists(path), 'The batch was not committed once it had waited')
+
+    def test_file_writer_drops_incomplete(self):
+        """
+        Check a file cut off part way is removed rather than committed.
+        """
+        self.assertEqual(self.receive('part.txt', b'part', hashlib.md5(b'part').digest(), complete=False), [])
+        self.assertEqual(os.listdir(self.FOLDER), [])
+
+
+class SyncRunTest(TemporaryFolderTest):
+    """
+    Whole syncs run in-process in a temporary directory. The server runs on a thread listening on free ports, as
+    bench-sync.py runs it, and the client is run once against it, so each test waits on the sync itself rather than
+    sleeping. They can be run alone with:
+    python3 test-sync.py SyncRunTest
+    """
+
+    NETEM_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'netem-sync.py')
+    SYNC_TIMEOUT = 60
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.NETEM = runpy.run_path(cls.NETEM_SCRIPT)
+
+    def setUp(self):
+        super().setUp()
+        self.CLIENT_FOLDER = os.path.join(self.FOLDER, 'client')
+        self.SERVER_FOLDER = os.path.join(self.FOLDER, 'server')
+        os.mkdir(self.CLIENT_FOLDER)
+        os.mkdir(self.SERVER_FOLDER)
+
+    @staticmethod
+    def free_ports(count):
+        """
+        Find ports nothing is listening on, held open together so no port is handed out twice
+        :param count: The number of ports to find
+        :return: List of the port numbers
+        """
+        sockets = [socket.socket(socket.AF_INET, socket.SOCK_STREAM) for _ in range(count)]
+        try:
+            for s in sockets:
+                s.bind(('localhost', 0))
+            return [s.getsockname()[1] for s in sockets]
+        finally:
+            for s in sockets:
+                s.close()
+
+    def start_server(self, folder, *options):
+        """
+        Start a SyncServer for a folder running on a thread and listening on free ports, and wait for its first scan
+        :param folder: The folder the server keeps in sync
+        :param options: Any further command line options
+        :return: The SyncServer, its SCANNED event is set each time it finishes scanning its folder
+        """
+        class ScannedServer(self.SERVER['SyncServer']):
+            SCANNED = threading.Event()
+
+            def read_local_storage(self):
+                file_list = super().read_local_storage()
+                self.SCANNED.set()
+                return file_list
+
+        port, data_port = self.free_ports(2)
+        server = ScannedServer([folder, '--port', str(port), '--data-port', str(data_port)] + list(options))
+        self.addCleanup(server.SOCKET.close)
+        threading.Thread(target=server.run, daemon=True).start()
+        self.assertTrue(server.SCANNED.wait(self.SYNC_TIMEOUT), 'The server did not scan its folder')
+        return server
+
+    def sync(self, server, *options, port=0, data_port=0):
+        """
+        Run the client once against a server and wait for the server to scan its folder again after the sync
+        :param server: The server started by start_server
+        :param options: Any further client command line options
+        :param port: The port to connect to instead of the server's, such as an emulator's
+        :param data_port: The data port to connect to instead of the server's
+        :return: The SyncClient
+        """
+        server.SCANNED.clear()
+        client = self.CLIENT['SyncClient']([self.CLIENT_FOLDER, '--port', str(port or server.PORT),
+                                            '--data-port', str(data_port or server.DATA_PORT)] + list(options))
+        client.run()
+        self.assertTrue(server.SCANNED.wait(self.SYNC_TIMEOUT), 'The server did not scan its folder after the sync')
+        return client
+
+    def start_emulator(self, server, *options):
+        """
+        Start a NetworkEmulator forwarding free ports to a server's ports
+        :param server: The server started by start_server
+        :param options: The network to emulate as netem-sync.py command line options
+        :return: The port and data port for the client to connect to
+        """
+        port, data_port = self.free_ports(2)
+        emulator = self.NETEM['NetworkEmulator'](['--forward', '%d:%d' % (port, server.PORT),
+                                                  '--forward', '%d:%d' % (data_port, server.DATA_PORT)] + list(options))
+        emulator.start()
+        self.addCleanup(emulator.stop)
+        return port, data_port
+
+    @staticmethod
+    def folder_md5s(folder):
+        """
+        :param folder: The folder to list
+        :return: Dictionary of the md5 of every file beneath the folder keyed by its path relative to the folder
+        """
+        md5s = {}
+        for root, dirs, files in os.walk(folder):
+            for file in files:
+                file_md5 = hashlib.md5()
+                with open(os.path.join(root, file), 'rb') as f:
+                    for data in iter(lambda: f.read(64 * 1024), b''):
+                        file_md5.update(data)
+                md5s[os.path.relpath(os.path.join(root, file), folder)] = file_md5.hexdigest()
+        return md5s
+
+    def test_client_file_add(self):
+        """
+        Check files added to the client arrive in the server's folder intact.
+        """
+        self.write_file('client/added.txt', b'test_client_file_add')
+        self.write_file('client/added.bin', os.urandom(256 * 1024))
+        server = self.start_server(self.SERVER_FOLDER)
+        self.sync(server)
+        self.assertEqual(self.folder_md5s(self.SERVER_FOLDER), self.folder_md5s(self.CLIENT_FOLDER))
+
+    def test_client_writes_metrics(self):
+        """
+        Check the client writes out metrics counting the sync and the file it transferred.
+        """
+        self.write_file('client/metrics.txt', b'test_client_writes_metrics')
+        metrics_path = os.path.join(self.FOLDER, 'client.prom')
+        server = self.start_server(self.SERVER_FOLDER)
+        self.sync(server, '--metrics', metrics_path)
+        with open(metrics_path) as metrics_file:
+            metrics = dict(line.split() for line in metrics_file.read().splitlines()
+                           if line and not line.startswith('#'))
+        self.assertIn('metrics.txt', self.folder_md5s(self.SERVER_FOLDER))
+        self.assertEqual(float(metrics['client_sync_syncs_total']), 1)
+        self.assertEqual(float(metrics['client_sync_files_transferred_total']), 1)
+
+    def test_client_file_add_over_emulated_network(self):
+        """
+        Check a file added to the client arrives intact with the client and server talking through the network emulator
+        with latency, jitter and a bandwidth limit.
+        """
+        self.write_file('client/emulated.bin', os.urandom(512 * 1024))
+        server = self.start_server(self.SERVER_FOLDER)
+        port, data_port = self.start_emulator(server, '--latency', '20', '--jitter', '5', '--bandwidth', '10M',
+                                              '--seed', '1')
+        self.sync(server, port=port, data_port=data_port)
+        self.assertEqual(self.folder_md5s(self.SERVER_FOLDER), self.folder_md5s(self.CLIENT_FOLDER))
+
+    def test_client_file_add_over_dropped_connections(self):
+        """
+        Check files added to the client all arrive intact, with no partly received file left, when the emulator resets
+        half of the connections part way through and the client tries again after each failed sync.
+        """
+        for number in range(4):
+            self.write_file('client/dropped_%d.bin' % number, os.urandom(500000))
+        server = self.start_server(self.SERVER_FOLDER)
+        port, data_port = self.start_emulator(server, '--drop', '0.5', '--drop-after', '200000', '--seed', '3')
+        for attempt in range(10):
+            try:
+                self.sync(server, port=port, data_port=data_port)
+            except OSError:
+                continue
+            if self.folder_md5s(self.SERVER_FOLDER) == self.folder_md5s(self.CLIENT_FOLDER):
+                break
+        self.assertEqual(self.folder_md5s(self.SERVER_FOLDER), self.folder_md5s(self.CLIENT_FOLDER))
+
+    def test_client_file_ignored(self):
+        """
+        Check files and directories the client's .syncignore leaves out are not synced, and a file the rules leave out
+        of the server's folder is not deleted.
+        """
+        self.write_file('client/.syncignore', b'*.tmp\ncache/\n')
+        self.write_file('client/kept.txt', b'test_client_file_ignored')
+        self.write_file('client/skipped.tmp', b'test_client_file_ignored')
+        os.mkdir(os.path.join(self.CLIENT_FOLDER, 'cache'))
+        self.write_file('client/cache/cached.txt', b'test_client_file_ignored')
+        self.write_file('server/local.tmp', b'test_client_file_ignored')
+        server = self.start_server(self.SERVER_FOLDER)
+        self.sync(server)
+        self.assertEqual(sorted(self.folder_md5s(self.SERVER_FOLDER)), ['.syncignore', 'kept.txt', 'local.tmp'])
+
+    def test_client_file_add_sharded(self):
+        """
+        Check files added to the client all arrive intact, and a file the client does not have is deleted, with the
+        server sharded across two processes.
+        """
+        names = ['sharded_%s.txt' % letter for letter in 'abcdefgh']
+        for name in names:
+            self.write_file('client/' + name, b'test_client_file_add_sharded ' + name.encode())
+        self.write_file('server/deleted.txt', b'test_client_file_add_sharded')
+        server = self.start_server(self.SERVER_FOLDER, '--shards', '2')
+        for process in server.SHARDS.PROCESSES:
+            self.addCleanup(process.terminate)
+        self.assertEqual({server.SHARDS.shard(name, 2) for name in names}, {0, 1})
+        self.sync(server)
+        self.assertEqual(self.folder_md5s(self.SERVER_FOLDER), self.folder_md5s(self.CLIENT_FOLDER))
+
+    def test_client_file_add_relayed(self):
+        """
+        Check files added to the client arrive intact at a server downstream of the server the client syncs with, and a
+        file the client does not have is deleted from it. The relaying server waits for the downstream server to finish
+        before it scans its folder again, so the sync has reached the downstream server once it has.
+        """
+        self.write_file('client/relayed.txt', b'test_client_file_add_relayed')
+        self.write_file('client/relayed.bin', os.urandom(256 * 1024))
+        downstream_folder = os.path.join(self.FOLDER, 'downstream')
+        os.mkdir(downstream_folder)
+        self.write_file('downstream/deleted.txt', b'test_client_file_add_relayed')
+        downstream = self.start_server(downstream_folder)
+        server = self.start_server(self.SERVER_FOLDER, '--downstream',
+                                   'localhost:%d:%d' % (downstream.PORT, downstream.DATA_PORT))
+        self.sync(server)
+        self.assertEqual(self.folder_md5s(downstream_folder), self.folder_md5s(self.CLIENT_FOLDER))
+
+    def test_client_file_add_with_state(self):
+        """
+        Check a file added to the client arrives with both sides saving their state, both stat caches are saved and the
+        server's journal is removed once the sync completes.
+        """
+        self.write_file('client/state.txt', b'test_client_file_add_with_state')
+        server_state = os.path.join(self.FOLDER, 'server.state')
+        client_state = os.path.join(self.FOLDER, 'client.state')
+        server = self.start_server(self.SERVER_FOLDER, '--state', server_state)
+        self.sync(server, '--state', client_state)
+        self.assertIn('state.txt', self.folder_md5s(self.SERVER_FOLDER))
+        self.assertTrue(os.path.exists(os.path.join(server_state, 'server-cache')), 'The server cache was not saved')
+        self.assertTrue(os.path.exists(os.path.join(client_state, 'client-cache')), 'The client cache was not saved')
+        self.assertFalse(os.path.exists(os.path.join(server_state, 'server-journal')),
+                         'The server journal was left after the sync completed')
+
+    def test_client_file_add_tuned(self):
+        """
+        Check a file large enough to measure the link arrives intact and the client reports the link it measured and the
+        sizes tuned from it in its summary.
+        """
+        self.write_file('client/tuned.bin', os.urandom(4 * 1024 * 1024))
+        server = self.start_server(self.SERVER_FOLDER, '--nodelay')
+        client = self.sync(server, '--nodelay')
+        self.assertEqual(self.folder_md5s(self.SERVER_FOLDER), self.folder_md5s(self.CLIENT_FOLDER))
+        self.assertGreater(client.SUMMARY['rtt_seconds'], 0, 'The round trip time was not measured')
+        self.assertGreater(client.SUMMARY['link_bytes_per_second'], 0, 'The link throughput was not measured')
+        self.assertGreaterEqual(client.SUMMARY['chunk_size'], 64 * 1024, 'The chunk size was not tuned')
+
+    def test_client_file_add_sparse(self):
+        """
+        Check a sparse file added to the client arrives intact and still sparse.
+        """
+        with open(os.path.join(self.CLIENT_FOLDER, 'sparse.img'), 'wb') as f:
+            f.truncate(64 * 1024 * 1024)
+            f.seek(32 * 1024 * 1024)
+            f.write(b'test_client_file_add_sparse')
+        server = self.start_server(self.SERVER_FOLDER)
+        self.sync(server)
+        self.assertEqual(self.folder_md5s(self.SERVER_FOLDER), self.folder_md5s(self.CLIENT_FOLDER))
+        server_stat = os.stat(os.path.join(self.SERVER_FOLDER, 'sparse.img'))
+        self.assertLess(server_stat.st_blocks * 512, server_stat.st_size // 2, 'sparse.img was not kept sparse')
+
+    def test_client_file_add_verified(self):
+        """
+        Check a file added to the client arrives and is verified against its md5 as it is received, so the server does
+        not read it back to hash it when it scans its folder after the sync, only the file it started with is hashed.
+        The file the server starts with is dated back so the StatCache keeps it rather than treating it as racy.
+        """
+        data = os.urandom(64 * 1024)
+        self.write_file('client/existing.bin', data)
+        existing = self.write_file('server/existing.bin', data)
+        os.utime(existing, (time.time() - 3600, time.time() - 3600))
+        self.write_file('client/verified.bin', os.urandom(1024 * 1024))
+        server = self.start_server(self.SERVER_FOLDER)
+        self.sync(server)
+        self.assertEqual(self.folder_md5s(self.SERVER_FOLDER), self.folder_md5s(self.CLIENT_FOLDER))
+        self.assertEqual(server.METRICS.VALUES.get('rejected_files_total', 0), 0, 'A file was rejected')
+        self.assertEqual(server.METRICS.VALUES['hashed_bytes_total'], 64 * 1024,
+                         'The server read back a file it had received to hash it')
+
+
 if __name__ == '__main__':
     unittest.main()